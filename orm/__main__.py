@@ -4,11 +4,22 @@ import argparse
 
 import orm.parser as parser
 import orm.validator as validator
-from orm.rendervarnish import RenderVarnish
+import orm.fsmcache as fsmcache
+import orm.logprofile as logprofile
+import orm.dispatchtree as dispatchtree
+from orm.rendervarnish import RenderVarnish, MAX_STRING_COMPARISON_VALUES
 from orm.renderhaproxy import RenderHAProxy
 from orm.runtests import run_tests
 
 
+def get_too_many_values_note(match_counts):
+    if not match_counts["too_many_values"]:
+        return ""
+    return " ({} kept as regexes for having over {} values)".format(
+        match_counts["too_many_values"], MAX_STRING_COMPARISON_VALUES
+    )
+
+
 def main():
     # pylint:disable=too-many-branches,too-many-statements
     """ Main function! """
@@ -35,9 +46,18 @@ def main():
         "--cache-path",
         type=str,
         default=None,
-        help="Path to collision check cache file. Caching "
+        help="Path to collision check cache directory. Caching "
         "is disabled if no path is specified.",
     )
+    arg_parser.add_argument(
+        "--cache-max-size",
+        type=int,
+        default=fsmcache.DEFAULT_MAX_SIZE_MB,
+        metavar="MB",
+        help="Maximum size of the collision check cache directory. Least "
+        "recently used entries are evicted first. "
+        "(default: %(default)s)",
+    )
     arg_parser.add_argument(
         "-c",
         "--check",
@@ -68,14 +88,54 @@ def main():
         default=False,
     )
 
+    arg_parser.add_argument(
+        "--profile-logs",
+        type=str,
+        nargs="+",
+        default=None,
+        metavar="LOG",
+        help="Count the hits of domains and rules in HAProxy JSON log files "
+        "(optionally gzipped), and write them to the profile given by "
+        "--profile-path. No config generated.",
+    )
+    arg_parser.add_argument(
+        "--profile-path",
+        type=str,
+        default=None,
+        help="Path to a profile of domain and rule hits. If it exists, "
+        "hot domains and rules are rendered first.",
+    )
+
     args = arg_parser.parse_args()
+    if args.profile_logs:
+        if not args.profile_path:
+            print("ERROR: --profile-logs requires --profile-path.")
+            exit(1)
+        print("Profiling HAProxy log files...")
+        profile = logprofile.make_profile_from_logs(args.profile_logs)
+        logprofile.save_profile(profile, args.profile_path)
+        print(
+            "Profile with {} domains and {} rules written to {}".format(
+                len(profile["domains"]), len(profile["rules"]), args.profile_path
+            )
+        )
+        exit(0)
     yml_files = parser.list_rules_files(args.orm_rules_path)
     if not yml_files:
         print("ERROR: Found no files using glob: {}".format(args.orm_rules_path))
         exit(1)
 
+    # Every file is read and parsed once, and shared by all steps below
+    ruleset = parser.LoadedRuleset(
+        yml_files,
+        globals_file=args.globals_path,
+        rules_root=parser.get_rules_root(args.orm_rules_path),
+    )
+
     if args.globals_path:
-        if not validator.validate_globals_file(args.globals_path):
+        if not validator.validate_globals_file(
+            args.globals_path, globals_doc=ruleset.globals_doc
+        ):
             print("ERROR: Global settings not valid")
             exit(1)
 
@@ -85,7 +145,9 @@ def main():
     if not args.no_check:
         print("Validating ORM rule files...")
         if not validator.validate_rule_files(
-            yml_files=yml_files, cache_path=args.cache_path
+            cache_path=args.cache_path,
+            cache_max_size=args.cache_max_size * 1024 * 1024,
+            ruleset=ruleset,
         ):
             print("ERROR: Not valid")
             exit(1)
@@ -93,13 +155,8 @@ def main():
         print("All checks passed.")
         exit(0)
 
-    parsed_globals = None
-    defaults = None
-    if args.globals_path:
-        parsed_globals = parser.parse_globals(args.globals_path)
-        defaults = parsed_globals.get("defaults", None)
-
-    parsed_rules = parser.parse_rules(yml_files=yml_files, defaults=defaults)
+    parsed_globals = ruleset.globals_doc
+    parsed_rules = ruleset.get_merged_documents(with_defaults=True)
     domain_rules = parsed_rules["rules"]
     tests = parsed_rules["tests"]
 
@@ -112,10 +169,67 @@ def main():
         )
         exit(0)
 
+    profile = None
+    if args.profile_path:
+        profile = logprofile.load_profile(args.profile_path)
+
     print("Rendering Varnish config...")
-    render_varnish = RenderVarnish(rule_docs=domain_rules, globals_doc=parsed_globals)
+    render_varnish = RenderVarnish(
+        rule_docs=domain_rules, globals_doc=parsed_globals, profile=profile
+    )
+    print(
+        "Host dispatch: {} domains, at most {} host comparisons per request "
+        "(a linear chain would need {})".format(
+            len(render_varnish.southbound_subs),
+            dispatchtree.get_host_dispatch_depth(render_varnish.host_dispatch_tree),
+            len(render_varnish.southbound_subs),
+        )
+    )
+    if profile:
+        costs = dispatchtree.get_host_dispatch_costs(render_varnish.host_dispatch_tree)
+        hits = {
+            domain: domain_hits
+            for domain, domain_hits in profile["domains"].items()
+            if domain in costs
+        }
+        if sum(hits.values()):
+            print(
+                "Host dispatch: {:.2f} host comparisons per profiled request "
+                "on average".format(
+                    sum(costs[domain] * hits[domain] for domain in hits)
+                    / sum(hits.values())
+                )
+            )
+    if render_varnish.rule_dispatch_costs:
+        print(
+            "Rule dispatch: at most {} conditions tested per request, "
+            "for at most {} rules per domain".format(
+                max(render_varnish.rule_dispatch_costs.values()),
+                max(len(rules) for rules in render_varnish.actions_southbound.values()),
+            )
+        )
+    for rule_id, rule_counts in render_varnish.rule_match_counts.items():
+        print(
+            "Matches of {}: {} of {} regexes replaced by string "
+            "comparisons{}".format(
+                rule_id,
+                rule_counts["string"],
+                rule_counts["string"] + rule_counts["regex"],
+                get_too_many_values_note(rule_counts),
+            )
+        )
+    print(
+        "Matches: {} of {} regexes replaced by string comparisons{}".format(
+            render_varnish.match_counts["string"],
+            render_varnish.match_counts["string"]
+            + render_varnish.match_counts["regex"],
+            get_too_many_values_note(render_varnish.match_counts),
+        )
+    )
     print("Rendering HAProxy config...")
-    render_haproxy = RenderHAProxy(rule_docs=domain_rules, globals_doc=parsed_globals)
+    render_haproxy = RenderHAProxy(
+        rule_docs=domain_rules, globals_doc=parsed_globals, profile=profile
+    )
     if not args.output_dir:
         render_varnish.print_config()
         render_haproxy.print_config()
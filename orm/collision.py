@@ -0,0 +1,255 @@
+import concurrent.futures
+
+import orm.matchsummary as matchsummary
+
+
+def fsms_collide(one, two):
+    # Entries are bucketed by domain before pairing, so only
+    # same-domain FSM:s ever get here. The sources are checked cheapest
+    # first, since a single disjoint source rules out a collision.
+    return (
+        not one["method"].isdisjoint(two["method"])
+        and not one["query"].isdisjoint(two["query"])
+        and not one["path"].isdisjoint(two["path"])
+    )
+
+
+# The FSM table of a collision check worker process. It is published to the
+# workers once, when they are started, so tasks only carry integer indices.
+collision_fsm_table = []
+
+
+def init_collision_worker(fsm_table):
+    # pylint:disable=global-statement
+    global collision_fsm_table
+    collision_fsm_table = fsm_table
+
+
+def fsms_collide_task(pairs):
+    """
+    Returns the colliding pairs among pairs, a list of (i, j) indices into
+    the FSM table of the worker.
+    """
+    fsm_table = collision_fsm_table
+    return [(i, j) for i, j in pairs if fsms_collide(fsm_table[i], fsm_table[j])]
+
+
+def get_domain_buckets(new_entries, cached_entries):
+    """
+    Returns a domain keyed dict of FSM entry buckets. Each bucket holds
+    the entries which need checking ('new') and the entries verified in an
+    earlier run ('cached') for the domain. Rules on different domains can
+    never collide, so only entries within the same bucket have to be
+    checked against each other.
+    """
+    domain_buckets = {}
+    for fsm_entry in new_entries:
+        bucket = domain_buckets.setdefault(
+            fsm_entry["domain"], {"new": [], "cached": []}
+        )
+        bucket["new"].append(fsm_entry)
+    for fsm_entry in cached_entries:
+        bucket = domain_buckets.setdefault(
+            fsm_entry["domain"], {"new": [], "cached": []}
+        )
+        bucket["cached"].append(fsm_entry)
+    return domain_buckets
+
+
+def count_pairs(num_new, num_cached):
+    # New entries are checked against each other and against the cached
+    # entries. Cached entries are known not to collide with each other.
+    return num_new * (num_new - 1) // 2 + num_new * num_cached
+
+
+collision_tile_size = 32
+
+
+def get_collision_tiles(bucket, tile_size=collision_tile_size):
+    """
+    Yields the pairs of a bucket which have to be collision checked, as
+    lists of (i, j) index pairs into bucket["new"] + bucket["cached"].
+
+    The pair matrix is split into tiles of tile_size x tile_size pairs,
+    so each task sent to a worker carries a reasonable amount of work.
+    """
+    num_new = len(bucket["new"])
+    num_total = num_new + len(bucket["cached"])
+    for row_start in range(0, num_new, tile_size):
+        rows = range(row_start, min(row_start + tile_size, num_new))
+        for col_start in range(row_start, num_total, tile_size):
+            cols = range(col_start, min(col_start + tile_size, num_total))
+            pairs = [(i, j) for i in rows for j in cols if j > i]
+            if pairs:
+                yield pairs
+
+
+def resolve_collision_pairs(domain_buckets, pair_counts, fsm_cache=None):
+    """
+    Settles the pairs of the domain buckets which can be settled without
+    FSM:s: pairs proven disjoint by the prefilters, and pairs of match trees
+    with a verdict from an earlier run in the cache.
+
+    Returns (collisions, pending) where collisions lists the (fsm_one,
+    fsm_two) entry pairs known to collide, and pending maps each pair of
+    cache keys still to be checked by FSM intersection to its entry pairs.
+    The same pair of match trees is only checked once, even if it is found
+    in several domains.
+    """
+    collisions = []
+    pending = {}
+    for bucket in domain_buckets.values():
+        entries = bucket["new"] + bucket["cached"]
+        for pairs in get_collision_tiles(bucket):
+            for i, j in pairs:
+                entry_pair = (entries[i], entries[j])
+                prefilter = matchsummary.prefilter_disjoint(*entry_pair)
+                if prefilter:
+                    pair_counts[prefilter] += 1
+                    continue
+                key_pair = tuple(
+                    sorted((entry_pair[0]["cache_key"], entry_pair[1]["cache_key"]))
+                )
+                if key_pair in pending:
+                    pending[key_pair].append(entry_pair)
+                    continue
+                verdict = None
+                if fsm_cache:
+                    verdict = fsm_cache.get_pair_verdict(*key_pair)
+                if verdict is None:
+                    pending[key_pair] = [entry_pair]
+                    continue
+                pair_counts["pair_cache"] += 1
+                if verdict:
+                    collisions.append(entry_pair)
+    return collisions, pending
+
+
+def get_collision_fsm_table(key_pairs, fsms):
+    """
+    Returns (fsm_table, index_pairs) where fsm_table holds the FSM:s of
+    every match tree in key_pairs once, and index_pairs holds the key pairs
+    as (i, j) indices into the table. fsms maps cache keys to FSM:s.
+    """
+    fsm_table = []
+    table_ids = {}
+    index_pairs = []
+    for key_pair in key_pairs:
+        index_pair = []
+        for cache_key in key_pair:
+            if cache_key not in table_ids:
+                table_ids[cache_key] = len(fsm_table)
+                fsm_table.append(fsms[cache_key])
+            index_pair.append(table_ids[cache_key])
+        index_pairs.append(tuple(index_pair))
+    return fsm_table, index_pairs
+
+
+def check_collisions(key_pairs, fsms, max_workers, pair_counts):
+    """
+    Collision checks the match tree pairs in key_pairs, and yields
+    (key_pair, collides) for each of them. fsms maps cache keys to FSM:s.
+
+    All FSM:s are published to the worker processes once, when they are
+    started. The pairs are then sent to the workers as tiles of table
+    indices. At most two tiles per worker are in flight, so memory use does
+    not grow with the number of pairs.
+    """
+    key_pairs = list(key_pairs)
+    if not key_pairs:
+        return
+    fsm_table, index_pairs = get_collision_fsm_table(key_pairs, fsms)
+    pair_keys = dict(zip(index_pairs, key_pairs))
+    worker_pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=init_collision_worker,
+        initargs=(fsm_table,),
+    )
+    tasks = {}
+
+    def wait_for_tasks(return_when):
+        done, _ = concurrent.futures.wait(tasks, return_when=return_when)
+        for future in done:
+            tile = tasks.pop(future)
+            colliding = set(future.result())
+            for index_pair in tile:
+                yield pair_keys[index_pair], index_pair in colliding
+
+    tile_size = collision_tile_size * collision_tile_size
+    with worker_pool:
+        for tile_start in range(0, len(index_pairs), tile_size):
+            tile = index_pairs[tile_start : tile_start + tile_size]
+            tasks[worker_pool.submit(fsms_collide_task, tile)] = tile
+            pair_counts["checked"] += len(tile)
+            if len(tasks) >= 2 * max_workers:
+                yield from wait_for_tasks(concurrent.futures.FIRST_COMPLETED)
+        yield from wait_for_tasks(concurrent.futures.ALL_COMPLETED)
+
+
+def print_domain_buckets_summary(domain_buckets):
+    total_new = 0
+    total_cached = 0
+    total_pairs = 0
+    for domain, bucket in sorted(domain_buckets.items()):
+        num_new = len(bucket["new"])
+        num_cached = len(bucket["cached"])
+        num_pairs = count_pairs(num_new, num_cached)
+        total_new += num_new
+        total_cached += num_cached
+        total_pairs += num_pairs
+        if num_pairs:
+            print(
+                "Domain {}: {} new, {} cached, {} pairs".format(
+                    domain, num_new, num_cached, num_pairs
+                )
+            )
+    print(
+        "Checking {} pairs in {} domains ({} pairs without domain "
+        "bucketing)".format(
+            total_pairs, len(domain_buckets), count_pairs(total_new, total_cached)
+        )
+    )
+
+
+def get_cached_fsms(fsm_cache, cache_key, alphabet_classes):
+    """
+    Returns the cached FSM:s for cache_key remapped to alphabet_classes,
+    or None if they are not in the cache. The cached FSM:s may have been
+    built over the alphabet classes of another ruleset.
+    """
+    cached = fsm_cache.get(cache_key)
+    if cached is None:
+        return None
+    return {
+        match_type: fsm.remap(alphabet_classes[match_type])
+        for match_type, fsm in cached["fsms"].items()
+    }
+
+
+def split_verified_fsm_entries(domain_entries, fsm_cache):
+    """
+    Splits the FSM entries of every domain into entries which were verified
+    not to collide with each other in an earlier run, and entries which need
+    to be collision checked. Returns (unverified_entries, verified_entries).
+    """
+    verified = fsm_cache.load_verified(domain_entries) if fsm_cache else {}
+    unverified_entries = []
+    verified_entries = []
+    for domain, entries in domain_entries.items():
+        verified_keys = verified.get(domain, set())
+        # Rules with the same match tree always collide, so a key listed
+        # more than once in a domain is never verified.
+        key_counts = {}
+        for fsm_entry in entries:
+            key_counts[fsm_entry["cache_key"]] = (
+                key_counts.get(fsm_entry["cache_key"], 0) + 1
+            )
+        for fsm_entry in entries:
+            if (
+                fsm_entry["cache_key"] in verified_keys
+                and key_counts[fsm_entry["cache_key"]] == 1
+            ):
+                verified_entries.append(fsm_entry)
+            else:
+                unverified_entries.append(fsm_entry)
+    return unverified_entries, verified_entries
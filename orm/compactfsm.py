@@ -0,0 +1,334 @@
+import collections
+from array import array
+
+from greenery import fsm as greenery_fsm
+
+
+def get_typecode(num_states):
+    """ Returns the smallest signed array typecode fitting all state ids """
+    for typecode in ("b", "h", "i"):
+        if num_states < 2 ** (8 * array(typecode).itemsize - 1):
+            return typecode
+    return "q"
+
+
+def iter_breadth_first(starts, get_next):
+    """
+    Yields the items reachable from starts, starts included, in breadth
+    first order. get_next returns the items following an item.
+    """
+    seen = set(starts)
+    queue = collections.deque(starts)
+    while queue:
+        item = queue.popleft()
+        yield item
+        for next_item in get_next(item):
+            if next_item not in seen:
+                seen.add(next_item)
+                queue.append(next_item)
+
+
+def get_live_states(rows, initial, finals):
+    """
+    Returns the states reachable from the initial state which can reach a
+    final state. rows holds the transitions of each state.
+    """
+    reachable = list(
+        iter_breadth_first(
+            [initial],
+            lambda state: (next_state for next_state in rows[state] if next_state >= 0),
+        )
+    )
+    predecessors = {state: set() for state in reachable}
+    for state in reachable:
+        for next_state in rows[state]:
+            if next_state >= 0:
+                predecessors[next_state].add(state)
+    return set(
+        iter_breadth_first(
+            [state for state in reachable if finals[state]],
+            predecessors.__getitem__,
+        )
+    )
+
+
+def refine_partition(rows, finals, live):
+    """
+    Returns a dict mapping each live state to its block of equivalent
+    states, by refining the final/non-final partition until it is stable.
+    """
+    states = sorted(live)
+    block = {state: finals[state] for state in states}
+    num_blocks = len(set(block.values()))
+    while True:
+        signatures = {}
+        new_block = {}
+        for state in states:
+            signature = (block[state],) + tuple(
+                block[next_state] if next_state in live else -1
+                for next_state in rows[state]
+            )
+            new_block[state] = signatures.setdefault(signature, len(signatures))
+        block = new_block
+        if len(signatures) == num_blocks:
+            return block
+        num_blocks = len(signatures)
+
+
+def get_block_states(rows, initial, live, block):
+    """
+    Returns a representative state of each block reachable from the
+    initial state, in breadth first order. The position of a block in
+    the list is its state id in the minimal FSM.
+    """
+    representative = {}
+    for state in sorted(live):
+        representative.setdefault(block[state], state)
+    block_order = iter_breadth_first(
+        [block[initial]],
+        lambda current: (
+            block[next_state]
+            for next_state in rows[representative[current]]
+            if next_state in live
+        ),
+    )
+    return [representative[current] for current in block_order]
+
+
+def get_block_transitions(rows, live, block, block_states):
+    """
+    Returns the flat transition table of the minimal FSM, with one row
+    for each block in block_states.
+    """
+    num_symbols = len(rows[0])
+    block_ids = {block[state]: block_id for block_id, state in enumerate(block_states)}
+    transitions = array(get_typecode(len(block_states)), [-1]) * (
+        len(block_states) * num_symbols
+    )
+    for block_id, state in enumerate(block_states):
+        for k, next_state in enumerate(rows[state]):
+            if next_state in live:
+                transitions[block_id * num_symbols + k] = block_ids[block[next_state]]
+    return transitions
+
+
+class CompactFSM:
+    """
+    Dense, array-backed representation of a deterministic FSM.
+
+    Built from a greenery fsm and minimized. Each symbol is a class of
+    characters given as a string. The states are numbered 0..num_states-1
+    and the transition for state s on the symbol with index k is
+    transitions[s * num_symbols + k], where -1 is the dead state.
+    The transition table uses the smallest integer type which fits the
+    state ids. finals is an accept bitmap with one byte per state.
+
+    Compared to greenery's dicts of dicts this is small to pickle and keep
+    in memory, and fast to intersect.
+    """
+
+    __slots__ = ("symbols", "initial", "finals", "transitions")
+
+    def __init__(self, symbols, initial, finals, transitions):
+        self.symbols = symbols
+        self.initial = initial
+        self.finals = finals
+        self.transitions = transitions
+
+    @classmethod
+    def from_fsm(cls, fsm, symbols=None):
+        """
+        Returns the minimal CompactFSM accepting the same strings as fsm.
+
+        symbols optionally lists the symbol classes as strings of
+        characters. fsm must then be built over the first character of
+        each class, and the CompactFSM treats all characters of a class
+        alike.
+        """
+        if symbols is None:
+            symbols = tuple(sorted(fsm.alphabet, key=str))
+        num_symbols = len(symbols)
+        state_ids = {}
+        for state in fsm.states:
+            state_ids[state] = len(state_ids)
+        transitions = [-1] * (len(state_ids) * num_symbols)
+        finals = bytearray(len(state_ids))
+        for state, state_id in state_ids.items():
+            if state in fsm.finals:
+                finals[state_id] = 1
+            state_map = fsm.map.get(state, {})
+            for k, symbol in enumerate(symbols):
+                next_state = state_map.get(symbol[0])
+                if next_state is not None:
+                    transitions[state_id * num_symbols + k] = state_ids[next_state]
+        return cls.minimize(symbols, state_ids[fsm.initial], finals, transitions)
+
+    @classmethod
+    def minimize(cls, symbols, initial, finals, transitions):
+        """
+        Returns the minimal CompactFSM for a transition table given as a
+        flat list. States which can not reach a final state are merged into
+        the dead state and equivalent states are merged by partition
+        refinement. The states are numbered in breadth first order from the
+        initial state, so FSM:s accepting the same strings get equal tables.
+        """
+        num_symbols = len(symbols)
+        rows = [
+            transitions[state * num_symbols : (state + 1) * num_symbols]
+            for state in range(len(finals))
+        ]
+        live = get_live_states(rows, initial, finals)
+        if initial not in live:
+            return cls(symbols, 0, bytearray(1), array("b", [-1]) * num_symbols)
+        block = refine_partition(rows, finals, live)
+        block_states = get_block_states(rows, initial, live, block)
+        min_finals = bytearray(finals[state] for state in block_states)
+        min_transitions = get_block_transitions(rows, live, block, block_states)
+        return cls(symbols, 0, min_finals, min_transitions)
+
+    def to_fsm(self):
+        """
+        Returns an equivalent greenery fsm, over the first character of
+        each symbol class.
+        """
+        num_symbols = len(self.symbols)
+        transition_map = {}
+        for state in range(self.num_states):
+            row = self.transitions[state * num_symbols : (state + 1) * num_symbols]
+            transition_map[state] = {
+                symbol[0]: next_state
+                for symbol, next_state in zip(self.symbols, row)
+                if next_state >= 0
+            }
+        return greenery_fsm.fsm(
+            alphabet={symbol[0] for symbol in self.symbols},
+            states=set(range(self.num_states)),
+            initial=self.initial,
+            finals={state for state in range(self.num_states) if self.finals[state]},
+            map=transition_map,
+        )
+
+    def remap(self, symbols):
+        """
+        Returns an equivalent CompactFSM over other symbol classes. Every
+        new class takes the transitions of the class which holds its first
+        character, so this FSM must treat all characters of a new class
+        alike.
+        """
+        if symbols == self.symbols:
+            return self
+        num_symbols = len(self.symbols)
+        char_index = self.get_char_index()
+        columns = [char_index.get(symbol[0]) for symbol in symbols]
+        transitions = []
+        for state in range(self.num_states):
+            row = self.transitions[state * num_symbols : (state + 1) * num_symbols]
+            transitions.extend(-1 if k is None else row[k] for k in columns)
+        return self.minimize(symbols, self.initial, self.finals, transitions)
+
+    def get_char_index(self):
+        """ Returns a dict mapping each character to its symbol index """
+        return {char: k for k, symbol in enumerate(self.symbols) for char in symbol}
+
+    @property
+    def num_states(self):
+        return len(self.finals)
+
+    def isempty(self):
+        """ Returns True if no string is accepted """
+        num_symbols = len(self.symbols)
+        transitions = self.transitions
+        reachable = iter_breadth_first(
+            [self.initial],
+            lambda state: (
+                next_state
+                for next_state in transitions[
+                    state * num_symbols : (state + 1) * num_symbols
+                ]
+                if next_state >= 0
+            ),
+        )
+        return not any(self.finals[state] for state in reachable)
+
+    def iter_product_states(self, other):
+        """
+        Yields the states of the product automaton of two FSM:s, breadth
+        first from the pair of initial states, as (one, two, row). row
+        holds the ids of the product states following on each symbol, -1
+        for the dead state. Product states are numbered in the order they
+        are yielded, starting from 0.
+        """
+        if self.symbols != other.symbols:
+            raise ValueError("Can not intersect FSM:s over different alphabets")
+        num_symbols = len(self.symbols)
+        start = (self.initial, other.initial)
+        product_ids = {start: 0}
+        queue = collections.deque([start])
+        while queue:
+            one, two = queue.popleft()
+            row = []
+            for pair in zip(
+                self.transitions[one * num_symbols : (one + 1) * num_symbols],
+                other.transitions[two * num_symbols : (two + 1) * num_symbols],
+            ):
+                if pair[0] < 0 or pair[1] < 0:
+                    row.append(-1)
+                    continue
+                pair_id = product_ids.get(pair)
+                if pair_id is None:
+                    pair_id = product_ids[pair] = len(product_ids)
+                    queue.append(pair)
+                row.append(pair_id)
+            yield one, two, row
+
+    def intersection(self, other):
+        """ Returns the product FSM accepting strings accepted by both """
+        transitions = array("i")
+        finals = bytearray()
+        for one, two, row in self.iter_product_states(other):
+            finals.append(self.finals[one] & other.finals[two])
+            transitions.extend(row)
+        return CompactFSM(self.symbols, 0, finals, transitions)
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def isdisjoint(self, other):
+        """
+        Returns True if no string is accepted by both FSM:s.
+
+        The product automaton is explored lazily, and the search stops at
+        the first jointly accepting state. The intersection is never
+        materialized.
+        """
+        return not any(
+            self.finals[one] and other.finals[two]
+            for one, two, _ in self.iter_product_states(other)
+        )
+
+    def accepts(self, string):
+        symbol_index = self.get_char_index()
+        num_symbols = len(self.symbols)
+        state = self.initial
+        for char in string:
+            if char not in symbol_index:
+                return False
+            state = self.transitions[state * num_symbols + symbol_index[char]]
+            if state < 0:
+                return False
+        return bool(self.finals[state])
+
+    def __eq__(self, other):
+        if not isinstance(other, CompactFSM):
+            return NotImplemented
+        return (
+            self.symbols == other.symbols
+            and self.initial == other.initial
+            and self.finals == other.finals
+            and self.transitions == other.transitions
+        )
+
+    def __repr__(self):
+        return "CompactFSM({} states, {} symbols)".format(
+            self.num_states, len(self.symbols)
+        )
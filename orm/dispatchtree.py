@@ -0,0 +1,112 @@
+import os
+
+import orm.logprofile as logprofile
+
+# Rules sharing a longer literal path prefix than their trie node are only
+# nested in a check of that prefix if there are at least this many
+MIN_PATH_PREFIX_GROUP = 2
+
+
+def get_path_prefix_trie(entries, prefix=""):
+    """
+    Returns a trie of rules by the literal prefix of all paths they match.
+
+    entries lists (path prefix, rule) tuples, all with paths beginning with
+    prefix. A node is a tuple (prefix, rules, children), where rules lists
+    the rules of the node in the order of entries and children lists the
+    nodes of groups of rules with a longer common prefix. The children are
+    ordered by their first rule in entries.
+    """
+    groups = {}
+    for path_prefix, rule in entries:
+        if len(path_prefix) > len(prefix):
+            groups.setdefault(path_prefix[len(prefix)], []).append((path_prefix, rule))
+    groups = {
+        char: group
+        for char, group in groups.items()
+        if len(group) >= MIN_PATH_PREFIX_GROUP
+    }
+    rules = [
+        rule
+        for path_prefix, rule in entries
+        if len(path_prefix) <= len(prefix) or path_prefix[len(prefix)] not in groups
+    ]
+    children = [
+        get_path_prefix_trie(
+            group, os.path.commonprefix([path_prefix for path_prefix, _ in group])
+        )
+        for group in groups.values()
+    ]
+    return (prefix, rules, children)
+
+
+def get_path_prefix_trie_cost(trie):
+    """ Returns the most conditions tested for a request in a trie """
+    _, rules, children = trie
+    child_costs = [
+        index + 1 + get_path_prefix_trie_cost(child)
+        for index, child in enumerate(children)
+    ]
+    return len(rules) + max(child_costs + [len(children)])
+
+
+# Hosts are compared with the remaining domains one by one once the host
+# dispatch has narrowed them down to at most this many
+MAX_HOST_CHAIN_LENGTH = 3
+
+
+def get_host_dispatch_tree(domains, hits=None):
+    """
+    Returns a decision tree telling the domains apart.
+
+    A leaf is a list of at most MAX_HOST_CHAIN_LENGTH domains, which are
+    compared with the host one by one, hottest first. An inner node is a
+    tuple (position, chars, left, right): hosts with one of chars at
+    position go to the right subtree and all other hosts to the left one.
+    The tree is balanced by the hits of the domains (plus one), so hot
+    domains take fewer comparisons.
+    """
+    if hits is None:
+        hits = {}
+    domains = sorted(set(domains))
+    if len(domains) <= MAX_HOST_CHAIN_LENGTH:
+        return logprofile.sort_by_hits(domains, hits)
+    # The domains are sorted, so all of them share the common prefix of
+    # the first and the last, and are sorted by the character after it.
+    position = len(os.path.commonprefix((domains[0], domains[-1])))
+    keys = [domain[position : position + 1] for domain in domains]
+    weights = [1 + hits.get(domain, 0) for domain in domains]
+    total_weight = sum(weights)
+    split = None
+    left_weight = 0
+    for index in range(1, len(domains)):
+        left_weight += weights[index - 1]
+        if keys[index] == keys[index - 1]:
+            continue
+        imbalance = abs(2 * left_weight - total_weight)
+        if split is None or imbalance < split_imbalance:
+            split, split_imbalance = index, imbalance
+    return (
+        position,
+        "".join(sorted(set(keys[split:]))),
+        get_host_dispatch_tree(domains[:split], hits),
+        get_host_dispatch_tree(domains[split:], hits),
+    )
+
+
+def get_host_dispatch_costs(tree):
+    """ Returns the number of host comparisons to reach each domain """
+    if isinstance(tree, list):
+        return {domain: index + 1 for index, domain in enumerate(tree)}
+    _, _, left, right = tree
+    costs = get_host_dispatch_costs(left)
+    costs.update(get_host_dispatch_costs(right))
+    return {domain: cost + 1 for domain, cost in costs.items()}
+
+
+def get_host_dispatch_depth(tree):
+    """ Returns the most host comparisons made to dispatch a request """
+    if isinstance(tree, list):
+        return len(tree)
+    _, _, left, right = tree
+    return 1 + max(get_host_dispatch_depth(left), get_host_dispatch_depth(right))
@@ -0,0 +1,299 @@
+import os
+import json
+import hashlib
+import pickle
+import tempfile
+from importlib import metadata
+
+# Bump whenever the layout or the content of the cache entries changes.
+CACHE_FORMAT_VERSION = "2"
+
+DEFAULT_MAX_SIZE_MB = 1024
+
+# Pair verdicts are kept in 256 shard files of at most this many verdicts
+# each. The least recently used verdicts of a shard are dropped first.
+MAX_PAIR_VERDICTS_PER_SHARD = 16384
+
+
+def get_package_version(package_name):
+    try:
+        return metadata.version(package_name)
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+cache_key_salt = [
+    CACHE_FORMAT_VERSION,
+    get_package_version("origin-routing-machine"),
+    get_package_version("greenery"),
+]
+
+
+def get_cache_key(match_tree):
+    """
+    Returns a stable key for the FSM:s of a match tree. The key is a hash of
+    the match tree (independent of dict ordering) together with the ORM and
+    greenery versions, so entries from other versions are never used.
+    """
+    serialized = json.dumps(
+        [cache_key_salt, match_tree], sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def get_pair_key(key_one, key_two):
+    """
+    Returns the key of the unordered pair of two cache keys, as 16 bytes.
+    The first byte picks the shard the verdict of the pair is kept in.
+    """
+    serialized = ":".join(sorted((key_one, key_two)))
+    return hashlib.sha256(serialized.encode("utf-8")).digest()[:16]
+
+
+def get_manifest_key(rules_root=None):
+    """
+    Returns the key of the rule file manifest of the rules in rules_root
+    (by default the working directory). Every rules tree (and checkout)
+    has its own manifest.
+    """
+    return get_cache_key(["manifest", os.path.abspath(rules_root or os.curdir)])
+
+
+def write_atomically(path, data):
+    """ Writes data to path so that readers never see a partial file """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+class CacheStats:
+    """
+    Counts the hits, misses and writes of an FSMCache, and the bytes
+    written since the size of the cache was last saved.
+    """
+
+    # pylint:disable=too-few-public-methods
+    __slots__ = ("hits", "misses", "writes", "written_bytes")
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.written_bytes = 0
+
+
+class FSMCache:
+    """
+    Content addressed on-disk FSM cache.
+
+    Every entry is stored in its own file, sharded into subdirectories by
+    key prefix. Entries are loaded lazily, written atomically and evicted
+    least recently used first when the cache grows beyond max_size bytes.
+    Several processes may share the same cache directory.
+
+    Entries live in namespaces: "fsm" for the FSM:s of whole match trees,
+    "leaf" for the FSM:s of single matches, "pair" for shards of
+    collision verdicts of match tree pairs, "verified" for the keys of the
+    entries of each domain which were verified not to collide with each
+    other in the latest run on the domain, and "manifest" for the
+    manifests of the rule files which passed schema validation, one per
+    rules tree.
+    """
+
+    namespaces = ("fsm", "leaf", "pair", "verified", "manifest")
+
+    def __init__(
+        self,
+        cache_dir,
+        max_size=DEFAULT_MAX_SIZE_MB * 1024 * 1024,
+        max_pair_verdicts=MAX_PAIR_VERDICTS_PER_SHARD,
+    ):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.stats = CacheStats()
+        self.max_pair_verdicts = max_pair_verdicts
+        # Pair verdict shards loaded in this run, and the ones with new
+        # verdicts which have to be saved
+        self.pair_shards = {}
+        self.dirty_pair_shards = set()
+
+    def entry_path(self, key, namespace="fsm"):
+        return os.path.join(self.cache_dir, namespace, key[:2], key + ".pkl")
+
+    def __contains__(self, key):
+        return os.path.isfile(self.entry_path(key))
+
+    def get(self, key, namespace="fsm"):
+        """ Returns the cached entry for key, or None on a cache miss """
+        path = self.entry_path(key, namespace)
+        try:
+            with open(path, "rb") as entry_file:
+                entry = pickle.load(entry_file)
+            # The modification time is used as access time for LRU eviction
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        return entry
+
+    def put(self, key, entry, namespace="fsm"):
+        data = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+        write_atomically(self.entry_path(key, namespace), data)
+        self.stats.writes += 1
+        self.stats.written_bytes += len(data)
+
+    def load_size(self):
+        """ Returns the size of the cache as last saved, or None """
+        try:
+            with open(os.path.join(self.cache_dir, "size.json"), "r") as size_file:
+                size = json.load(size_file)
+        except (OSError, ValueError):
+            return None
+        return size if isinstance(size, int) else None
+
+    def save_size(self, size):
+        data = json.dumps(size).encode("utf-8")
+        write_atomically(os.path.join(self.cache_dir, "size.json"), data)
+        self.stats.written_bytes = 0
+
+    def evict(self):
+        """
+        Removes least recently used entries until within max_size.
+
+        The size of the cache is estimated as the size saved by the latest
+        run plus the bytes written since, and the cache is only walked when
+        the estimate is beyond max_size. Rewritten or evicted entries make
+        the estimate too high, which only makes the walk come early. Runs
+        saving the size at the same time may lose each other's writes from
+        the estimate, until the next walk saves the real size.
+        """
+        size = self.load_size()
+        if size is not None and size + self.stats.written_bytes <= self.max_size:
+            self.save_size(size + self.stats.written_bytes)
+            return 0
+        entries = []
+        total_size = 0
+        for namespace in self.namespaces:
+            namespace_dir = os.path.join(self.cache_dir, namespace)
+            for dirpath, _, filenames in os.walk(namespace_dir):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                    total_size += stat.st_size
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            evicted += 1
+        self.save_size(total_size)
+        return evicted
+
+    def get_pair_shard(self, pair_key):
+        shard_id = "{:02x}".format(pair_key[0])
+        if shard_id not in self.pair_shards:
+            self.pair_shards[shard_id] = self.get(shard_id, "pair") or {}
+        return shard_id, self.pair_shards[shard_id]
+
+    def get_pair_verdict(self, key_one, key_two):
+        """
+        Returns True if the match trees with the given cache keys were found
+        to collide in an earlier run, False if they were found disjoint and
+        None if the pair has no verdict.
+        """
+        pair_key = get_pair_key(key_one, key_two)
+        _, shard = self.get_pair_shard(pair_key)
+        verdict = shard.pop(pair_key, None)
+        if verdict is not None:
+            # Keep the shard in least recently used first order
+            shard[pair_key] = verdict
+        return verdict
+
+    def put_pair_verdict(self, key_one, key_two, verdict):
+        pair_key = get_pair_key(key_one, key_two)
+        shard_id, shard = self.get_pair_shard(pair_key)
+        shard.pop(pair_key, None)
+        shard[pair_key] = verdict
+        self.dirty_pair_shards.add(shard_id)
+
+    def save_pair_verdicts(self):
+        """
+        Writes the shards with new verdicts. Verdicts written by other
+        processes since the shard was loaded are kept, and every shard is
+        cut down to the max_pair_verdicts most recently used verdicts.
+        """
+        for shard_id in sorted(self.dirty_pair_shards):
+            shard = self.pair_shards[shard_id]
+            on_disk = self.get(shard_id, "pair") or {}
+            merged = {
+                pair_key: verdict
+                for pair_key, verdict in on_disk.items()
+                if pair_key not in shard
+            }
+            merged.update(shard)
+            if len(merged) > self.max_pair_verdicts:
+                merged = dict(
+                    list(merged.items())[len(merged) - self.max_pair_verdicts :]
+                )
+            self.pair_shards[shard_id] = merged
+            self.put(shard_id, merged, "pair")
+        self.dirty_pair_shards.clear()
+
+    def load_verified(self, domains):
+        """ Returns a domain keyed dict with sets of verified entry keys """
+        verified = {}
+        for domain in domains:
+            keys = self.get(get_cache_key(["verified", domain]), "verified")
+            if keys is not None:
+                verified[domain] = keys
+        return verified
+
+    def save_verified(self, verified):
+        """
+        Saves the verified entry keys of the domains in verified. Keys
+        saved for other domains, possibly by other processes, are kept.
+        """
+        for domain, keys in verified.items():
+            self.put(get_cache_key(["verified", domain]), set(keys), "verified")
+
+    def load_manifest(self, rules_root=None):
+        """
+        Returns the manifest of the rule files in rules_root, a dict keyed
+        by file path (relative to rules_root) with the content hash
+        ("hash") and the rules ("rules") of every rule file which passed
+        schema validation in earlier runs.
+        """
+        manifest = self.get(get_manifest_key(rules_root), "manifest")
+        return manifest if isinstance(manifest, dict) else {}
+
+    def update_manifest(self, changes, rules_root=None):
+        """
+        Updates the manifest of the rule files in rules_root with changes,
+        a dict keyed by file path with the new entry of the file, or None
+        to remove it. Entries of other files, possibly written by other
+        processes since the manifest was loaded, are kept.
+        """
+        manifest = self.load_manifest(rules_root)
+        for path, entry in changes.items():
+            if entry is None:
+                manifest.pop(path, None)
+            else:
+                manifest[path] = entry
+        self.put(get_manifest_key(rules_root), manifest, "manifest")
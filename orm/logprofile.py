@@ -0,0 +1,113 @@
+import os
+import gzip
+import json
+from collections import Counter
+
+from orm.fsmcache import write_atomically
+
+# Name of the HAProxy section in front of Varnish, which logs every request.
+# The loopback frontend logs the rule id of the backend used as backend name.
+EXTERNAL_FRONTEND = "orm_external"
+
+# Backend names which are not ORM rule ids
+NON_RULE_BACKENDS = (EXTERNAL_FRONTEND, "<NOSRV>")
+
+# Position of the Host header among the captured request headers
+HOST_HEADER_INDEX = 2
+
+
+def open_log_file(path):
+    """ Opens a log file for reading text, decompressing it if gzipped """
+    with open(path, "rb") as log_file:
+        gzipped = log_file.read(2) == b"\x1f\x8b"
+    if gzipped:
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, "rt", encoding="utf-8", errors="replace")
+
+
+def iter_log_entries(paths):
+    """
+    Yields the JSON log entries of HAProxy log files one by one, skipping
+    lines which are not JSON. Lines may have a syslog prefix.
+    """
+    for path in paths:
+        with open_log_file(path) as log_file:
+            for line in log_file:
+                start = line.find("{")
+                if start < 0:
+                    continue
+                try:
+                    entry = json.loads(line[start:])
+                except ValueError:
+                    continue
+                if isinstance(entry, dict):
+                    yield entry
+
+
+def get_log_entry_host(entry):
+    """ Returns the Host header of a log entry, or None if not captured """
+    headers = entry.get("headers")
+    if not isinstance(headers, str):
+        return None
+    headers = headers.strip("{}").split("|")
+    if len(headers) <= HOST_HEADER_INDEX or not headers[HOST_HEADER_INDEX]:
+        return None
+    return headers[HOST_HEADER_INDEX]
+
+
+def make_profile(entries):
+    """
+    Returns the hit counts of domains and rule ids in HAProxy log entries.
+
+    Every request is logged by the external frontend, and once more by the
+    loopback frontend if Varnish sent it to a rule's backend. Domains are
+    counted from the external frontend's entries, or from the loopback
+    frontend's entries if there are none.
+    """
+    external_hosts = Counter()
+    rule_hosts = Counter()
+    rules = Counter()
+    for entry in entries:
+        backend_name = entry.get("backend_name")
+        host = get_log_entry_host(entry)
+        if backend_name == EXTERNAL_FRONTEND:
+            if host:
+                external_hosts[host] += 1
+        elif backend_name and backend_name not in NON_RULE_BACKENDS:
+            rules[backend_name] += 1
+            if host:
+                rule_hosts[host] += 1
+    return {"domains": dict(external_hosts or rule_hosts), "rules": dict(rules)}
+
+
+def make_profile_from_logs(paths):
+    return make_profile(iter_log_entries(paths))
+
+
+def load_profile(path):
+    """ Returns the profile in a sidecar file, or an empty profile """
+    profile = {"domains": {}, "rules": {}}
+    try:
+        with open(path, "r") as profile_file:
+            loaded = json.load(profile_file)
+    except (OSError, ValueError):
+        return profile
+    if not isinstance(loaded, dict):
+        return profile
+    for key in profile:
+        if isinstance(loaded.get(key), dict):
+            profile[key] = loaded[key]
+    return profile
+
+
+def save_profile(profile, path):
+    data = json.dumps(profile, indent=2, sort_keys=True)
+    write_atomically(os.path.abspath(path), data.encode("utf-8"))
+
+
+def sort_by_hits(items, hits, key=None):
+    """
+    Returns items sorted by their hits, hottest first. Items without hits
+    keep their order after the ones with hits.
+    """
+    return sorted(items, key=lambda item: -hits.get(key(item) if key else item, 0))
@@ -0,0 +1,453 @@
+import string
+import concurrent.futures
+import threading
+
+from greenery import lego
+
+import orm.parser as parser
+import orm.fsmcache as fsmcache
+from orm.compactfsm import CompactFSM
+
+
+class ValidateRuleConstraintsException(Exception):
+    pass
+
+
+def is_ascii_letter_range(start_char, end_char):
+    return (
+        start_char in string.ascii_letters
+        and end_char in string.ascii_letters
+        and (
+            (
+                start_char.isupper()
+                and end_char.isupper()
+                or (start_char.islower() and end_char.islower())
+            )
+        )
+    )
+
+
+def lego_ignore_case(instance):
+    in_char_class = False
+    new_inst = ""
+    i = 0
+    prev_char = ""
+    while i < len(instance):
+        char = instance[i]
+        if char == "[" and prev_char != "\\":
+            in_char_class = True
+            new_inst += char
+            i += 1
+        elif char == "]" and prev_char != "\\":
+            in_char_class = False
+            new_inst += char
+            i += 1
+        elif in_char_class:
+            if instance[i + 1] == "-" and char != "\\":  # character range
+                end_char = instance[i + 2]
+                if is_ascii_letter_range(char, end_char):
+                    # Only be case insensitive in letter-only ranges
+                    # If we need to support other ranges, it is better to
+                    # add ignore-case support to greenery.lego
+                    new_inst += (
+                        char.lower()
+                        + "-"
+                        + end_char.lower()
+                        + char.upper()
+                        + "-"
+                        + end_char.upper()
+                    )
+                else:
+                    # Do not touch weird ranges
+                    new_inst += instance[i : i + 3]
+                i += 3
+                prev_char = end_char
+            elif char.isalpha():
+                new_inst += char.lower() + char.upper()
+                i += 1
+            else:
+                new_inst += char
+                i += 1
+        else:
+            if char.isalpha():
+                new_inst += "[" + char.lower() + char.upper() + "]"
+            else:
+                new_inst += char
+            i += 1
+        prev_char = instance[i - 1]
+    return new_inst
+
+
+def lego_re_escape(instance):
+    for special_char in "\\{}[].*+?|":
+        instance = instance.replace(special_char, "\\" + special_char)
+    return instance
+
+
+def get_match_regex(fun, inp):
+    """ Returns the lego regex for a match function and its input """
+    value = inp["value"]
+    lego_regex = value if fun == "regex" else lego_re_escape(value)
+    if inp.get("ignore_case", False):
+        lego_regex = lego_ignore_case(lego_regex)
+    if fun == "begins_with":
+        return lego_regex + r".*"
+    if fun == "ends_with":
+        return r".*" + lego_regex
+    if fun == "contains":
+        return r".*" + lego_regex + r".*"
+    if fun in ("exact", "regex"):
+        return lego_regex
+    raise ValidateRuleConstraintsException(
+        "Handling of match function " + str(fun) + " not implemented."
+    )
+
+
+def get_lego_charsets(lego_piece):
+    """ Yields the character sets of all charclasses in a lego piece """
+    if isinstance(lego_piece, lego.charclass):
+        yield lego_piece.chars
+    elif isinstance(lego_piece, lego.mult):
+        yield from get_lego_charsets(lego_piece.multiplicand)
+    elif isinstance(lego_piece, lego.conc):
+        for mult in lego_piece.mults:
+            yield from get_lego_charsets(mult)
+    elif isinstance(lego_piece, lego.pattern):
+        for conc in lego_piece.concs:
+            yield from get_lego_charsets(conc)
+
+
+def get_default_alphabet_classes():
+    """ Returns the alphabet classes with one class per character """
+    return tuple(sorted(string.printable))
+
+
+def get_alphabet_classes(match_trees, match_type):
+    """
+    Returns the partition of the alphabet into classes of characters which
+    no match on match_type in any of match_trees can tell apart, as a
+    sorted tuple of strings with the sorted characters of each class.
+
+    Every FSM built for these match trees accepts a string if and only if
+    it accepts the string with each character replaced by the first
+    character of its class. FSM:s can therefore be built and intersected
+    over one symbol per class instead of the whole alphabet.
+    """
+    charsets = set()
+
+    def handle_match(src, fun, inp, negate):
+        # pylint:disable=unused-argument
+        if src == match_type:
+            for single_inp in parser.iter_match_inputs(inp):
+                regex = get_match_regex(fun, single_inp)
+                charsets.update(get_lego_charsets(lego.parse(regex)))
+
+    func = {"handle_match": handle_match}
+    for match_tree in match_trees:
+        parser.traverse_match_tree(func, match_tree)
+    alphabet = sorted(string.printable)
+    class_ids = dict.fromkeys(alphabet, 0)
+    for charset in charsets:
+        # Split every class in the characters in and not in charset
+        new_ids = {}
+        for char in alphabet:
+            key = (class_ids[char], char in charset)
+            class_ids[char] = new_ids.setdefault(key, len(new_ids))
+    classes = {}
+    for char in alphabet:
+        classes[class_ids[char]] = classes.get(class_ids[char], "") + char
+    return tuple(sorted(classes.values()))
+
+
+def get_all_alphabet_classes(match_trees):
+    return {
+        match_type: get_alphabet_classes(match_trees, match_type)
+        for match_type in ("method", "path", "query")
+    }
+
+
+def fsm_parse_regex_task(regex, negate, alphabet):
+    fsm = lego.parse(regex).to_fsm(alphabet)
+    return fsm.everythingbut() if negate else fsm
+
+
+def fsm_negate_task(fsm):
+    return fsm.everythingbut()
+
+
+def fsm_compact_task(fsm, alphabet_classes):
+    return CompactFSM.from_fsm(fsm, alphabet_classes)
+
+
+def fsm_action_task(action, fsm1, fsm2):
+    if action == "and":
+        return fsm1 & fsm2
+    elif action == "or":
+        return fsm1 | fsm2
+    else:
+        raise ValidateRuleConstraintsException(
+            "Unknown fsm_action_task " "action: " + action
+        )
+
+
+class LeafFSMMemo:
+    """
+    Memo of the FSM:s of single matches (leaves of match trees), keyed by
+    (regex, negate, alphabet classes). The regex covers the match function
+    and ignore_case. Identical leaves of all rules in a run share one parse
+    task. Leaves missing in the memo are loaded from the FSM cache when
+    there is one, and newly parsed leaves are written to it by save().
+    Thread safe.
+    """
+
+    def __init__(self, worker_pool, fsm_cache=None):
+        self.worker_pool = worker_pool
+        self.fsm_cache = fsm_cache
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.parsed = []
+        self.hits = 0
+        self.loaded = 0
+
+    @staticmethod
+    def get_cache_key(regex, negate):
+        return fsmcache.get_cache_key(["leaf", regex, negate])
+
+    def get(self, regex, negate, alphabet_classes):
+        """ Returns a future of the greenery fsm of a leaf """
+        key = (regex, negate, alphabet_classes)
+        with self.lock:
+            future = self.futures.get(key)
+            if future is not None:
+                self.hits += 1
+                return future
+            future = self.futures[key] = concurrent.futures.Future()
+        cached = None
+        if self.fsm_cache:
+            cached = self.fsm_cache.get(self.get_cache_key(regex, negate), "leaf")
+        if cached is not None:
+            # Cached leaves may be built over the classes of another ruleset
+            future.set_result(cached.remap(alphabet_classes).to_fsm())
+            with self.lock:
+                self.loaded += 1
+            return future
+        alphabet = {alphabet_class[0] for alphabet_class in alphabet_classes}
+        parse_future = self.worker_pool.submit(
+            fsm_parse_regex_task, regex, negate, alphabet
+        )
+        parse_future.add_done_callback(lambda done: copy_future_result(done, future))
+        with self.lock:
+            self.parsed.append(key)
+        return future
+
+    def save(self):
+        """ Writes the newly parsed leaves to the FSM cache """
+        for key in self.parsed:
+            regex, negate, alphabet_classes = key
+            compact_fsm = CompactFSM.from_fsm(
+                self.futures[key].result(), alphabet_classes
+            )
+            self.fsm_cache.put(self.get_cache_key(regex, negate), compact_fsm, "leaf")
+
+    def print_summary(self):
+        print(
+            "Got {} leaf FSM:s. {} reused within this run. {} loaded from cache. "
+            "{} freshly parsed.".format(
+                len(self.futures), self.hits, self.loaded, len(self.parsed)
+            )
+        )
+
+
+def copy_future_result(source, target):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+class FSMGraph:
+    """
+    Dependency graph of FSM construction for any number of match trees.
+
+    Nodes are parse (a leaf match), and, or, not and compact (minimize into
+    a CompactFSM) operations. Identical subexpressions, also across match
+    trees, are the same node. run() dispatches every node to the worker
+    pool as soon as its inputs are done, without blocking any threads, so
+    all workers are kept busy until the last FSM is finished.
+    """
+
+    def __init__(self, alphabet_classes=None):
+        if alphabet_classes is None:
+            alphabet_classes = dict.fromkeys(
+                ("method", "path", "query"), get_default_alphabet_classes()
+            )
+        self.alphabet_classes = alphabet_classes
+        self.node_ids = {}
+        self.nodes = []
+        self.num_shared = 0
+
+    def add_node(self, node):
+        """ Returns the id of node, adding it unless already in the graph """
+        node_id = self.node_ids.get(node)
+        if node_id is None:
+            node_id = self.node_ids[node] = len(self.nodes)
+            self.nodes.append(node)
+        else:
+            self.num_shared += 1
+        return node_id
+
+    def add_condition_list(self, node_ids, op):
+        # and/or are commutative and idempotent, so the children are
+        # deduplicated and sorted to share more subexpressions.
+        node_ids = sorted(set(node_ids))
+        while len(node_ids) > 1:
+            # Balanced, so independent parts can be built in parallel
+            paired_ids = [
+                self.add_node((op, node_ids[i], node_ids[i + 1]))
+                for i in range(0, len(node_ids) - 1, 2)
+            ]
+            if len(node_ids) % 2:
+                paired_ids.append(node_ids[-1])
+            node_ids = paired_ids
+        return node_ids[0]
+
+    def add_negation(self, node_id):
+        node = self.nodes[node_id]
+        if node[0] == "not":
+            return node[1]
+        return self.add_node(("not", node_id))
+
+    def add_match_tree(self, match_tree, match_type):
+        """
+        Adds the nodes building the CompactFSM for the match_type part of
+        match_tree, and returns the id of the final node.
+        """
+        if match_type not in self.alphabet_classes:
+            raise ValidateRuleConstraintsException(
+                "Handling of match type " + str(match_type) + " not implemented."
+            )
+
+        def handle_condition_list(data_list_in, op, negate):
+            if op == "or" and any(data is None for data in data_list_in):
+                # A match on another source can satisfy the condition list on
+                # its own, so it does not constrain this source at all.
+                return None
+            node_ids = [data for data in data_list_in if data is not None]
+            if not node_ids:
+                return None
+            node_id = self.add_condition_list(node_ids, op)
+            return self.add_negation(node_id) if negate else node_id
+
+        def handle_match(src, fun, inp, negate):
+            if src != match_type:
+                return None
+            regexes = [
+                get_match_regex(fun, single_inp)
+                for single_inp in parser.iter_match_inputs(inp)
+            ]
+            if len(regexes) == 1:
+                return self.add_node(("parse", regexes[0], negate, match_type))
+            # Merged matches are built from the FSM:s of their values, which
+            # are shared with single matches on the same values
+            node_ids = [
+                self.add_node(("parse", regex, False, match_type)) for regex in regexes
+            ]
+            node_id = self.add_condition_list(node_ids, "or")
+            return self.add_negation(node_id) if negate else node_id
+
+        func = {
+            "handle_condition_list": handle_condition_list,
+            "handle_match": handle_match,
+        }
+        node_id = parser.traverse_match_tree(func, match_tree)
+        if node_id is None:
+            node_id = self.add_node(("parse", ".*", False, match_type))
+        return self.add_node(("compact", node_id, match_type))
+
+    @staticmethod
+    def get_children(node):
+        op = node[0]
+        if op in ("and", "or"):
+            return set(node[1:3])
+        if op in ("not", "compact"):
+            return {node[1]}
+        return set()
+
+    def submit(self, node, results, worker_pool, leaf_memo):
+        """ Returns a future for the result of node """
+        op = node[0]
+        if op == "parse":
+            _, regex, negate, match_type = node
+            return leaf_memo.get(regex, negate, self.alphabet_classes[match_type])
+        if op in ("and", "or"):
+            return worker_pool.submit(
+                fsm_action_task, op, results[node[1]], results[node[2]]
+            )
+        if op == "not":
+            return worker_pool.submit(fsm_negate_task, results[node[1]])
+        if op == "compact":
+            return worker_pool.submit(
+                fsm_compact_task, results[node[1]], self.alphabet_classes[node[2]]
+            )
+        raise ValidateRuleConstraintsException("Unknown FSM graph node: " + op)
+
+    def run(self, worker_pool, leaf_memo=None):
+        """
+        Builds all nodes and yields (node_id, CompactFSM) for every compact
+        node as soon as it is done.
+        """
+        # pylint:disable=too-many-locals
+        if leaf_memo is None:
+            leaf_memo = LeafFSMMemo(worker_pool)
+        parents = [[] for _ in self.nodes]
+        num_pending = [0] * len(self.nodes)
+        for node_id, node in enumerate(self.nodes):
+            for child_id in self.get_children(node):
+                parents[child_id].append(node_id)
+                num_pending[node_id] += 1
+        # Results are dropped as soon as all their parents are submitted
+        num_unsubmitted_parents = [len(node_parents) for node_parents in parents]
+        results = {}
+        running = {}
+
+        def submit(node_id):
+            node = self.nodes[node_id]
+            future = self.submit(node, results, worker_pool, leaf_memo)
+            # Leaf futures are shared by equal leaves of different sources
+            running.setdefault(future, []).append(node_id)
+            for child_id in self.get_children(node):
+                num_unsubmitted_parents[child_id] -= 1
+                if not num_unsubmitted_parents[child_id]:
+                    del results[child_id]
+
+        for node_id in range(len(self.nodes)):
+            if not num_pending[node_id]:
+                submit(node_id)
+        while running:
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                for node_id in running.pop(future):
+                    if self.nodes[node_id][0] == "compact":
+                        yield node_id, future.result()
+                        continue
+                    results[node_id] = future.result()
+                    for parent_id in parents[node_id]:
+                        num_pending[parent_id] -= 1
+                        if not num_pending[parent_id]:
+                            submit(parent_id)
+
+
+def get_all_match_fsms(
+    match_tree, worker_pool=None, alphabet_classes=None, leaf_memo=None
+):
+    if worker_pool is None:
+        worker_pool = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+    fsm_graph = FSMGraph(alphabet_classes)
+    node_ids = {
+        match_type: fsm_graph.add_match_tree(match_tree, match_type)
+        for match_type in ("method", "path", "query")
+    }
+    results = dict(fsm_graph.run(worker_pool, leaf_memo))
+    return {match_type: results[node_id] for match_type, node_id in node_ids.items()}
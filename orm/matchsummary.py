@@ -0,0 +1,251 @@
+import os
+import string
+
+import orm.parser as parser
+
+
+def get_summary_top():
+    """
+    Returns a match summary which does not constrain anything.
+
+    A match summary is a conservative description of the set of strings
+    a match tree accepts for one match source:
+      empty:       True if provably no string is accepted
+      prefix:      literal prefix of all accepted strings
+      suffix:      literal suffix of all accepted strings
+      first_chars: first characters of all non-empty accepted strings,
+                   None if unknown
+      values:      finite set of all accepted strings, None if unknown
+      min_len:     minimum length of accepted strings
+      max_len:     maximum length of accepted strings, None if unbounded
+    """
+    return {
+        "empty": False,
+        "prefix": "",
+        "suffix": "",
+        "first_chars": None,
+        "values": None,
+        "min_len": 0,
+        "max_len": None,
+    }
+
+
+def get_summary_empty():
+    summary = get_summary_top()
+    summary["empty"] = True
+    return summary
+
+
+def meet_prefix(one, two):
+    """ Returns the longer of two literal prefixes, None if they differ """
+    if one.startswith(two):
+        return one
+    if two.startswith(one):
+        return two
+    return None
+
+
+def meet_suffix(one, two):
+    """ Returns the longer of two literal suffixes, None if they differ """
+    if one.endswith(two):
+        return one
+    if two.endswith(one):
+        return two
+    return None
+
+
+def meet_set(one, two):
+    """ Returns the intersection of two sets, where None is unknown """
+    if one is None:
+        return two
+    if two is None:
+        return one
+    return one & two
+
+
+def meet_max_len(one, two):
+    """ Returns the smaller of two maximum lengths, where None is unbounded """
+    max_lens = [l for l in (one, two) if l is not None]
+    return min(max_lens) if max_lens else None
+
+
+def is_summary_contradictory(summary):
+    """ Returns True if no string can fit all fields of a summary """
+    if summary["prefix"] is None or summary["suffix"] is None:
+        return True
+    if summary["values"] is not None and not summary["values"]:
+        return True
+    if summary["max_len"] is not None and summary["min_len"] > summary["max_len"]:
+        return True
+    return (
+        summary["first_chars"] is not None
+        and not summary["first_chars"]
+        and summary["min_len"] > 0
+    )
+
+
+def summary_meet(one, two):
+    """ Returns a summary of the intersection of two summaries """
+    if one["empty"] or two["empty"]:
+        return get_summary_empty()
+    summary = {
+        "empty": False,
+        "prefix": meet_prefix(one["prefix"], two["prefix"]),
+        "suffix": meet_suffix(one["suffix"], two["suffix"]),
+        "first_chars": meet_set(one["first_chars"], two["first_chars"]),
+        "values": meet_set(one["values"], two["values"]),
+        "min_len": max(one["min_len"], two["min_len"]),
+        "max_len": meet_max_len(one["max_len"], two["max_len"]),
+    }
+    if is_summary_contradictory(summary):
+        return get_summary_empty()
+    return summary
+
+
+def summary_join(one, two):
+    """ Returns a summary of the union of two summaries """
+    if one["empty"]:
+        return two
+    if two["empty"]:
+        return one
+    summary = get_summary_top()
+    summary["prefix"] = os.path.commonprefix([one["prefix"], two["prefix"]])
+    summary["suffix"] = os.path.commonprefix(
+        [one["suffix"][::-1], two["suffix"][::-1]]
+    )[::-1]
+    for key in ("first_chars", "values"):
+        if one[key] is not None and two[key] is not None:
+            summary[key] = one[key] | two[key]
+    summary["min_len"] = min(one["min_len"], two["min_len"])
+    if one["max_len"] is not None and two["max_len"] is not None:
+        summary["max_len"] = max(one["max_len"], two["max_len"])
+    return summary
+
+
+def get_leaf_summary(fun, inp):
+    summary = get_summary_top()
+    value = inp["value"]
+    if fun in ("regex", "contains"):
+        if fun == "contains":
+            summary["min_len"] = len(value)
+        return summary
+    summary["min_len"] = len(value)
+    if fun == "exact":
+        summary["max_len"] = len(value)
+    if inp.get("ignore_case", False):
+        # Only the first character survives case folding as a literal
+        if fun in ("exact", "begins_with") and value and value[0] in string.printable:
+            summary["first_chars"] = frozenset((value[0].lower(), value[0].upper()))
+        return summary
+    if fun in ("exact", "begins_with"):
+        summary["prefix"] = value
+        if value:
+            summary["first_chars"] = frozenset(value[0])
+    if fun in ("exact", "ends_with"):
+        summary["suffix"] = value
+    if fun == "exact":
+        summary["values"] = frozenset([value])
+        if not value:
+            summary["first_chars"] = frozenset()
+    return summary
+
+
+def get_match_summary(match_tree, match_type):
+    """
+    Returns a conservative summary of the strings accepted by the
+    match_tree for the given match_type. Matches on other sources are
+    handled in the same way as when the FSM is generated.
+    """
+
+    def handle_condition_list(data_list_in, op, negate):
+        if op == "or" and any(data is None for data in data_list_in):
+            return None
+        summaries = [data for data in data_list_in if data is not None]
+        if not summaries:
+            return None
+        if negate:
+            return get_summary_top()
+        combine = summary_meet if op == "and" else summary_join
+        summary = summaries[0]
+        for other in summaries[1:]:
+            summary = combine(summary, other)
+        return summary
+
+    def handle_match(src, fun, inp, negate):
+        if src != match_type:
+            return None
+        if negate:
+            return get_summary_top()
+        summaries = [
+            get_leaf_summary(fun, single_inp)
+            for single_inp in parser.iter_match_inputs(inp)
+        ]
+        summary = summaries[0]
+        for other in summaries[1:]:
+            summary = summary_join(summary, other)
+        return summary
+
+    func = {
+        "handle_condition_list": handle_condition_list,
+        "handle_match": handle_match,
+    }
+    summary = parser.traverse_match_tree(func, match_tree)
+    if summary is None:
+        return get_summary_top()
+    return summary
+
+
+def get_all_match_summaries(match_tree):
+    summaries = {}
+    for match_type in ("method", "path", "query"):
+        summaries[match_type] = get_match_summary(match_tree, match_type)
+    return summaries
+
+
+def summaries_disjoint(one, two):
+    """
+    Returns the name of the prefilter proving that no string is accepted
+    by both summaries, or None if the prefilters can not tell.
+    """
+    # pylint:disable=too-many-return-statements
+    if one["empty"] or two["empty"]:
+        return "empty"
+    if one["values"] is not None and two["values"] is not None:
+        if one["values"].isdisjoint(two["values"]):
+            return "finite_set"
+    if not (
+        one["prefix"].startswith(two["prefix"])
+        or two["prefix"].startswith(one["prefix"])
+    ):
+        return "prefix"
+    if not (
+        one["suffix"].endswith(two["suffix"]) or two["suffix"].endswith(one["suffix"])
+    ):
+        return "suffix"
+    if one["first_chars"] is not None and two["first_chars"] is not None:
+        if one["first_chars"].isdisjoint(two["first_chars"]) and (
+            one["min_len"] > 0 or two["min_len"] > 0
+        ):
+            return "first_char"
+    if one["max_len"] is not None and one["max_len"] < two["min_len"]:
+        return "length"
+    if two["max_len"] is not None and two["max_len"] < one["min_len"]:
+        return "length"
+    return None
+
+
+prefilter_names = ("empty", "finite_set", "prefix", "suffix", "first_char", "length")
+
+
+def prefilter_disjoint(one, two):
+    """
+    Returns the name of the prefilter proving that two FSM entries can not
+    collide, or None if the full FSM intersection has to be checked.
+    """
+    for match_type in ("method", "query", "path"):
+        prefilter = summaries_disjoint(
+            one["summaries"][match_type], two["summaries"][match_type]
+        )
+        if prefilter:
+            return prefilter
+    return None
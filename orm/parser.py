@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
 import os
+import sys
 import glob
 import re
 import copy
+import collections
+import collections.abc
+import itertools
+import json
+import hashlib
+import concurrent.futures
 
 import yaml
 
@@ -22,15 +29,68 @@ def list_rules_files(rulesglob, recursive=True):
     return sorted(list(file_glob))
 
 
+def get_rules_root(rulesglob):
+    """ Returns the directory of a rules glob, up to its first wildcard """
+    return os.path.dirname(re.split(r"[*?[]", rulesglob, maxsplit=1)[0]) or os.curdir
+
+
+# Use the libyaml based loader when PyYAML is built with it
+yaml_loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
 def parse_yaml_file(path):
     """ Returns an list of objects containing all YAML docs in the
         file at given path """
     stream = open(path, "r")
-    yml_docs = list(yaml.safe_load_all(stream))
+    yml_docs = list(yaml.load_all(stream, Loader=yaml_loader))
     stream.close()
     return yml_docs
 
 
+# Below this number of files, starting worker processes costs more than
+# it saves.
+parallel_parse_min_files = 16
+
+# Files parsed in parallel are parsed at most this many per worker ahead
+# of the consumer.
+parse_prefetch_per_worker = 4
+
+
+def iter_yaml_files(paths, max_workers=None):
+    """
+    Yields (path, yml_docs) for each file in paths, in the order of
+    paths. Larger sets of files are parsed in parallel by max_workers
+    processes (by default one per CPU), at most
+    parse_prefetch_per_worker * max_workers files ahead of the consumer.
+    Up to that many parsed files are held until they are consumed.
+    """
+    if len(paths) < parallel_parse_min_files:
+        for path in paths:
+            yield path, parse_yaml_file(path)
+        return
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    remaining_paths = iter(paths)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+        pending = collections.deque(
+            (path, pool.submit(parse_yaml_file, path))
+            for path in itertools.islice(
+                remaining_paths, parse_prefetch_per_worker * max_workers
+            )
+        )
+        while pending:
+            path, future = pending.popleft()
+            for next_path in itertools.islice(remaining_paths, 1):
+                pending.append((next_path, pool.submit(parse_yaml_file, next_path)))
+            yield path, future.result()
+
+
+def parse_yaml_files(paths, max_workers=None):
+    """ Returns a list with the YAML docs of each file in paths, in the
+        same order as paths. Larger sets of files are parsed in parallel. """
+    return [yml_docs for _, yml_docs in iter_yaml_files(paths, max_workers)]
+
+
 scheme_delim = r"://"
 port_delim = r":"
 
@@ -140,6 +200,138 @@ def minify_match_tree(match_tree):
     return mini_tree
 
 
+def iter_match_inputs(inp):
+    """
+    Yields the single value inputs of a match input. The input of a match
+    merged by canonicalize_match_tree holds a list of "values" instead of a
+    single "value".
+    """
+    if not isinstance(inp, dict) or "values" not in inp:
+        yield inp
+        return
+    for value in inp["values"]:
+        single_inp = {key: val for key, val in inp.items() if key != "values"}
+        single_inp["value"] = value
+        yield single_inp
+
+
+def merge_match_values(function, values):
+    """
+    Returns the sorted unique values, leaving out values which can not
+    match anything not already matched by another value.
+    """
+    values = sorted(set(values))
+    if function == "begins_with":
+        merged = []
+        for value in values:
+            # Sorted values come right after their shortest prefix
+            if not merged or not value.startswith(merged[-1]):
+                merged.append(value)
+        return merged
+    if function == "ends_with":
+        return [
+            value
+            for value in values
+            if not any(other != value and value.endswith(other) for other in values)
+        ]
+    if function == "contains":
+        return [
+            value
+            for value in values
+            if not any(other != value and other in value for other in values)
+        ]
+    return values
+
+
+def merge_match_leaves(match_trees, operator):
+    """
+    Merges the matches on the same source with the same function and
+    options among match_trees into one match with several values. Under
+    'or' the matches are merged, and under 'and' the negated matches are
+    merged into the negation of one match (not a and not b is not (a or b)).
+    """
+    merged = {}
+    other_trees = []
+    for match_tree in match_trees:
+        if operator == "and" and "not" in match_tree:
+            leaf = match_tree["not"]
+        elif operator == "or" and "match" in match_tree:
+            leaf = match_tree
+        else:
+            leaf = None
+        if (
+            leaf is None
+            or "match" not in leaf
+            or not isinstance(leaf["match"]["input"], dict)
+        ):
+            other_trees.append(match_tree)
+            continue
+        match = leaf["match"]
+        key = (
+            match["source"],
+            match["function"],
+            has_ignore_case(match["input"]),
+        )
+        values = merged.setdefault(key, [])
+        values += [inp["value"] for inp in iter_match_inputs(match["input"])]
+    for (src, func, ignore_case), values in merged.items():
+        values = merge_match_values(func, values)
+        inp = {"value": values[0]} if len(values) == 1 else {"values": values}
+        if ignore_case:
+            inp["ignore_case"] = ignore_case
+        leaf = create_match_tree_expr(src, func, inp)
+        other_trees.append({"not": leaf} if operator == "and" else leaf)
+    return other_trees
+
+
+def get_match_tree_sort_key(match_tree):
+    return json.dumps(match_tree, sort_keys=True)
+
+
+def canonicalize_match_tree(match_tree, negate=False):
+    """
+    Returns the canonical form of match_tree. Equivalent match trees
+    written in different ways get equal canonical forms, so they get equal
+    cache keys and render equal conditions.
+
+    Negations are pushed down to the matches, nested condition lists of
+    the same operator are flattened, matches on the same source with the
+    same function and options are merged into one match with several
+    "values", and the branches of every condition list are deduplicated
+    and sorted. Condition lists with a single branch are replaced by it.
+    """
+    if "not" in match_tree:
+        return canonicalize_match_tree(match_tree["not"], negate=not negate)
+    if "match" in match_tree:
+        return {"not": match_tree} if negate else match_tree
+    if "and" in match_tree:
+        op = "and"
+    elif "or" in match_tree:
+        op = "or"
+    else:
+        raise ORMInternalParserException(
+            "ERROR: unhandled condition operator: " + str(list(match_tree.keys()))
+        )
+    branches = match_tree[op]
+    if negate:
+        op = "or" if op == "and" else "and"
+    canonical_trees = []
+    for branch in branches:
+        canonical_tree = canonicalize_match_tree(branch, negate=negate)
+        if op in canonical_tree:
+            canonical_trees += canonical_tree[op]
+        else:
+            canonical_trees.append(canonical_tree)
+    canonical_trees = merge_match_leaves(canonical_trees, op)
+    unique_trees = {}
+    for canonical_tree in canonical_trees:
+        unique_trees.setdefault(get_match_tree_sort_key(canonical_tree), canonical_tree)
+    canonical_trees = [tree for _, tree in sorted(unique_trees.items())]
+    if len(canonical_trees) == 1:
+        return canonical_trees[0]
+    return {op: canonical_trees}
+
+
 def create_match_tree(matches, domains=None):
     expr_list = []
     if domains:
@@ -153,7 +345,7 @@ def create_match_tree(matches, domains=None):
 
 
 def get_match_tree(matches, domains=None):
-    return minify_match_tree(create_match_tree(matches, domains=domains))
+    return canonicalize_match_tree(create_match_tree(matches, domains=domains))
 
 
 def default_handle_condition_list(data_list_in, op, negate):
@@ -170,7 +362,8 @@ def traverse_match(func, match, negate=False):
     src = match["source"]
     fun = match["function"]
     inp = match["input"]
-    return func["handle_match"](src, fun, inp, negate)
+    handle_match = func.get("handle_match", default_handle_match)
+    return handle_match(src, fun, inp, negate)
 
 
 def traverse_condition_list(func, match_tree_list, operator, negate=False):
@@ -178,12 +371,16 @@ def traverse_condition_list(func, match_tree_list, operator, negate=False):
     for match_tree in match_tree_list:
         data_in = traverse_match_tree(func, match_tree)
         data_list_in.append(data_in)
-    return func["handle_condition_list"](data_list_in, operator, negate)
+    handle_condition_list = func.get(
+        "handle_condition_list", default_handle_condition_list
+    )
+    return handle_condition_list(data_list_in, operator, negate)
 
 
 def traverse_match_tree(func, match_tree, negate=False):
     """
-    Performs a depth first traversal of a match_tree.
+    Performs a depth first traversal of a match_tree, given either as
+    dicts or as a compiled match tree (see compile_match_tree).
     Supply the following functions to be invoked during traversal:
 
     handle_condition_list(data_list_in, op, negate)
@@ -198,10 +395,12 @@ def traverse_match_tree(func, match_tree, negate=False):
       negate:  boolean
     """
 
-    if not "handle_condition_list" in func:
-        func["handle_condition_list"] = default_handle_condition_list
-    if not "handle_match" in func:
-        func["handle_match"] = default_handle_match
+    if isinstance(match_tree, (MatchNode, MatchLeaf)):
+        return match_tree.traverse(
+            func.get("handle_condition_list", default_handle_condition_list),
+            func.get("handle_match", default_handle_match),
+            negate=negate,
+        )
     if "and" in match_tree:
         data_out = traverse_condition_list(
             func, match_tree["and"], "and", negate=negate
@@ -219,6 +418,210 @@ def traverse_match_tree(func, match_tree, negate=False):
     return data_out
 
 
+class MatchLeaf:
+    """
+    A single (possibly negated) match of a compiled match tree. Immutable.
+    The input of a merged match holds several "values", see
+    iter_match_inputs.
+    """
+
+    __slots__ = ("source", "function", "input", "negate")
+
+    def __init__(self, source, function, inp, negate=False):
+        self.source = sys.intern(source)
+        self.function = sys.intern(function)
+        self.input = inp
+        self.negate = negate
+
+    @property
+    def match(self):
+        return {"source": self.source, "function": self.function, "input": self.input}
+
+    def traverse(self, handle_condition_list, handle_match, negate=False):
+        # pylint:disable=unused-argument
+        return handle_match(
+            self.source, self.function, self.input, self.negate != negate
+        )
+
+    def to_dict(self):
+        match_tree = {"match": self.match}
+        return {"not": match_tree} if self.negate else match_tree
+
+    def __setattr__(self, name, value):
+        if hasattr(self, name):
+            raise AttributeError("MatchLeaf is immutable")
+        super().__setattr__(name, value)
+
+    def __eq__(self, other):
+        if not isinstance(other, MatchLeaf):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __hash__(self):
+        return hash(get_match_tree_sort_key(self.to_dict()))
+
+
+class MatchNode:
+    """
+    An 'and' or 'or' condition list of a compiled match tree. Immutable.
+    Negations are always pushed down to the leaves.
+    """
+
+    __slots__ = ("operator", "children")
+
+    def __init__(self, operator, children):
+        self.operator = sys.intern(operator)
+        self.children = tuple(children)
+
+    def traverse(self, handle_condition_list, handle_match, negate=False):
+        """
+        Calls handle_condition_list and handle_match as traverse_match_tree,
+        but walks the slots of the compiled tree instead of dicts.
+        """
+        data_list_in = [
+            child.traverse(handle_condition_list, handle_match)
+            for child in self.children
+        ]
+        return handle_condition_list(data_list_in, self.operator, negate)
+
+    def to_dict(self):
+        return {self.operator: [child.to_dict() for child in self.children]}
+
+    def __setattr__(self, name, value):
+        if hasattr(self, name):
+            raise AttributeError("MatchNode is immutable")
+        super().__setattr__(name, value)
+
+    def __eq__(self, other):
+        if not isinstance(other, MatchNode):
+            return NotImplemented
+        return self.operator == other.operator and self.children == other.children
+
+    def __hash__(self):
+        return hash((self.operator, self.children))
+
+
+def compile_match_tree(match_tree):
+    """
+    Returns the compiled form (MatchNode and MatchLeaf objects) of the
+    canonical form of match_tree.
+    """
+
+    def compile_canonical(canonical_tree):
+        if "match" in canonical_tree:
+            match = canonical_tree["match"]
+            return MatchLeaf(match["source"], match["function"], match["input"])
+        if "not" in canonical_tree:
+            match = canonical_tree["not"]["match"]
+            return MatchLeaf(
+                match["source"], match["function"], match["input"], negate=True
+            )
+        op = "and" if "and" in canonical_tree else "or"
+        return MatchNode(
+            op, [compile_canonical(branch) for branch in canonical_tree[op]]
+        )
+
+    return compile_canonical(canonicalize_match_tree(match_tree))
+
+
+def get_rule_match_tree(rule):
+    """
+    Returns the compiled match tree of a rule, given as a DomainRule or as
+    a rule dict.
+    """
+    if isinstance(rule, DomainRule):
+        return rule.rule.match_tree
+    return compile_match_tree(create_match_tree(rule["matches"]))
+
+
+class Rule:
+    """
+    A rule of a rule file. Immutable, and shared by every domain the rule
+    is listed for.
+
+    fields holds the keys of the rule as written in the rule file (with
+    global defaults applied to the actions). The rule file documents are
+    never modified. The compiled match tree is built on first use.
+    """
+
+    __slots__ = (
+        "description",
+        "domains",
+        "domain_default",
+        "source_file",
+        "fields",
+        "compiled_match_tree",
+    )
+
+    def __init__(self, fields, source_file, defaults=None):
+        if defaults:
+            fields = dict(fields)
+            set_rule_defaults(fields, defaults)
+        set_attr = super().__setattr__
+        set_attr("description", sys.intern(fields["description"]))
+        set_attr(
+            "domains", tuple(sys.intern(domain) for domain in fields.get("domains", []))
+        )
+        set_attr("domain_default", fields.get("domain_default", False))
+        set_attr("source_file", sys.intern(source_file))
+        set_attr("fields", fields)
+        set_attr("compiled_match_tree", None)
+
+    @property
+    def matches(self):
+        return self.fields.get("matches")
+
+    @property
+    def actions(self):
+        return self.fields.get("actions")
+
+    @property
+    def match_tree(self):
+        """ The compiled match tree, or None for domain_default rules """
+        if self.compiled_match_tree is None and self.matches is not None:
+            super().__setattr__(
+                "compiled_match_tree",
+                compile_match_tree(create_match_tree(self.matches)),
+            )
+        return self.compiled_match_tree
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Rule is immutable")
+
+
+class DomainRule(collections.abc.Mapping):
+    """
+    A rule listed for one domain, with the rule id it got there.
+
+    Also a read-only dict view of the rule with the '_rule_id' and
+    '_orm_source_file' keys added, for code working on rule dicts.
+    """
+
+    __slots__ = ("rule", "rule_id")
+
+    def __init__(self, rule, rule_id):
+        self.rule = rule
+        self.rule_id = rule_id
+
+    def __getitem__(self, key):
+        if key == "_rule_id":
+            return self.rule_id
+        if key == "_orm_source_file":
+            return self.rule.source_file
+        return self.rule.fields[key]
+
+    def __iter__(self):
+        yield from self.rule.fields
+        yield "_rule_id"
+        yield "_orm_source_file"
+
+    def __len__(self):
+        return len(self.rule.fields) + 2
+
+    def __repr__(self):
+        return "DomainRule({!r}, {!r})".format(self.rule.description, self.rule_id)
+
+
 def parse_document(doc):
     """
     Returns dict with 'rules' and 'tests' from a single yaml document,
@@ -236,8 +639,6 @@ def parse_document(doc):
 def parse_document_v2(doc):
     """ The document parser for schema version 2 """
 
-    if doc.get("schema_version"):
-        del doc["schema_version"]
     parsed_doc = {"rules": {}, "tests": doc.get("tests", [])}
     for rule in doc.get("rules"):
         for domain in rule.get("domains", []):
@@ -263,8 +664,34 @@ def get_unique_id(name_counter, raw_name):
     return name
 
 
+def get_rule_path(source_file, rules_root=None):
+    """
+    Returns the path of a rule file relative to the rules root (by default
+    the working directory), with forward slashes. It is the same however
+    the rule files were listed on the command line.
+    """
+    rule_path = os.path.relpath(source_file, rules_root or os.curdir)
+    return rule_path.replace(os.sep, "/")
+
+
+def get_rule_id(source_file, domain, description, rules_root=None):
+    """
+    Returns the id of a rule listed for domain, made from its description
+    and a short hash of its source file path (relative to rules_root, see
+    get_rule_path), domain and description. The id only depends on the
+    rule itself, so adding, removing or reordering other rules never
+    changes it. HAProxy backend names (and the server state HAProxy keeps
+    for them across reloads) stay the same for unchanged rules.
+    """
+    rule_path = get_rule_path(source_file, rules_root)
+    identity = "\n".join((rule_path, domain, description))
+    digest = hashlib.sha256(identity.encode("utf-8")).hexdigest()[:8]
+    return normalize_lower(description) + "_" + digest
+
+
 def set_rule_defaults(rule, defaults):
-    rule.setdefault("actions", {})
+    # The actions may be shared with the rule file document
+    rule["actions"] = dict(rule.get("actions", {}))
     if defaults.get("https_redirection", False):
         if "redirect" not in rule["actions"]:
             rule["actions"]["https_redirection"] = rule["actions"].get(
@@ -272,32 +699,80 @@ def set_rule_defaults(rule, defaults):
             )
 
 
-def parse_rules(yml_files, defaults=None):
+def iter_file_rules(yml_file, yml_docs, defaults=None, rules_root=None):
+    """
+    Yields (domain, rule) for the rules of the parsed documents of one
+    rule file, where rule is a DomainRule with its rule id and global
+    defaults applied. A rule listed for several domains is yielded once
+    per domain, sharing one Rule.
+    """
+    name_counter = {}
+    for doc in yml_docs:
+        parsed_doc = parse_document(doc)
+        rules = {}
+        for domain, domain_rules in sorted(parsed_doc["rules"].items()):
+            for rule_fields in domain_rules:
+                if id(rule_fields) not in rules:
+                    rules[id(rule_fields)] = Rule(
+                        rule_fields, yml_file, defaults=defaults
+                    )
+                rule = rules[id(rule_fields)]
+                # Only identical rules (same file, domain and description)
+                # need the counter to tell them apart
+                rule_id = get_unique_id(
+                    name_counter,
+                    get_rule_id(yml_file, domain, rule.description, rules_root),
+                )
+                yield domain, DomainRule(rule, rule_id)
+
+
+def iter_rules(file_docs, defaults=None, rules_root=None):
+    """
+    Yields (domain, rule) for the rules of an iterable of (yml_file,
+    yml_docs) tuples, file by file, as iter_file_rules. Given
+    iter_yaml_files, files are parsed at most
+    parse_prefetch_per_worker * max_workers files ahead of the rules
+    consumed. LoadedRuleset still reads every file before rendering, since
+    the schema validation and the renderers need all the documents.
+    """
+    for yml_file, yml_docs in file_docs:
+        yield from iter_file_rules(
+            yml_file, yml_docs, defaults=defaults, rules_root=rules_root
+        )
+
+
+def parse_rules(yml_files, defaults=None, rules_root=None):
     """
     Returns dict with 'rules' and 'tests' merged from a list of yaml files,
     where 'rules' is a domain keyed dict containing lists of ORM rules.
     """
-    name_counter = {}
+    return merge_documents(
+        iter_yaml_files(yml_files), defaults=defaults, rules_root=rules_root
+    )
+
+
+def merge_documents(file_docs, defaults=None, rules_root=None):
+    """
+    Returns dict with 'rules' and 'tests' merged from an iterable of
+    (yml_file, yml_docs) tuples. Each rule is a DomainRule, and rules
+    listed for several domains share one Rule. Tests are deep copied. The
+    documents are left untouched.
+    """
     merged_documents = {"rules": {}, "tests": []}
-    for yml_file in yml_files:
-        yml_docs = parse_yaml_file(yml_file)
-        for doc in yml_docs:
-            parsed_doc = parse_document(doc)
-            for domain, rules in sorted(parsed_doc["rules"].items()):
-                merged_documents["rules"].setdefault(domain, [])
-                for rule in rules:
-                    rule_copy = copy.deepcopy(rule)
-                    rule_copy["_rule_id"] = get_unique_id(
-                        name_counter, rule["description"]
-                    )
-                    rule_copy["_orm_source_file"] = yml_file
-                    if defaults:
-                        set_rule_defaults(rule_copy, defaults)
-                    merged_documents["rules"][domain].append(rule_copy)
-            for test in parsed_doc["tests"]:
-                test_copy = copy.deepcopy(test)
-                test_copy["_orm_source_file"] = yml_file
-                merged_documents["tests"].append(test_copy)
+
+    def collect_tests(file_docs):
+        for yml_file, yml_docs in file_docs:
+            for doc in yml_docs:
+                for test in parse_document(doc)["tests"]:
+                    test_copy = copy.deepcopy(test)
+                    test_copy["_orm_source_file"] = yml_file
+                    merged_documents["tests"].append(test_copy)
+            yield yml_file, yml_docs
+
+    for domain, rule in iter_rules(
+        collect_tests(file_docs), defaults=defaults, rules_root=rules_root
+    ):
+        merged_documents["rules"].setdefault(domain, []).append(rule)
     return merged_documents
 
 
@@ -307,3 +782,64 @@ def parse_globals(yml_file):
         raise ORMParserException("There must be exactly one globals document")
     doc = globals_docs[0]
     return doc
+
+
+class LoadedRuleset:
+    """
+    The rule files (and globals file) of one ORM run, each read and parsed
+    at most once. Create it once and pass it to validation and rendering.
+
+    Rule files are parsed on first use, so steps which only need some of
+    the files (like incremental validation) do not parse the others.
+    documents holds the parsed YAML documents per file, in the order of
+    yml_files. They are never modified. Merged rules are built from them
+    on first use and then reused.
+    """
+
+    def __init__(self, yml_files, globals_file=None, rules_root=None):
+        self.yml_files = yml_files
+        self.rules_root = rules_root
+        self.loaded_documents = {}
+        self.file_hashes = {}
+        self.globals_file = globals_file
+        self.globals_doc = parse_globals(globals_file) if globals_file else None
+        self.merged = {}
+
+    def get_documents(self, yml_files):
+        """ Returns the parsed YAML documents of some of the files """
+        unloaded_files = [
+            yml_file for yml_file in yml_files if yml_file not in self.loaded_documents
+        ]
+        self.loaded_documents.update(
+            zip(unloaded_files, parse_yaml_files(unloaded_files))
+        )
+        return {yml_file: self.loaded_documents[yml_file] for yml_file in yml_files}
+
+    @property
+    def documents(self):
+        return self.get_documents(self.yml_files)
+
+    def get_file_hash(self, yml_file):
+        """ Returns a hash of the content of a rule file """
+        if yml_file not in self.file_hashes:
+            with open(yml_file, "rb") as content:
+                self.file_hashes[yml_file] = hashlib.sha256(content.read()).hexdigest()
+        return self.file_hashes[yml_file]
+
+    def get_defaults(self):
+        if not self.globals_doc:
+            return None
+        return self.globals_doc.get("defaults", None)
+
+    def get_merged_documents(self, with_defaults=False):
+        """
+        Returns dict with 'rules' and 'tests' as parse_rules. Global rule
+        defaults are applied if with_defaults is set.
+        """
+        if with_defaults not in self.merged:
+            self.merged[with_defaults] = merge_documents(
+                self.documents.items(),
+                defaults=self.get_defaults() if with_defaults else None,
+                rules_root=self.rules_root,
+            )
+        return self.merged[with_defaults]
@@ -9,11 +9,16 @@ class ORMInternalRenderException(Exception):
 
 
 class RenderOutput:
-    def __init__(self, rule_docs, output_file, globals_doc=None):
+    def __init__(self, rule_docs, output_file, globals_doc=None, profile=None):
         self.rule_docs = rule_docs
         if not globals_doc:
             globals_doc = {}
         self.globals_doc = globals_doc
+        # Hit counts of domains and rule ids, for ordering the hottest first
+        if not profile:
+            profile = {}
+        self.domain_hits = profile.get("domains", {})
+        self.rule_hits = profile.get("rules", {})
         self.output_file = output_file
         self.config = ""
         self.jinja = Environment(
@@ -1,5 +1,6 @@
 from orm.render import RenderOutput, ORMInternalRenderException
 import orm.parser as parser
+import orm.logprofile as logprofile
 
 
 def make_custom_internal_healthcheck(healthcheck_config):
@@ -82,15 +83,21 @@ class RenderHAProxy(RenderOutput):
             conf = action_config["backend"]
             self.make_backend_action(conf, rule_id)
 
-    def __init__(self, rule_docs, globals_doc=None):
+    def __init__(self, rule_docs, globals_doc=None, profile=None):
         super().__init__(
-            rule_docs=rule_docs, globals_doc=globals_doc, output_file="haproxy.cfg"
+            rule_docs=rule_docs,
+            globals_doc=globals_doc,
+            output_file="haproxy.cfg",
+            profile=profile,
         )
         self.backend_acls = []
         self.backends = []
-        for rules in rule_docs.values():
-            for rule in rules:
-                self.make_actions(rule["actions"], rule["_rule_id"])
+        # The use_backend rules are evaluated in order, hottest first
+        all_rules = [rule for rules in rule_docs.values() for rule in rules]
+        for rule in logprofile.sort_by_hits(
+            all_rules, self.rule_hits, key=lambda rule: rule["_rule_id"]
+        ):
+            self.make_actions(rule["actions"], rule["_rule_id"])
 
         crypto = self.globals_doc.get("crypto", {})
         certs = crypto.get("certificates", [])
@@ -2,6 +2,9 @@ import re
 
 from orm.render import RenderOutput, ORMInternalRenderException
 import orm.parser as parser
+import orm.matchsummary as matchsummary
+import orm.dispatchtree as dispatchtree
+import orm.logprofile as logprofile
 
 
 def vcl_escape_string_to_regex(string):
@@ -63,10 +66,143 @@ def make_vcl_value_regex(value_type, value, match_function, ignore_case):
     return vcl_regex_add_opts(regex, ignore_case)
 
 
+vcl_value_regex_formats = {
+    "exact": "^{}$",
+    "begins_with": "^{}.*$",
+    "ends_with": "^.*{}$",
+    "contains": "^.*{}.*$",
+}
+
+
+def make_vcl_input_regex(value_type, match_function, inp):
+    """
+    Returns the regex for a match input. The values of a merged match are
+    combined into one alternation.
+    """
+    ignore_case = inp.get("ignore_case", False)
+    values = [single_inp["value"] for single_inp in parser.iter_match_inputs(inp)]
+    if len(values) == 1:
+        return make_vcl_value_regex(value_type, values[0], match_function, ignore_case)
+    if match_function != "regex" and match_function not in vcl_value_regex_formats:
+        raise ORMInternalRenderException(
+            "ERROR: unhandled " + value_type + " match "
+            "function: " + match_function + ":" + str(values)
+        )
+    if match_function == "regex":
+        # Each regex keeps its own anchors, exactly as if rendered alone
+        regex = "|".join("(?:^{}$)".format(vcl_escape_regex(value)) for value in values)
+    else:
+        alternatives = [vcl_escape_string_to_regex(value) for value in values]
+        regex = vcl_value_regex_formats[match_function].format(
+            "(?:" + "|".join(alternatives) + ")"
+        )
+    return vcl_regex_add_opts(regex, ignore_case)
+
+
+# Merged matches with more values than this keep one regex alternation
+# instead of a string comparison per value
+MAX_STRING_COMPARISON_VALUES = 4
+
+
+def make_vcl_string_comparison(
+    subject, match_function, inp, sentinel=None, max_values=MAX_STRING_COMPARISON_VALUES
+):
+    """
+    Returns a VCL condition comparing the string subject with the values of
+    a match input without regexes, or None if the match needs a regex.
+    Matches with more than max_values values (unless it is None) need a
+    regex.
+
+    Prefixes are checked with std.strstr on the subject behind a "#", so
+    the first occurrence is at the start exactly when the prefix matches.
+    Suffixes can only be checked if sentinel is a character which never
+    occurs in subject: the suffix followed by it can then only occur at
+    the end.
+    """
+    if inp.get("ignore_case", False):
+        return None
+    values = [single_inp["value"] for single_inp in parser.iter_match_inputs(inp)]
+    if max_values is not None and len(values) > max_values:
+        return None
+    comparisons = []
+    for value in values:
+        if match_function == "exact":
+            comparisons.append(subject + " == " + vcl_safe_string(value))
+        elif match_function == "begins_with":
+            comparisons.append(
+                'std.strstr("#" + {subject}, {prefix}) == ("#" + {subject})'.format(
+                    subject=subject, prefix=vcl_safe_string("#" + value)
+                )
+            )
+        elif match_function == "ends_with" and sentinel:
+            suffix = vcl_safe_string(value + sentinel)
+            comparisons.append(
+                "std.strstr({subject} + {sentinel}, {suffix}) == {suffix}".format(
+                    subject=subject, sentinel=vcl_safe_string(sentinel), suffix=suffix
+                )
+            )
+        else:
+            return None
+    if len(comparisons) == 1:
+        return comparisons[0]
+    return "(" + " || ".join(comparisons) + ")"
+
+
 def indent(indent_depth):
     return "  " * indent_depth
 
 
+def make_vcl_char_class(chars):
+    """ Returns a regex character class of chars, with runs as ranges """
+    escaped = []
+    codes = sorted({ord(char) for char in chars})
+    start = 0
+    while start < len(codes):
+        end = start
+        while end + 1 < len(codes) and codes[end + 1] == codes[end] + 1:
+            end += 1
+        run = [
+            re.sub(r"([\\\]\^-])", r"\\\1", chr(code))
+            for code in codes[start : end + 1]
+        ]
+        if len(run) > 2:
+            run = [run[0] + "-" + run[-1]]
+        escaped += run
+        start = end + 1
+    return "[" + "".join(escaped) + "]"
+
+
+def make_host_dispatch(tree, domain_subs, indent_depth=1):
+    """
+    Returns the VCL lines calling the sub of the requested host, given the
+    host dispatch tree and a dict of sub names keyed by domain.
+    """
+    lines = []
+    if isinstance(tree, list):
+        for index, domain in enumerate(tree):
+            lines.append(
+                indent(indent_depth)
+                + ("if" if index == 0 else "} elseif")
+                + " (req.http.host == "
+                + vcl_safe_string(domain)
+                + ") {"
+            )
+            lines.append(indent(indent_depth + 1) + "call " + domain_subs[domain] + ";")
+        if tree:
+            lines.append(indent(indent_depth) + "}")
+        return lines
+    position, chars, left, right = tree
+    regex = "^" + (".{%d}" % position if position else "") + make_vcl_char_class(chars)
+    lines.append(
+        indent(indent_depth) + "if (req.http.host ~ " + vcl_safe_string(regex) + ") {"
+    )
+    lines += make_host_dispatch(right, domain_subs, indent_depth + 1)
+    lines.append(indent(indent_depth) + "} else {")
+    lines += make_host_dispatch(left, domain_subs, indent_depth + 1)
+    lines.append(indent(indent_depth) + "}")
+    return lines
+
+
 def make_sb_header_action(config_in, config_out, rule_id, indent_depth=0):
     return make_header_action(
         config_in, config_out, rule_id, southbound=True, indent_depth=indent_depth
@@ -373,23 +509,35 @@ class RenderVarnish(RenderOutput):
         self.names[namespace][name] = 1
         return name
 
+    def make_match_string(self, subject, value_type, fun, inp, sentinel=None):
+        condition = make_vcl_string_comparison(subject, fun, inp, sentinel=sentinel)
+        if condition is not None:
+            self.match_counts["string"] += 1
+            return condition
+        self.match_counts["regex"] += 1
+        # Count the regexes only kept for having too many values
+        unlimited = make_vcl_string_comparison(
+            subject, fun, inp, sentinel=sentinel, max_values=None
+        )
+        if unlimited is not None:
+            self.match_counts["too_many_values"] += 1
+        vcl_regex = make_vcl_input_regex(value_type, fun, inp)
+        return subject + " ~ " + vcl_safe_string(vcl_regex)
+
     def make_match_path(self, fun, inp):
-        value = inp["value"]
-        ignore_case = inp.get("ignore_case", False)
-        vcl_regex = make_vcl_value_regex("path", value, fun, ignore_case)
-        return 'variable.get("path") ~ ' + vcl_safe_string(vcl_regex)
+        # The path is split from req.url at the first "?" or "#"
+        return self.make_match_string(
+            'variable.get("path")', "path", fun, inp, sentinel="#"
+        )
 
     def make_match_query(self, fun, inp):
-        value = inp["value"]
-        ignore_case = inp.get("ignore_case", False)
-        vcl_regex = make_vcl_value_regex("query", value, fun, ignore_case)
-        return 'variable.get("query") ~ ' + vcl_safe_string(vcl_regex)
+        # The query is split from req.url at the first "#"
+        return self.make_match_string(
+            'variable.get("query")', "query", fun, inp, sentinel="#"
+        )
 
     def make_match_method(self, fun, inp):
-        value = inp["value"]
-        ignore_case = inp.get("ignore_case", False)
-        vcl_regex = make_vcl_value_regex("method", value, fun, ignore_case)
-        return "req.method ~ " + vcl_safe_string(vcl_regex)
+        return self.make_match_string("req.method", "method", fun, inp)
 
     def make_match_domain(self, fun, inp):
         if fun == "exact":
@@ -432,6 +580,16 @@ class RenderVarnish(RenderOutput):
         return expr
 
     def parse_match_tree(self, match_tree, indent_depth=0, negate=False):
+        if isinstance(match_tree, parser.MatchNode):
+            return self.handle_condition_list(
+                "&&" if match_tree.operator == "and" else "||",
+                match_tree.children,
+                negate=negate,
+                indent_depth=indent_depth,
+            )
+        if isinstance(match_tree, parser.MatchLeaf):
+            opt_negate = "!" if match_tree.negate != negate else ""
+            return opt_negate + self.make_condition_match(match_tree.match)
         if "and" in match_tree:
             return self.handle_condition_list(
                 "&&", match_tree["and"], negate=negate, indent_depth=indent_depth
@@ -451,35 +609,48 @@ class RenderVarnish(RenderOutput):
             "ERROR: unhandled condition operator: " + str(match_tree.keys)
         )
 
-    def make_condition(self, match_tree, rule_id, indent_depth=0):
+    def make_condition(
+        self, match_tree, rule_id, indent_depth=0, keyword="if", comments=()
+    ):
+        """
+        Returns the opening lines of an if (or elseif) block which is
+        entered when match_tree matches, and sets the match variable of the
+        rule. The block is left open for the actions of the rule.
+        """
         condition = []
+        counts_before = dict(self.match_counts)
         expr = self.parse_match_tree(match_tree, indent_depth=indent_depth + 1)
-        if_clause = indent(indent_depth) + "if (" + expr + ")"
+        self.rule_match_counts[rule_id] = {
+            kind: count - counts_before[kind]
+            for kind, count in self.match_counts.items()
+        }
+        if_clause = indent(indent_depth) + keyword + " (" + expr + ")"
         condition += if_clause.split("\n")
-        condition.append(indent(indent_depth) + "{")
+        condition[-1] += " {"
+        for comment in comments:
+            condition.append(indent(indent_depth + 1) + "# " + comment)
         condition.append(
             indent(indent_depth + 1) + make_vcl_set_match_variable(rule_id)
         )
-        condition.append(indent(indent_depth) + "}")
         return condition
 
-    def make_match_sub(self, match_tree, rule_id, match_sub_name):
-        indent_depth = 0
-        sub = []
-        sub.append("sub " + match_sub_name + " {")
-        sub += self.make_condition(match_tree, rule_id, indent_depth=indent_depth + 1)
-        sub.append("}")
-        return sub
-
     def make_actions(
         self,
         action_config,
         rule_id,
+        *,
         domain=None,
-        match_sub_name=None,
+        match_tree=None,
         indent_depth=0,
         is_global=False,
+        comments=(),
     ):
+        """
+        Creates the southbound and northbound actions of a rule. Rules
+        without a match_tree are domain default rules. The southbound
+        actions of regular rules are kept with their match_tree, for
+        make_southbound_actions to put together.
+        """
         # pylint:disable=too-many-locals,too-many-arguments,too-many-branches
         # pylint:disable=too-many-statements
         if not domain and not is_global:
@@ -543,17 +714,20 @@ class RenderVarnish(RenderOutput):
                 sb.insert(
                     0, indent(indent_depth + 1) + "call global_actions_southbound;"
                 )
-                if match_sub_name:
-                    actions = []
-                    actions.append(
-                        (indent(indent_depth) + "call " + match_sub_name + ";")
-                    )
-                    actions += make_action_if_clause(
-                        sb, rule_id, indent_depth=indent_depth
-                    )
+                if match_tree is not None:
+                    # The rules of a domain are put together by
+                    # make_southbound_actions
                     self.actions_southbound.setdefault(domain, [])
-                    self.actions_southbound[domain] += actions
-                else:  # If there is no match_sub_name, it is a default rule
+                    self.actions_southbound[domain].append(
+                        {
+                            "rule_id": rule_id,
+                            "match_tree": match_tree,
+                            "comments": comments,
+                            "actions": sb,
+                            "indent_depth": indent_depth,
+                        }
+                    )
+                else:  # If there is no match_tree, it is a default rule
                     actions = []
                     # Set variable when default actions are reached in
                     # vcl_recv (southbound) so we know whether to perform
@@ -565,13 +739,13 @@ class RenderVarnish(RenderOutput):
                     self.default_actions_southbound.setdefault(domain, [])
                     self.default_actions_southbound[domain] += actions
             if nb:
-                if match_sub_name:
+                if match_tree is not None:
                     actions = make_action_if_clause(
                         nb, rule_id, indent_depth=indent_depth
                     )
                     self.actions_northbound.setdefault(domain, [])
                     self.actions_northbound[domain] += actions
-                else:  # If there is no match_sub_name, it is a default rule
+                else:  # If there is no match_tree, it is a default rule
                     # Only perform default northbound actions if variable is set
                     # (that is, only when the default southbound actions did)
                     actions = make_action_if_clause(
@@ -583,25 +757,90 @@ class RenderVarnish(RenderOutput):
         return config_out["sb"] or config_out["nb"] or config_out["synth"]
 
     def make_southbound_actions(self, domains):
-        config = []
+        """
+        Returns the subs with the southbound actions of each domain, and the
+        vcl_recv lines which dispatch a request to the sub of its host.
+        """
+        subs = []
+        domain_subs = self.southbound_subs
         for domain in domains:
             actions = self.actions_southbound[domain]
             default_actions = self.default_actions_southbound[domain]
             if not actions and not default_actions:
                 continue
-            config.append(
-                indent(1) + "if (req.http.host == " + vcl_safe_string(domain) + ") {"
-            )
-            for line in actions:
-                config.append(indent(1) + line)
+            domain_subs[domain] = self.get_unique_vcl_name("southbound", domain)
+            subs.append("")
+            subs.append("# ORM: Southbound actions for " + domain)
+            subs.append("sub " + domain_subs[domain] + " {")
+            if actions:
+                trie = dispatchtree.get_path_prefix_trie(
+                    [
+                        (
+                            matchsummary.get_match_summary(rule["match_tree"], "path")[
+                                "prefix"
+                            ],
+                            rule,
+                        )
+                        for rule in actions
+                    ]
+                )
+                self.rule_dispatch_costs[domain] = (
+                    dispatchtree.get_path_prefix_trie_cost(trie)
+                )
+                subs += self.make_rule_chain(trie)
             if default_actions:
-                config.append(
-                    indent(2) + "# ORM: Default southbound actions for " + domain
+                subs.append(
+                    indent(1) + "# ORM: Default southbound actions for " + domain
                 )
-                for line in default_actions:
-                    config.append(indent(1) + line)
-            config.append(indent(1) + "}")
-        return config
+                # Default actions are created as deep as the regular ones,
+                # which are nested in the if/elseif chain
+                subs += [line[len(indent(1)) :] for line in default_actions]
+            subs.append("}")
+        self.host_dispatch_tree = dispatchtree.get_host_dispatch_tree(
+            domain_subs, self.domain_hits
+        )
+        dispatch = make_host_dispatch(self.host_dispatch_tree, domain_subs)
+        return subs, dispatch
+
+    def make_rule_chain(self, trie, indent_depth=1):
+        """
+        Returns an if/elseif chain testing the rules of a path prefix trie.
+        Collision checking guarantees that at most one rule matches, so the
+        chain stops at the first match. The rules of a node are tested
+        before its children, which are nested in a check of their prefix.
+        No other rules of the node can match after a prefix check passed,
+        as the prefixes of the children differ in the character after the
+        prefix of the node.
+        """
+        lines = []
+        _, rules, children = trie
+        for rule in rules:
+            lines += self.make_condition(
+                rule["match_tree"],
+                rule["rule_id"],
+                indent_depth=indent_depth,
+                keyword="} elseif" if lines else "if",
+                comments=rule["comments"],
+            )
+            lines += [
+                indent(indent_depth - rule["indent_depth"]) + line
+                for line in rule["actions"]
+            ]
+        for child in children:
+            prefix_check = make_vcl_string_comparison(
+                'variable.get("path")', "begins_with", {"value": child[0]}
+            )
+            lines.append(
+                indent(indent_depth)
+                + ("} elseif" if lines else "if")
+                + " ("
+                + prefix_check
+                + ") {"
+            )
+            lines += self.make_rule_chain(child, indent_depth + 1)
+        if lines:
+            lines.append(indent(indent_depth) + "}")
+        return lines
 
     def make_northbound_actions(self, domains):
         config = []
@@ -618,13 +857,20 @@ class RenderVarnish(RenderOutput):
                 config += default_actions
         return config
 
-    def __init__(self, rule_docs, globals_doc=None):
+    def __init__(self, rule_docs, globals_doc=None, profile=None):
         # pylint:disable=too-many-locals,too-many-statements
         super().__init__(
-            rule_docs=rule_docs, globals_doc=globals_doc, output_file="varnish.vcl"
+            rule_docs=rule_docs,
+            globals_doc=globals_doc,
+            output_file="varnish.vcl",
+            profile=profile,
         )
         self.names = {}
-        self.matches = []
+        # Number of path, query and method matches rendered as string
+        # comparisons and as regexes (of which too_many_values are over
+        # MAX_STRING_COMPARISON_VALUES), in total and per rule id
+        self.match_counts = {"string": 0, "regex": 0, "too_many_values": 0}
+        self.rule_match_counts = {}
         self.actions_southbound = {}
         self.actions_northbound = {}
         self.default_actions_southbound = {}
@@ -635,38 +881,42 @@ class RenderVarnish(RenderOutput):
         self.uses_sub_use_backend = False
         self.uses_sub_reconstruct_requrl = False
         self.directors = {}
+        # Southbound sub names and the decision tree dispatching to them,
+        # keyed by domain
+        self.southbound_subs = {}
+        self.host_dispatch_tree = []
+        # The most rule and path prefix conditions tested for a request,
+        # keyed by domain
+        self.rule_dispatch_costs = {}
         for domain, rules in rule_docs.items():
             self.actions_southbound.setdefault(domain, [])
             self.actions_northbound.setdefault(domain, [])
             self.default_actions_southbound.setdefault(domain, [])
             self.default_actions_northbound.setdefault(domain, [])
-            for rule in rules:
+            # Rules of a domain never collide, so they are tested hottest
+            # first
+            for rule in logprofile.sort_by_hits(
+                rules, self.rule_hits, key=lambda rule: rule.get("_rule_id")
+            ):
                 description = rule.get("description")
                 orm_file = rule.get("_orm_source_file").split("/", 1)[1:][0]
                 rule_id = rule.get("_rule_id")
-                config_debug_line = "\n# " + orm_file + " - " + description
                 if rule.get("domain_default", False):
                     # Create default southbound and northbound actions
                     actions = rule.get("actions")
                     self.make_actions(actions, rule_id, domain=domain, indent_depth=1)
                 else:
-                    # Create a Varnish subroutine (sub) to match current rule
-                    matches = rule.get("matches")
-                    match_tree = parser.get_match_tree(matches)
-                    self.matches.append(config_debug_line)
-                    match_sub_name = self.get_unique_vcl_name("match", rule_id)
-                    match_sub = self.make_match_sub(match_tree, rule_id, match_sub_name)
-                    # Create regular southbound and northbound actions
-                    # (using the matching sub).
+                    # Create regular southbound and northbound actions,
+                    # performed when the match tree of the rule matches
                     actions = rule.get("actions")
-                    if self.make_actions(
+                    self.make_actions(
                         actions,
                         rule_id,
                         domain=domain,
-                        match_sub_name=match_sub_name,
+                        match_tree=parser.get_rule_match_tree(rule),
                         indent_depth=1,
-                    ):
-                        self.matches += match_sub
+                        comments=(orm_file + " - " + description,),
+                    )
 
         # Create global southbound and northbound actions
         global_actions = self.globals_doc.get("global_actions", None)
@@ -676,16 +926,17 @@ class RenderVarnish(RenderOutput):
 
         if self.uses_sub_use_backend:
             self.uses_sub_reconstruct_requrl = True
-        southbound_config = self.make_southbound_actions(rule_docs.keys())
-        northbound_config = self.make_northbound_actions(rule_docs.keys())
+        domains = logprofile.sort_by_hits(rule_docs.keys(), self.domain_hits)
+        southbound_subs, southbound_config = self.make_southbound_actions(domains)
+        northbound_config = self.make_northbound_actions(domains)
         haproxy = self.globals_doc.get("haproxy", {})
         self.config = self.jinja.get_template("varnish.vcl.j2").render(
             global_actions_southbound=self.global_actions_southbound,
             global_actions_northbound=self.global_actions_northbound,
-            matches=self.matches,
             synthetic_responses=self.synthetic_responses,
             uses_sub_use_backend=self.uses_sub_use_backend,
             uses_sub_reconstruct_requrl=self.uses_sub_reconstruct_requrl,
+            southbound_subs=southbound_subs,
             southbound_actions=southbound_config,
             northbound_actions=northbound_config,
             haproxy_address=haproxy.get("address", "localhost"),
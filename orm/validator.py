@@ -2,11 +2,10 @@ import os
 from sys import stderr
 import shutil
 import re
-import string
 import concurrent.futures
 import time
 import json
-import pickle
+import functools
 
 import pkg_resources
 from rfc3986 import validators, uri_reference
@@ -16,28 +15,125 @@ from jsonschema import Draft4Validator, FormatChecker
 from greenery import lego
 
 import orm.parser as parser
+import orm.fsmcache as fsmcache
+import orm.matchfsm as matchfsm
+import orm.matchsummary as matchsummary
+import orm.collision as collision
+
+# Raised while building the match FSM:s, kept importable from here
+from orm.matchfsm import (  # pylint:disable=unused-import
+    ValidateRuleConstraintsException,
+)
 
 
 class ORMSchemaException(Exception):
     pass
 
 
-class ValidateRuleConstraintsException(Exception):
-    pass
-
-
-def validate_rule_files(yml_files, cache_path=None):
-    valid = True
-    for yml_file in yml_files:
-        if not validate_rule_schema(yml_file):
-            valid = False
-    if not valid:
+def validate_rule_files(
+    yml_files=None, cache_path=None, cache_max_size=None, ruleset=None
+):
+    """
+    Validates the rule files given either as yml_files or as an already
+    loaded parser.LoadedRuleset.
+    """
+    if ruleset is None:
+        ruleset = parser.LoadedRuleset(yml_files)
+    fsm_cache = get_fsm_cache(cache_path, cache_max_size)
+    if not fsm_cache:
+        if not all(validate_rule_schemas(ruleset).values()):
+            return False
+        return validate_rule_constraints(ruleset=ruleset)
+    # With a cache, only files which changed since they last passed schema
+    # validation are parsed and validated. The rules of unchanged files
+    # are taken from the manifest.
+    manifest = fsm_cache.load_manifest(ruleset.rules_root)
+    rule_paths = {
+        yml_file: parser.get_rule_path(yml_file, ruleset.rules_root)
+        for yml_file in ruleset.yml_files
+    }
+    changed_files = [
+        yml_file
+        for yml_file in ruleset.yml_files
+        if manifest.get(rule_paths[yml_file], {}).get("hash")
+        != ruleset.get_file_hash(yml_file)
+    ]
+    print(
+        "{} of {} rule files changed since last validated.".format(
+            len(changed_files), len(ruleset.yml_files)
+        )
+    )
+    verdicts = validate_rule_schemas(ruleset, yml_files=changed_files)
+    changed_docs = ruleset.get_documents(changed_files)
+    fsm_cache.update_manifest(
+        get_manifest_changes(ruleset, verdicts, changed_docs), ruleset.rules_root
+    )
+    if not all(verdicts.values()):
         return False
-    return validate_rule_constraints(yml_files, cache_path=cache_path)
+    domain_rules = parser.merge_documents(
+        changed_docs.items(), rules_root=ruleset.rules_root
+    )["rules"]
+    for yml_file in ruleset.yml_files:
+        if yml_file not in changed_docs:
+            for rule in manifest[rule_paths[yml_file]]["rules"]:
+                for domain in rule.get("domains", []):
+                    domain_rules.setdefault(domain, []).append(
+                        dict(rule, _orm_source_file=yml_file)
+                    )
+    return validate_rule_constraints(domain_rules=domain_rules, fsm_cache=fsm_cache)
+
+
+def get_manifest_changes(ruleset, verdicts, changed_docs):
+    """
+    Returns the manifest entries of the validated files, keyed by their
+    path in the rules tree. Files which failed are dropped from the
+    manifest (None), so they are validated again in the next run.
+    """
+    manifest_changes = {}
+    for yml_file, verdict in verdicts.items():
+        rule_path = parser.get_rule_path(yml_file, ruleset.rules_root)
+        manifest_changes[rule_path] = None
+        if verdict:
+            manifest_changes[rule_path] = {
+                "hash": ruleset.get_file_hash(yml_file),
+                "rules": get_rule_stubs(changed_docs[yml_file]),
+            }
+    return manifest_changes
+
+
+def get_rule_stubs(yml_docs):
+    """
+    Returns the rules of the documents of a file, with only the keys
+    needed for constraint validation.
+    """
+    return [
+        {
+            key: rule[key]
+            for key in ("description", "domains", "domain_default", "matches")
+            if key in rule
+        }
+        for doc in yml_docs
+        for rule in doc.get("rules", [])
+    ]
+
+
+def get_fsm_cache(cache_path, cache_max_size=None):
+    """ Returns an FSMCache for cache_path, or None if caching is off """
+    if not cache_path:
+        return None
+    if os.path.isfile(cache_path):
+        print(
+            "WARNING: Ignoring FSM cache. {} is a file, the FSM cache is "
+            "a directory nowadays.".format(cache_path)
+        )
+        return None
+    if cache_max_size:
+        return fsmcache.FSMCache(cache_path, max_size=cache_max_size)
+    return fsmcache.FSMCache(cache_path)
 
 
-def validate_globals_file(globals_file):
-    return validate_globals_schema(globals_file)
+def validate_globals_file(globals_file, globals_doc=None):
+    return validate_globals_schema(globals_file, doc=globals_doc)
 
 
 orm_schemas = {"rules": {}, "globals": {}}
@@ -46,7 +142,7 @@ orm_schemas["rules"]["2"] = "rules-2.json"
 orm_schemas["globals"]["1"] = "globals-1.json"
 
 
-def get_schema(yml_file, yml_doc, schema_type="rules"):
+def get_schema_file(yml_file, yml_doc, schema_type="rules"):
     schema_version = str(yml_doc.get("schema_version", None))
     if not schema_version:
         raise ORMSchemaException("ORM doc missing schema_version (" + yml_file + ")")
@@ -61,12 +157,54 @@ def get_schema(yml_file, yml_doc, schema_type="rules"):
             + yml_file
             + ")"
         )
+    return schema_file
+
+
+@functools.lru_cache(maxsize=None)
+def load_schema(schema_file):
+    """ Returns the parsed schema. Shared between callers, do not modify. """
     json_file = open(os.path.join(schema_dir, schema_file))
     schema = json.load(json_file)
     json_file.close()
     return schema
 
 
+def get_schema(yml_file, yml_doc, schema_type="rules"):
+    return load_schema(get_schema_file(yml_file, yml_doc, schema_type))
+
+
+@functools.lru_cache(maxsize=None)
+def get_schema_validator(schema_file):
+    """ Returns a validator for the schema, created once per schema """
+    return Draft4Validator(
+        load_schema(schema_file),
+        format_checker=format_checker,
+        resolver=schema_resolver,
+    )
+
+
+format_check_cache_size = 4096
+
+
+def memoize_format_check(format_check):
+    """
+    Memoizes a pure format check for string instances. The same paths,
+    origins and regexes tend to appear in many rules.
+    """
+    cached_format_check = functools.lru_cache(maxsize=format_check_cache_size)(
+        format_check
+    )
+
+    @functools.wraps(format_check)
+    def memoized_format_check(instance):
+        if isinstance(instance, str):
+            return cached_format_check(instance)
+        return format_check(instance)
+
+    memoized_format_check.cache_info = cached_format_check.cache_info
+    return memoized_format_check
+
+
 noncontrol_US_ASCII = r"\u0020-\u007E"
 noncontrol_unicode = r"\u0020-\u007E\u00A0-\uFFFF"
 
@@ -109,6 +247,7 @@ uri_all_components_validator = (
 
 
 @FormatChecker.cls_checks("uri-path")
+@memoize_format_check
 def format_check_uri_path(instance):
     uri = uri_reference("http://example.com/{}?param=value#fragment".format(instance))
     try:
@@ -125,6 +264,7 @@ def format_check_uri_path(instance):
 
 
 @FormatChecker.cls_checks("uri-query")
+@memoize_format_check
 def format_check_uri_query_value(instance):
     uri = uri_reference("http://example.com/path?{}#fragment".format(instance))
     try:
@@ -144,6 +284,7 @@ uri_validator = validators.Validator()
 
 
 @FormatChecker.cls_checks("uri")
+@memoize_format_check
 def format_check_url(instance):
     uri = uri_reference(instance)
     try:
@@ -176,6 +317,7 @@ regex_network = re.compile("^" + reg_ipv4_network + "$")
 
 
 @FormatChecker.cls_checks("network")
+@memoize_format_check
 def format_check_network(instance):
     if not bool(regex_network.search(instance)):
         return False
@@ -215,6 +357,7 @@ regex_hostport = re.compile(
 
 
 @FormatChecker.cls_checks("hostname_with_port")
+@memoize_format_check
 def format_check_hostname_with_port(instance):
     if not bool(regex_hostport.search(instance)):
         return False
@@ -245,6 +388,7 @@ regex_origin = re.compile(orm_origin)
 
 
 @FormatChecker.cls_checks("origin")
+@memoize_format_check
 def format_check_origin(instance):
     if not isinstance(instance, str):
         return False
@@ -268,6 +412,7 @@ def format_check_origin(instance):
 
 
 @FormatChecker.cls_checks("orm_regex")
+@memoize_format_check
 def format_check_orm_regex(instance):
     # pylint:disable=broad-except
     try:
@@ -290,24 +435,72 @@ schema_dir = pkg_resources.resource_filename(__name__, "schemas/")
 schema_resolver = jsonschema.RefResolver("file://" + schema_dir, None)
 
 
-def validate_rule_schema(source_file):
-    valid = True
-    for doc in parser.parse_yaml_file(source_file):
-        schema = get_schema(source_file, doc, schema_type="rules")
-        if not validate_schema(source_file, doc, schema):
-            valid = False
-    return valid
+def validate_rule_schema_task(source_file, yml_docs):
+    """ Returns (error messages, seconds taken) for a rules file """
+    start = time.time()
+    error_msgs = []
+    for doc in yml_docs:
+        schema_file = get_schema_file(source_file, doc, schema_type="rules")
+        error_msg = get_schema_errors(
+            source_file, doc, get_schema_validator(schema_file)
+        )
+        if error_msg:
+            error_msgs.append(error_msg)
+    return error_msgs, time.time() - start
 
 
-def validate_globals_schema(source_file):
-    doc = parser.parse_globals(source_file)
-    schema = get_schema(source_file, doc, schema_type="globals")
-    return validate_schema(source_file, doc, schema)
+def validate_rule_schema(source_file, yml_docs=None):
+    if yml_docs is None:
+        yml_docs = parser.parse_yaml_file(source_file)
+    error_msgs, _ = validate_rule_schema_task(source_file, yml_docs)
+    for error_msg in error_msgs:
+        print(error_msg, file=stderr)
+    return not error_msgs
+
+
+# Below this number of files, starting worker processes costs more than
+# it saves.
+parallel_schema_min_files = 16
+
+
+def validate_rule_schemas(ruleset, yml_files=None, max_workers=None):
+    """
+    Validates the schema of the files (by default all files) of a
+    parser.LoadedRuleset. Larger sets of files are validated in parallel.
+    Errors and per-file timings are printed in file order. Returns a dict
+    with the verdict of each file.
+    """
+    if yml_files is None:
+        yml_files = ruleset.yml_files
+    yml_docs = list(ruleset.get_documents(yml_files).values())
+    if len(yml_files) < parallel_schema_min_files:
+        results = list(map(validate_rule_schema_task, yml_files, yml_docs))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(validate_rule_schema_task, yml_files, yml_docs))
+    verdicts = {}
+    for yml_file, (error_msgs, seconds) in zip(yml_files, results):
+        print("Validated schema of {} in {}s".format(yml_file, round(seconds, 3)))
+        for error_msg in error_msgs:
+            print(error_msg, file=stderr)
+        verdicts[yml_file] = not error_msgs
+    return verdicts
+
+
+def validate_globals_schema(source_file, doc=None):
+    if doc is None:
+        doc = parser.parse_globals(source_file)
+    schema_file = get_schema_file(source_file, doc, schema_type="globals")
+    error_msg = get_schema_errors(source_file, doc, get_schema_validator(schema_file))
+    if error_msg:
+        print(error_msg, file=stderr)
+        return False
+    return True
 
 
-def validate_schema(source_file, doc, schema):
-    v = Draft4Validator(schema, format_checker=format_checker, resolver=schema_resolver)
-    errors = sorted(v.iter_errors(doc), key=str)
+def get_schema_errors(source_file, doc, schema_validator):
+    """ Returns a message describing all schema errors in doc, or None """
+    errors = sorted(schema_validator.iter_errors(doc), key=str)
     if errors:
         best_error = jsonschema.exceptions.best_match(errors)
         term_cols = shutil.get_terminal_size().columns
@@ -320,191 +513,8 @@ def validate_schema(source_file, doc, schema):
         for error in errors:
             if error != best_error:
                 error_msg += str(error) + "\n" + "-" * term_cols
-        print(error_msg, file=stderr)
-        return False
-    return True
-
-
-def is_ascii_letter_range(start_char, end_char):
-    return (
-        start_char in string.ascii_letters
-        and end_char in string.ascii_letters
-        and (
-            (
-                start_char.isupper()
-                and end_char.isupper()
-                or (start_char.islower() and end_char.islower())
-            )
-        )
-    )
-
-
-def lego_ignore_case(instance):
-    in_char_class = False
-    new_inst = ""
-    i = 0
-    prev_char = ""
-    while i < len(instance):
-        char = instance[i]
-        if char == "[" and prev_char != "\\":
-            in_char_class = True
-            new_inst += char
-            i += 1
-        elif char == "]" and prev_char != "\\":
-            in_char_class = False
-            new_inst += char
-            i += 1
-        elif in_char_class:
-            if instance[i + 1] == "-" and char != "\\":  # character range
-                end_char = instance[i + 2]
-                if is_ascii_letter_range(char, end_char):
-                    # Only be case insensitive in letter-only ranges
-                    # If we need to support other ranges, it is better to
-                    # add ignore-case support to greenery.lego
-                    new_inst += (
-                        char.lower()
-                        + "-"
-                        + end_char.lower()
-                        + char.upper()
-                        + "-"
-                        + end_char.upper()
-                    )
-                else:
-                    # Do not touch weird ranges
-                    new_inst += instance[i : i + 3]
-                i += 3
-                prev_char = end_char
-            elif char.isalpha():
-                new_inst += char.lower() + char.upper()
-                i += 1
-            else:
-                new_inst += char
-                i += 1
-        else:
-            if char.isalpha():
-                new_inst += "[" + char.lower() + char.upper() + "]"
-            else:
-                new_inst += char
-            i += 1
-        prev_char = instance[i - 1]
-    return new_inst
-
-
-def lego_re_escape(instance):
-    for special_char in "\\{}[].*+?|":
-        instance = instance.replace(special_char, "\\" + special_char)
-    return instance
-
-
-def fsm_parse_regex_task(regex, negate, alphabet):
-    fsm = lego.parse(regex).to_fsm(alphabet)
-    return fsm.everythingbut() if negate else fsm
-
-
-def fsm_negate_task(fsm):
-    return fsm.everythingbut()
-
-
-def fsm_action_task(action, fsm1, fsm2):
-    if action == "and":
-        return fsm1 & fsm2
-    elif action == "or":
-        return fsm1 | fsm2
-    else:
-        raise ValidateRuleConstraintsException(
-            "Unknown fsm_action_task " "action: " + action
-        )
-
-
-def get_all_match_fsms(match_tree, worker_pool=None):
-    fsms = {}
-    for match_type in ("method", "path", "query"):
-        fsms[match_type] = get_match_fsm(
-            match_tree, match_type, worker_pool=worker_pool
-        )
-    return fsms
-
-
-def get_match_fsm(match_tree, match_type, worker_pool=None):
-    if worker_pool is None:
-        worker_pool = concurrent.futures.ProcessPoolExecutor(max_workers=1)
-    alphabet = set(string.printable)
-
-    def handle_condition_list(data_list_in, op, negate):
-        def divide_and_conquer(fsm_list, op):
-            num_items = len(fsm_list)
-            fsm_future1 = None
-            fsm_future2 = None
-            if num_items == 1:
-                return fsm_list[0]
-            elif num_items == 2:
-                fsm_future1 = fsm_list[0]
-                fsm_future2 = fsm_list[1]
-            else:
-                half = num_items // 2
-                fsm_future1 = divide_and_conquer(fsm_list[:half], op)
-                fsm_future2 = divide_and_conquer(fsm_list[half:], op)
-            if fsm_future1 is None and fsm_future2 is None:
-                return None
-            if fsm_future1 is None:
-                return fsm_future2
-            if fsm_future2 is None:
-                return fsm_future1
-            fsm_result1 = fsm_future1.result()
-            fsm_result2 = fsm_future2.result()
-            future = worker_pool.submit(fsm_action_task, op, fsm_result1, fsm_result2)
-            return future
-
-        fsm_future = divide_and_conquer(data_list_in, op)
-        if fsm_future is not None and negate:
-            fsm_result = fsm_future.result()
-            fsm_future = worker_pool.submit(fsm_negate_task, fsm_result)
-        return fsm_future
-
-    def handle_match(src, fun, inp, negate):
-        if src not in ("method", "path", "query"):
-            return None
-        value = inp["value"]
-        lego_regex = value if fun == "regex" else lego_re_escape(value)
-        if inp.get("ignore_case", False):
-            lego_regex = lego_ignore_case(lego_regex)
-        if fun == "begins_with":
-            regex = lego_regex + r".*"
-        elif fun == "ends_with":
-            regex = r".*" + lego_regex
-        elif fun == "contains":
-            regex = r".*" + lego_regex + r".*"
-        elif fun in ("exact", "regex"):
-            regex = lego_regex
-        else:
-            raise ValidateRuleConstraintsException(
-                "Handling of match function " + str(fun) + " not implemented."
-            )
-        future = worker_pool.submit(fsm_parse_regex_task, regex, negate, alphabet)
-        return future
-
-    func = {"handle_condition_list": handle_condition_list}
-    if match_type in ("method", "path", "query"):
-        func["handle_match"] = handle_match
-    else:
-        raise ValidateRuleConstraintsException(
-            "Handling of match type " + str(match_type) + " not implemented."
-        )
-    fsm_future = parser.traverse_match_tree(func, match_tree)
-    if fsm_future is None:
-        return lego.parse(".*").to_fsm(alphabet)
-    fsm_result = fsm_future.result()
-    return fsm_result
-
-
-def fsms_collide(one, two):
-    # TODO: Put the domain under fsms too
-    return (
-        one["domain"] == two["domain"]
-        and not one["fsms"]["path"].isdisjoint(two["fsms"]["path"])
-        and not one["fsms"]["query"].isdisjoint(two["fsms"]["query"])
-        and not one["fsms"]["method"].isdisjoint(two["fsms"]["method"])
-    )
+        return error_msg
+    return None
 
 
 def validate_constraints_domain_default(domain_rules):
@@ -541,7 +551,9 @@ def validate_constraints_domain_default(domain_rules):
     return True
 
 
-def validate_constraints_rule_collision(domain_rules, cache_path=None):
+def validate_constraints_rule_collision(
+    domain_rules, cache_path=None, cache_max_size=None, fsm_cache=None
+):
     # pylint:disable=too-many-locals,too-many-branches,too-many-statements
     # Assert all matches are unique (collision check) per domain
     print("Checking for match collisions...")
@@ -549,103 +561,178 @@ def validate_constraints_rule_collision(domain_rules, cache_path=None):
     cpu_count = os.cpu_count()
     print("Using a pool of {} workers".format(cpu_count))
     worker_pool = concurrent.futures.ProcessPoolExecutor(max_workers=cpu_count)
-    admin_pool = concurrent.futures.ThreadPoolExecutor(max_workers=cpu_count)
-    fsm_futures = {}
-    fsm_cache = {}
-    fsm_cache_hits = {}
-    if cache_path and os.path.exists(cache_path):
-        with open(cache_path, "rb") as fsm_cache_file:
-            fsm_cache = pickle.load(fsm_cache_file)
+    if fsm_cache is None:
+        fsm_cache = get_fsm_cache(cache_path, cache_max_size)
+    domain_entries = {}
+    # Rules are listed once per domain, but the match tree (and so the
+    # FSM:s) of a rule is the same for all its domains. Match trees are
+    # keyed by their cache key and everything derived from them is shared.
+    match_trees = {}
+    summaries = {}
+    # Rules listed for several domains share their compiled match tree
+    tree_keys = {}
     for domain, rules in domain_rules.items():
         for rule in rules:
-            # Create an FSM for each match type in each rule's match tree
             if rule.get("domain_default", False):
                 continue
-            matches = rule["matches"]
-            match_tree = parser.get_match_tree(matches)
-            fsm_cache_key = domain + str(match_tree)
-            if fsm_cache_key in fsm_cache:
-                fsm_cache_hits[fsm_cache_key] = fsm_cache.pop(fsm_cache_key)
-                continue
-            future = admin_pool.submit(
-                get_all_match_fsms, match_tree, worker_pool=worker_pool
+            match_tree = parser.get_rule_match_tree(rule)
+            if id(match_tree) not in tree_keys:
+                tree_keys[id(match_tree)] = (
+                    match_tree,
+                    fsmcache.get_cache_key(match_tree.to_dict()),
+                )
+            cache_key = tree_keys[id(match_tree)][1]
+            if cache_key not in match_trees:
+                match_trees[cache_key] = match_tree
+                summaries[cache_key] = matchsummary.get_all_match_summaries(match_tree)
+            domain_entries.setdefault(domain, []).append(
+                {
+                    "desc": rule["description"],
+                    "file": rule["_orm_source_file"],
+                    "domain": domain,
+                    "cache_key": cache_key,
+                    "match_tree": match_trees[cache_key],
+                    "summaries": summaries[cache_key],
+                }
             )
-            fsm_futures[future] = {
-                "desc": rule["description"],
-                "file": rule["_orm_source_file"],
-                "domain": domain,
-                "cache_key": fsm_cache_key,
-            }
-    # Set the cache to hits only to purge unused entries.
-    fsm_cache = fsm_cache_hits
-    rule_fsm_list = []
-    for fsm_future in concurrent.futures.as_completed(fsm_futures):
-        fsms = fsm_future.result()
-        fsm_entry = fsm_futures[fsm_future]
-        fsm_entry["fsms"] = fsms
-        print("Generated FSM for " + fsm_entry["file"] + ": " + fsm_entry["desc"])
-        rule_fsm_list.append(fsm_entry)
+    # FSM:s are built over classes of characters no rule tells apart
+    alphabet_classes = matchfsm.get_all_alphabet_classes(match_trees.values())
+    print(
+        "Alphabet classes: {}".format(
+            ", ".join(
+                "{}: {}".format(match_type, len(classes))
+                for match_type, classes in alphabet_classes.items()
+            )
+        )
+    )
+    unverified_entries, verified_entries = collision.split_verified_fsm_entries(
+        domain_entries, fsm_cache
+    )
+    domain_buckets = collision.get_domain_buckets(unverified_entries, verified_entries)
+    collision.print_domain_buckets_summary(domain_buckets)
+    pair_counts = dict.fromkeys(
+        matchsummary.prefilter_names + ("pair_cache", "checked"), 0
+    )
+    colliding_pairs, pending = collision.resolve_collision_pairs(
+        domain_buckets, pair_counts, fsm_cache
+    )
+    print(
+        "Prefilters proved {} pairs disjoint ({}). {} pairs settled by "
+        "earlier verdicts. {} match tree pairs left to check.".format(
+            sum(pair_counts[name] for name in matchsummary.prefilter_names),
+            ", ".join(
+                "{}: {}".format(name, pair_counts[name])
+                for name in matchsummary.prefilter_names
+            ),
+            pair_counts["pair_cache"],
+            len(pending),
+        )
+    )
+    # FSM:s are only needed for the match trees of the pending pairs
+    needed_trees = {}
+    for entry_pairs in pending.values():
+        for entry_pair in entry_pairs:
+            for fsm_entry in entry_pair:
+                entries = needed_trees.setdefault(fsm_entry["cache_key"], {})
+                entries[id(fsm_entry)] = fsm_entry
+    leaf_memo = matchfsm.LeafFSMMemo(worker_pool, fsm_cache)
+    fsm_graph = matchfsm.FSMGraph(alphabet_classes)
+    # The (cache key, match type) pairs waiting for each final graph node
+    graph_roots = {}
+    fsms_by_key = {}
+    for cache_key in needed_trees:
+        fsms = None
+        if fsm_cache:
+            fsms = collision.get_cached_fsms(fsm_cache, cache_key, alphabet_classes)
+        if fsms is not None:
+            fsms_by_key[cache_key] = fsms
+            continue
+        # Create an FSM for each match type in the match tree
+        for match_type in ("method", "path", "query"):
+            node_id = fsm_graph.add_match_tree(match_trees[cache_key], match_type)
+            graph_roots.setdefault(node_id, []).append((cache_key, match_type))
+    num_loaded = len(fsms_by_key)
+    print(
+        "FSM graph has {} nodes. {} shared subexpressions.".format(
+            len(fsm_graph.nodes), fsm_graph.num_shared
+        )
+    )
+    generated_fsms = {}
+    for node_id, compact_fsm in fsm_graph.run(worker_pool, leaf_memo):
+        for cache_key, match_type in graph_roots[node_id]:
+            fsms = generated_fsms.setdefault(cache_key, {})
+            fsms[match_type] = compact_fsm
+            if len(fsms) < 3:
+                continue
+            fsms_by_key[cache_key] = fsms
+            for fsm_entry in needed_trees[cache_key].values():
+                print(
+                    "Generated FSM for " + fsm_entry["file"] + ": " + fsm_entry["desc"]
+                )
 
     print(
-        "Got {} FSM:s. {} from cache. {} freshly generated.".format(
-            str(len(rule_fsm_list) + len(fsm_cache.keys())),
-            str(len(fsm_cache.keys())),
-            str(len(rule_fsm_list)),
+        "Needed FSM:s for {} of {} unique match trees. {} loaded from cache. "
+        "{} freshly generated.".format(
+            len(needed_trees),
+            len(match_trees),
+            num_loaded,
+            len(generated_fsms),
         )
     )
+    leaf_memo.print_summary()
     print("FSM generation took: {}s".format(str(round(time.time() - fsm_gen_start, 2))))
+    worker_pool.shutdown()
     collision_check_start = time.time()
-    collision_futures = {}
-    for i, fsm_one in enumerate(rule_fsm_list):
-        # First check the new FSM:s against the other new FSM:s
-        j = i + 1
-        while j < len(rule_fsm_list):
-            fsm_two = rule_fsm_list[j]
-            future = worker_pool.submit(fsms_collide, fsm_one, fsm_two)
-            collision_futures[future] = {"fsm_one": fsm_one, "fsm_two": fsm_two}
-            j += 1
-        # Then check the new FSM:s against the cached FSM:s
-        for cache_key in fsm_cache:
-            fsm_two = fsm_cache[cache_key]
-            future = worker_pool.submit(fsms_collide, fsm_one, fsm_two)
-            collision_futures[future] = {"fsm_one": fsm_one, "fsm_two": fsm_two}
+    for key_pair, collides in collision.check_collisions(
+        pending, fsms_by_key, cpu_count, pair_counts
+    ):
+        if fsm_cache:
+            fsm_cache.put_pair_verdict(*key_pair, collides)
+        if collides:
+            colliding_pairs += pending[key_pair]
+    print("{} pairs checked by FSM intersection.".format(pair_counts["checked"]))
     collision_messages = []
-    colliding_fsm_cache_keys = []
-    for collision_future in concurrent.futures.as_completed(collision_futures):
-        if collision_future.result():
-            collision_data = collision_futures[collision_future]
-            fsm_one = collision_data["fsm_one"]
-            fsm_two = collision_data["fsm_two"]
-            colliding_fsm_cache_keys += [fsm_one["cache_key"], fsm_two["cache_key"]]
-            collision_messages.append(
-                "\nFound collision for domain: {domain}\n"
-                "{first_file} ({first_desc})\n"
-                "collides with\n"
-                "{second_file} ({second_desc})\n".format(
-                    domain=fsm_one["domain"],
-                    first_file=fsm_one["file"],
-                    first_desc=fsm_one["desc"],
-                    second_file=fsm_two["file"],
-                    second_desc=fsm_two["desc"],
-                )
+    colliding_entries = set()
+    for fsm_one, fsm_two in colliding_pairs:
+        colliding_entries.update((id(fsm_one), id(fsm_two)))
+        collision_messages.append(
+            "\nFound collision for domain: {domain}\n"
+            "{first_file} ({first_desc})\n"
+            "collides with\n"
+            "{second_file} ({second_desc})\n".format(
+                domain=fsm_one["domain"],
+                first_file=fsm_one["file"],
+                first_desc=fsm_one["desc"],
+                second_file=fsm_two["file"],
+                second_desc=fsm_two["desc"],
             )
+        )
     print(
         "Collision check took: "
         + str(round(time.time() - collision_check_start, 2))
         + "s"
     )
-    if cache_path:
-        print("Writing FSM cache to {}".format(cache_path))
-        # Add newly generated FSM:s to cache
-        for fsm_entry in rule_fsm_list:
-            cache_key = fsm_entry["cache_key"]
-            # Only add to cache if it did not collide with anything.
-            # The cache must only contain FSM:s which does not collide
-            # with any other FSM in the cache.
-            if cache_key not in colliding_fsm_cache_keys:
-                fsm_cache[cache_key] = fsm_entry
-        with open(cache_path, "wb") as fsm_cache_file:
-            pickle.dump(fsm_cache, fsm_cache_file)
+    if fsm_cache:
+        print("Writing FSM cache to {}".format(fsm_cache.cache_dir))
+        # Entries are content addressed, so even FSM:s which collide
+        # can be shared with other runs.
+        for cache_key, fsms in generated_fsms.items():
+            fsm_cache.put(cache_key, {"fsms": fsms})
+        leaf_memo.save()
+        fsm_cache.save_pair_verdicts()
+        # Only entries which did not collide with anything are verified.
+        # Verified entries are never checked against each other again.
+        verified = {}
+        for fsm_entry in unverified_entries + verified_entries:
+            if id(fsm_entry) not in colliding_entries:
+                verified.setdefault(fsm_entry["domain"], set()).add(
+                    fsm_entry["cache_key"]
+                )
+        fsm_cache.save_verified(verified)
+        if fsm_cache.stats.writes:
+            evicted = fsm_cache.evict()
+            if evicted:
+                print("Evicted {} FSM cache entries".format(evicted))
     if collision_messages:
         for msg in collision_messages:
             print(msg)
@@ -654,13 +741,23 @@ def validate_constraints_rule_collision(domain_rules, cache_path=None):
 
 
 # Validate constraints not covered by schema validation
-def validate_rule_constraints(yml_files=None, cache_path=None):
-    orm_docs = parser.parse_rules(yml_files)
+def validate_rule_constraints(
+    yml_files=None, cache_path=None, *, ruleset=None, domain_rules=None, fsm_cache=None
+):
+    """
+    Validates the constraints of the rules of yml_files, of a
+    parser.LoadedRuleset or of already merged domain_rules. The FSM cache
+    is fsm_cache if given, else an unbounded cache in cache_path.
+    """
+    if domain_rules is None:
+        if ruleset is None:
+            ruleset = parser.LoadedRuleset(yml_files)
+        domain_rules = ruleset.get_merged_documents()["rules"]
+    if fsm_cache is None:
+        fsm_cache = get_fsm_cache(cache_path)
     print("Validating additional ORM constraints...")
-    if not validate_constraints_domain_default(orm_docs["rules"]):
+    if not validate_constraints_domain_default(domain_rules):
         return False
-    if not validate_constraints_rule_collision(
-        orm_docs["rules"], cache_path=cache_path
-    ):
+    if not validate_constraints_rule_collision(domain_rules, fsm_cache=fsm_cache):
         return False
     return True
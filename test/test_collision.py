@@ -0,0 +1,73 @@
+import unittest
+import tempfile
+
+import orm.matchsummary as matchsummary
+import orm.collision as collision
+import orm.fsmcache as fsmcache
+
+def fsm_entry(name, path='.*', domain=None):
+    match_tree = {'match': {'source': 'path', 'function': 'regex',
+                            'input': {'value': path}}}
+    return {'domain': domain, 'desc': name, 'cache_key': name,
+            'summaries': matchsummary.get_all_match_summaries(match_tree)}
+
+class CollisionTest(unittest.TestCase):
+    def test_get_domain_buckets(self):
+        new_entries = [fsm_entry('one', domain='a.example.com'),
+                       fsm_entry('two', domain='a.example.com'),
+                       fsm_entry('three', domain='b.example.com')]
+        cached_entries = [fsm_entry('four', domain='a.example.com'),
+                          fsm_entry('five', domain='c.example.com')]
+        domain_buckets = collision.get_domain_buckets(new_entries,
+                                                      cached_entries)
+        self.assertEqual(sorted(domain_buckets.keys()),
+                         ['a.example.com', 'b.example.com', 'c.example.com'])
+        pair_counts = dict.fromkeys(
+            matchsummary.prefilter_names + ('pair_cache', 'checked'), 0)
+        _, pending = collision.resolve_collision_pairs(domain_buckets,
+                                                       pair_counts)
+        # Cross-domain pairs and cached/cached pairs are never checked
+        self.assertEqual(sorted(pending),
+                         [('four', 'one'), ('four', 'two'), ('one', 'two')])
+        self.assertEqual(collision.count_pairs(2, 1), len(pending))
+
+    def test_get_collision_tiles(self):
+        bucket = {'new': list(range(7)), 'cached': list(range(5))}
+        tiles = list(collision.get_collision_tiles(bucket, tile_size=3))
+        pairs = [pair for tile in tiles for pair in tile]
+        self.assertEqual(len(pairs), len(set(pairs)))
+        self.assertEqual(len(pairs), collision.count_pairs(7, 5))
+        for tile in tiles:
+            self.assertLessEqual(len(tile), 9)
+            self.assertTrue(all(i < 7 and i < j < 12 for i, j in tile))
+
+    def test_get_collision_fsm_table(self):
+        fsms = {'a': 'fsm_a', 'b': 'fsm_b', 'c': 'fsm_c'}
+        fsm_table, index_pairs = collision.get_collision_fsm_table(
+            [('a', 'b'), ('b', 'c'), ('a', 'c')], fsms)
+        # Every FSM is in the table once
+        self.assertEqual(fsm_table, ['fsm_a', 'fsm_b', 'fsm_c'])
+        self.assertEqual(index_pairs, [(0, 1), (1, 2), (0, 2)])
+
+    def test_resolve_collision_pairs(self):
+        one, two, three = (fsm_entry('one', '/a.*'), fsm_entry('two', '/b.*'),
+                           fsm_entry('three', '.*x'))
+        domain_buckets = {
+            'a.example.com': {'new': [one], 'cached': [two, three]},
+            'b.example.com': {'new': [one, three], 'cached': []},
+        }
+        with tempfile.TemporaryDirectory() as cache_path:
+            fsm_cache = fsmcache.FSMCache(cache_path)
+            fsm_cache.put_pair_verdict('two', 'one', False)
+            pair_counts = dict.fromkeys(
+                matchsummary.prefilter_names + ('pair_cache', 'checked'), 0)
+            collisions, pending = collision.resolve_collision_pairs(
+                domain_buckets, pair_counts, fsm_cache)
+        self.assertEqual(collisions, [])
+        self.assertEqual(pair_counts['pair_cache'], 1)
+        # The pair found in both domains is checked once
+        self.assertEqual(list(pending), [('one', 'three')])
+        self.assertEqual(len(pending[('one', 'three')]), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import pickle
+import string
+import unittest
+
+from greenery import lego
+
+from orm.compactfsm import CompactFSM
+
+class CompactFSMTest(unittest.TestCase):
+    def setUp(self):
+        self.alphabet = set(string.printable)
+
+    def compact(self, regex):
+        return CompactFSM.from_fsm(lego.parse(regex).to_fsm(self.alphabet))
+
+    def test_from_fsm(self):
+        compact_fsm = self.compact('/api/.*')
+        self.assertEqual(len(compact_fsm.symbols), len(self.alphabet))
+        self.assertTrue(compact_fsm.accepts('/api/'))
+        self.assertTrue(compact_fsm.accepts('/api/v1'))
+        self.assertFalse(compact_fsm.accepts('/ap'))
+        self.assertFalse(compact_fsm.accepts('/apiå'))
+        # Equal languages give equal tables
+        self.assertEqual(compact_fsm, self.compact('/api/(.*|v1)'))
+        self.assertEqual(pickle.loads(pickle.dumps(compact_fsm)), compact_fsm)
+
+    def test_isempty(self):
+        self.assertFalse(self.compact('a*').isempty())
+        self.assertTrue(self.compact('[]').isempty())
+
+    def test_isdisjoint(self):
+        prefix = self.compact('/a.*')
+        self.assertFalse(prefix.isdisjoint(self.compact('/ab')))
+        self.assertFalse(prefix.isdisjoint(self.compact('.*b')))
+        self.assertTrue(prefix.isdisjoint(self.compact('/b.*')))
+        self.assertTrue(prefix.isdisjoint(self.compact('/')))
+        intersection = prefix & self.compact('.*b')
+        self.assertTrue(intersection.accepts('/ab'))
+        self.assertFalse(intersection.accepts('/a'))
+
+    def test_isdisjoint_matches_intersection(self):
+        regexes = ['', 'a*', '/a.*', '.*b', '[^a]b?', '(ab|ba)*', '/']
+        for one in regexes:
+            for two in regexes:
+                fsm_one = self.compact(one)
+                fsm_two = self.compact(two)
+                self.assertEqual(fsm_one.isdisjoint(fsm_two),
+                                 (fsm_one & fsm_two).isempty())
+
+    def test_remap(self):
+        compact_fsm = self.compact('/a[bc].*')
+        symbols = ('/', 'a', 'bc', ''.join(sorted(self.alphabet - set('/abc'))))
+        remapped = compact_fsm.remap(symbols)
+        self.assertEqual(remapped.symbols, symbols)
+        self.assertEqual(remapped.num_states, 4)
+        self.assertTrue(remapped.accepts('/ac'))
+        self.assertTrue(remapped.accepts('/abx'))
+        self.assertFalse(remapped.accepts('/a'))
+        self.assertEqual(remapped.remap(compact_fsm.symbols), compact_fsm)
+
+    def test_to_fsm(self):
+        compact_fsm = self.compact('/a[bc].*')
+        fsm = compact_fsm.to_fsm()
+        self.assertTrue(fsm.accepts('/abx'))
+        self.assertFalse(fsm.accepts('/ax'))
+        self.assertEqual(CompactFSM.from_fsm(fsm), compact_fsm)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,23 @@
+import unittest
+
+import orm.dispatchtree as dispatchtree
+
+class DispatchTreeTest(unittest.TestCase):
+    def test_path_prefix_trie(self):
+        entries = [('/api/v1/', 'v1'), ('', 'any'), ('/api/v2/', 'v2'),
+                   ('/img/', 'img'), ('/api/', 'api'), ('/api/v2/x', 'x')]
+        trie = dispatchtree.get_path_prefix_trie(entries)
+        self.assertEqual(trie, ('', ['any'], [
+            ('/', ['img'], [
+                ('/api/', ['api'], [
+                    ('/api/v', ['v1'], [
+                        ('/api/v2/', ['v2', 'x'], [])])])])]))
+        # All six rules and the four prefix checks on the way to "x"
+        self.assertEqual(dispatchtree.get_path_prefix_trie_cost(trie), 10)
+        entries = [('/' + str(i), str(i)) for i in range(3)]
+        trie = dispatchtree.get_path_prefix_trie(entries)
+        self.assertEqual(trie, ('', [], [('/', ['0', '1', '2'], [])]))
+        self.assertEqual(dispatchtree.get_path_prefix_trie_cost(trie), 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import os
+import unittest
+import tempfile
+
+import orm.fsmcache as fsmcache
+
+class FSMCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = fsmcache.FSMCache(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_get_cache_key(self):
+        tree1 = {'match': {'source': 'path', 'function': 'exact',
+                           'input': {'value': '/a', 'ignore_case': True}}}
+        tree2 = {'match': {'input': {'ignore_case': True, 'value': '/a'},
+                           'function': 'exact', 'source': 'path'}}
+        tree3 = {'match': {'source': 'path', 'function': 'exact',
+                           'input': {'value': '/b'}}}
+        key1 = fsmcache.get_cache_key(tree1)
+        self.assertEqual(key1, fsmcache.get_cache_key(tree2))
+        self.assertNotEqual(key1, fsmcache.get_cache_key(tree3))
+        self.assertRegex(key1, r'^[0-9a-f]{64}$')
+
+    def test_get_put(self):
+        key = fsmcache.get_cache_key('tree')
+        self.assertNotIn(key, self.cache)
+        self.assertIsNone(self.cache.get(key))
+        self.cache.put(key, {'fsms': 'yeah'})
+        self.assertIn(key, self.cache)
+        self.assertEqual(self.cache.get(key), {'fsms': 'yeah'})
+        self.assertEqual((self.cache.stats.hits, self.cache.stats.misses), (1, 1))
+        # A broken entry is a cache miss
+        with open(self.cache.entry_path(key), 'wb') as entry_file:
+            entry_file.write(b'broken')
+        self.assertIsNone(self.cache.get(key))
+
+    def test_evict(self):
+        keys = [fsmcache.get_cache_key(str(i)) for i in range(4)]
+        for i, key in enumerate(keys):
+            self.cache.put(key, 'x' * 1000)
+            os.utime(self.cache.entry_path(key), (i, i))
+        # Using an entry makes it the most recently used one
+        self.cache.get(keys[0])
+        self.cache.max_size = 2500
+        self.assertEqual(self.cache.evict(), 2)
+        self.assertIn(keys[0], self.cache)
+        self.assertNotIn(keys[1], self.cache)
+        self.assertNotIn(keys[2], self.cache)
+        self.assertIn(keys[3], self.cache)
+
+    def test_evict_size(self):
+        key = fsmcache.get_cache_key('tree')
+        self.cache.put(key, 'x' * 1000)
+        self.assertIsNone(self.cache.load_size())
+        self.assertEqual(self.cache.evict(), 0)
+        size = self.cache.load_size()
+        self.assertGreater(size, 1000)
+        # Under max_size, the cache is not walked and the size is only
+        # added to
+        self.cache.put(key, 'x' * 1000)
+        self.assertEqual(self.cache.evict(), 0)
+        self.assertEqual(self.cache.load_size(), 2 * size)
+        # Beyond it, the walk saves the real size
+        self.cache.max_size = 1.5 * size
+        self.assertEqual(self.cache.evict(), 0)
+        self.assertEqual(self.cache.load_size(), size)
+
+    def test_namespaces(self):
+        key = fsmcache.get_cache_key('tree')
+        self.cache.put(key, 'leaf', namespace='leaf')
+        self.assertIsNone(self.cache.get(key))
+        self.assertEqual(self.cache.get(key, namespace='leaf'), 'leaf')
+        # Eviction covers all namespaces
+        self.cache.max_size = 0
+        self.assertEqual(self.cache.evict(), 1)
+        self.assertIsNone(self.cache.get(key, namespace='leaf'))
+
+    def test_pair_verdicts(self):
+        self.assertIsNone(self.cache.get_pair_verdict('a', 'b'))
+        self.cache.put_pair_verdict('a', 'b', True)
+        self.cache.put_pair_verdict('a', 'c', False)
+        # Pairs are unordered
+        self.assertTrue(self.cache.get_pair_verdict('b', 'a'))
+        self.cache.save_pair_verdicts()
+        cache = fsmcache.FSMCache(self.tmpdir.name)
+        self.assertTrue(cache.get_pair_verdict('a', 'b'))
+        self.assertFalse(cache.get_pair_verdict('c', 'a'))
+
+    def test_pair_verdicts_eviction(self):
+        self.cache.max_pair_verdicts = 2
+        # Find three pairs kept in the same shard
+        pairs = [('a', str(i)) for i in range(2000)]
+        shard = fsmcache.get_pair_key(*pairs[0])[0]
+        pairs = [pair for pair in pairs
+                 if fsmcache.get_pair_key(*pair)[0] == shard][:3]
+        for pair in pairs:
+            self.cache.put_pair_verdict(*pair, False)
+        # Using a verdict makes it the most recently used one
+        self.cache.get_pair_verdict(*pairs[0])
+        self.cache.save_pair_verdicts()
+        cache = fsmcache.FSMCache(self.tmpdir.name)
+        self.assertFalse(cache.get_pair_verdict(*pairs[0]))
+        self.assertIsNone(cache.get_pair_verdict(*pairs[1]))
+        self.assertFalse(cache.get_pair_verdict(*pairs[2]))
+
+    def test_verified(self):
+        self.assertEqual(self.cache.load_verified(['example.com']), {})
+        verified = {'example.com': {'a', 'b'}}
+        self.cache.save_verified(verified)
+        self.assertEqual(self.cache.load_verified(['example.com']), verified)
+        # Saving other domains keeps the keys of this one
+        self.cache.save_verified({'example.org': {'c'}})
+        self.assertEqual(
+            self.cache.load_verified(['example.com', 'example.org']),
+            {'example.com': {'a', 'b'}, 'example.org': {'c'}})
+
+    def test_manifest(self):
+        self.assertEqual(self.cache.load_manifest('rules'), {})
+        self.cache.update_manifest({'a.yml': {'hash': 'a'},
+                                    'b.yml': {'hash': 'b'}}, 'rules')
+        # Other processes' changes to the same manifest are kept
+        cache = fsmcache.FSMCache(self.tmpdir.name)
+        cache.update_manifest({'b.yml': None, 'c.yml': {'hash': 'c'}},
+                              'rules')
+        self.assertEqual(self.cache.load_manifest('rules'),
+                         {'a.yml': {'hash': 'a'}, 'c.yml': {'hash': 'c'}})
+        # Every rules tree has its own manifest
+        self.assertEqual(self.cache.load_manifest('other/rules'), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import gzip
+import json
+import unittest
+import tempfile
+
+import orm.logprofile as logprofile
+
+def make_entry(backend_name, host):
+    return {'backend_name': backend_name,
+            'headers': '{-|curl/7.58.0|' + host + '|}',
+            'http_request': 'GET / HTTP/1.1'}
+
+class LogProfileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_iter_log_entries(self):
+        lines = ['Oct 18 10:00:00 lb haproxy[1]: ' +
+                 json.dumps(make_entry('orm_external', 'a.example.com')),
+                 'garbage {"not": json',
+                 json.dumps(make_entry('rule_id', 'a.example.com')),
+                 '']
+        plain_path = os.path.join(self.tmpdir.name, 'haproxy.log')
+        with open(plain_path, 'w') as log_file:
+            log_file.write('\n'.join(lines))
+        # Rotated logs are gzipped, whatever their name
+        gzip_path = os.path.join(self.tmpdir.name, 'haproxy.log.1')
+        with gzip.open(gzip_path, 'wt') as log_file:
+            log_file.write('\n'.join(lines))
+        entries = list(logprofile.iter_log_entries([plain_path, gzip_path]))
+        self.assertEqual(len(entries), 4)
+        self.assertEqual(entries[0]['backend_name'], 'orm_external')
+        self.assertEqual(entries[3]['backend_name'], 'rule_id')
+
+    def test_make_profile(self):
+        entries = [make_entry('orm_external', 'a.example.com'),
+                   make_entry('rule_one', 'a.example.com'),
+                   make_entry('orm_external', 'a.example.com'),
+                   make_entry('orm_external', 'b.example.com'),
+                   make_entry('rule_two', 'b.example.com'),
+                   make_entry('<NOSRV>', 'b.example.com'),
+                   {'backend_name': 'rule_one'},
+                   {'headers': 'unexpected'}]
+        profile = logprofile.make_profile(entries)
+        self.assertEqual(profile, {
+            'domains': {'a.example.com': 2, 'b.example.com': 1},
+            'rules': {'rule_one': 2, 'rule_two': 1}})
+        # Without the external frontend's logs, domains are counted from
+        # the requests sent to rule backends
+        profile = logprofile.make_profile(entries[1:2] + entries[4:5])
+        self.assertEqual(profile['domains'],
+                         {'a.example.com': 1, 'b.example.com': 1})
+
+    def test_save_load_profile(self):
+        path = os.path.join(self.tmpdir.name, 'profile.json')
+        self.assertEqual(logprofile.load_profile(path),
+                         {'domains': {}, 'rules': {}})
+        profile = {'domains': {'a.example.com': 2}, 'rules': {'rule': 1}}
+        logprofile.save_profile(profile, path)
+        self.assertEqual(logprofile.load_profile(path), profile)
+        with open(path, 'w') as profile_file:
+            profile_file.write('[]')
+        self.assertEqual(logprofile.load_profile(path),
+                         {'domains': {}, 'rules': {}})
+
+    def test_sort_by_hits(self):
+        hits = {'b': 1, 'd': 5}
+        self.assertEqual(logprofile.sort_by_hits('abcd', hits),
+                         ['d', 'b', 'a', 'c'])
+        items = [{'id': item} for item in 'abcd']
+        self.assertEqual(
+            logprofile.sort_by_hits(items, hits, key=lambda item: item['id']),
+            [{'id': 'd'}, {'id': 'b'}, {'id': 'a'}, {'id': 'c'}])
+
+if __name__ == '__main__':
+    unittest.main()
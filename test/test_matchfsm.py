@@ -0,0 +1,159 @@
+import string
+import unittest
+import tempfile
+import concurrent.futures
+
+from orm.compactfsm import CompactFSM
+
+import orm.matchfsm as matchfsm
+import orm.fsmcache as fsmcache
+
+def match_leaf(source, function, value, ignore_case=False):
+    inp = {'value': value}
+    if ignore_case:
+        inp['ignore_case'] = True
+    return {'match': {'source': source, 'function': function, 'input': inp}}
+
+class MatchFSMTest(unittest.TestCase):
+    def test_lego_ignore_case(self):
+        exp = ('[yY][eE][aA][hH]\\[[bB][oO][iI]\\]'
+               '[tT][hH][iI][sS][rRa-eA-EgG\\-eExX][!]')
+        out = matchfsm.lego_ignore_case('yeAh\\[boi\\]this[ra-eg\\-ex][!]')
+        self.assertEqual(exp, out)
+        # Do not convert weird non-ascii character ranges.
+        exp = ('[a-ö][$-f]')
+        out = matchfsm.lego_ignore_case('[a-ö][$-f]')
+        self.assertEqual(exp, out)
+
+    def test_get_all_match_fsms(self):
+        match_tree = {
+            'and': [
+                {'or': [
+                    {'not': {'and': [
+                        {'match': {
+                            'source': 'path',
+                            'function': 'regex',
+                            'input': {
+                                'value': 'imba'
+                            }
+                        }}
+                    ]}}
+                ]},
+                {'not': {'not': {
+                    'match': {
+                        'source': 'path',
+                        'function': 'begins_with',
+                        'input': {
+                            'value': 'yeah'
+                        }
+                    }
+                }}}
+            ]
+        }
+        fsm_obj = matchfsm.get_all_match_fsms(match_tree)
+        self.assertIsInstance(fsm_obj, dict)
+        self.assertIsInstance(fsm_obj["path"], CompactFSM)
+        self.assertTrue(fsm_obj["path"].accepts('yeah'))
+        self.assertFalse(fsm_obj["path"].accepts('imba'))
+        # Test match tree without any path matches
+        match_tree = {
+            'match': {'source': 'domain',
+                      'function': 'exact',
+                      'input': 'example.com'}
+        }
+        fsm_obj = matchfsm.get_all_match_fsms(match_tree)
+        self.assertIsInstance(fsm_obj, dict)
+        self.assertIsInstance(fsm_obj["path"], CompactFSM)
+
+    def test_get_alphabet_classes(self):
+        match_trees = [
+            match_leaf('path', 'begins_with', '/a'),
+            {'not': match_leaf('path', 'regex', '[a-c]x')},
+            match_leaf('path', 'exact', 'b', ignore_case=True),
+            match_leaf('method', 'exact', 'GET'),
+        ]
+        classes = matchfsm.get_alphabet_classes(match_trees, 'path')
+        self.assertEqual(''.join(sorted(''.join(classes))),
+                         ''.join(sorted(string.printable)))
+        self.assertIn('/', classes)
+        self.assertIn('a', classes)
+        self.assertIn('c', classes)
+        self.assertIn('x', classes)
+        self.assertIn('B', classes)
+        self.assertEqual(len(classes), 7)
+        # A source without matches is a single class
+        classes = matchfsm.get_alphabet_classes(match_trees, 'query')
+        self.assertEqual(len(classes), 1)
+        # FSM:s over the classes agree with FSM:s over the whole alphabet
+        alphabet_classes = matchfsm.get_all_alphabet_classes(match_trees)
+        fsms = [matchfsm.get_all_match_fsms(match_tree,
+                                            alphabet_classes=alphabet_classes)
+                for match_tree in match_trees]
+        self.assertFalse(fsms[0]['path'].isdisjoint(fsms[1]['path']))
+        self.assertTrue(fsms[0]['path'].isdisjoint(fsms[2]['path']))
+        self.assertTrue(fsms[1]['path'].accepts('/abc'))
+        self.assertFalse(fsms[1]['path'].accepts('bx'))
+
+    def test_fsm_graph(self):
+        prefix_a = match_leaf('path', 'begins_with', '/a')
+        prefix_a_b = match_leaf('path', 'begins_with', '/a/b')
+        match_trees = [
+            {'and': [prefix_a, {'not': prefix_a_b}]},
+            {'and': [{'not': prefix_a_b}, prefix_a]},
+            {'or': [match_leaf('path', 'begins_with', '/c'),
+                    match_leaf('method', 'begins_with', 'GET')]},
+        ]
+        fsm_graph = matchfsm.FSMGraph()
+        node_ids = [fsm_graph.add_match_tree(match_tree, 'path')
+                    for match_tree in match_trees]
+        # Equal subexpressions are the same node
+        self.assertEqual(node_ids[0], node_ids[1])
+        # A source without constraints is '.*'
+        self.assertIn(('parse', '.*', False, 'path'), fsm_graph.node_ids)
+        with concurrent.futures.ThreadPoolExecutor() as worker_pool:
+            results = dict(fsm_graph.run(worker_pool))
+        self.assertEqual(len(results), 2)
+        self.assertTrue(results[node_ids[0]].accepts('/a/c'))
+        self.assertFalse(results[node_ids[0]].accepts('/a/b/c'))
+        self.assertTrue(results[node_ids[2]].accepts('/d'))
+
+    def test_leaf_fsm_memo(self):
+        classes = matchfsm.get_default_alphabet_classes()
+        with tempfile.TemporaryDirectory() as cache_path, \
+                concurrent.futures.ThreadPoolExecutor() as worker_pool:
+            fsm_cache = fsmcache.FSMCache(cache_path)
+            leaf_memo = matchfsm.LeafFSMMemo(worker_pool, fsm_cache)
+            future = leaf_memo.get('/a.*', False, classes)
+            self.assertIs(leaf_memo.get('/a.*', False, classes), future)
+            negated = leaf_memo.get('/a.*', True, classes).result()
+            self.assertTrue(future.result().accepts('/ab'))
+            self.assertFalse(negated.accepts('/ab'))
+            self.assertEqual((leaf_memo.hits, len(leaf_memo.parsed)), (1, 2))
+            leaf_memo.save()
+            # Leaves are loaded from the cache in later runs, even when
+            # built over other alphabet classes
+            leaf_memo = matchfsm.LeafFSMMemo(worker_pool, fsm_cache)
+            classes = ('/', 'a', ''.join(sorted(set(classes) - set('/a'))))
+            fsm = leaf_memo.get('/a.*', False, classes).result()
+            self.assertEqual((leaf_memo.loaded, len(leaf_memo.parsed)), (1, 0))
+            self.assertTrue(fsm.accepts('/a/'))
+            self.assertFalse(fsm.accepts('a'))
+
+    def test_get_all_match_fsms_per_source(self):
+        path_match = match_leaf('path', 'begins_with', '/a')
+        method_match = match_leaf('method', 'exact', 'GET')
+        fsm_obj = matchfsm.get_all_match_fsms({'and': [path_match,
+                                                       method_match]})
+        self.assertTrue(fsm_obj["path"].accepts('/abc'))
+        self.assertFalse(fsm_obj["path"].accepts('GET'))
+        self.assertTrue(fsm_obj["method"].accepts('GET'))
+        self.assertFalse(fsm_obj["method"].accepts('/abc'))
+        self.assertTrue(fsm_obj["query"].accepts('anything'))
+        # A match on another source can satisfy an 'or' on its own
+        fsm_obj = matchfsm.get_all_match_fsms({'or': [path_match,
+                                                      method_match]})
+        self.assertTrue(fsm_obj["path"].accepts('/other'))
+        self.assertTrue(fsm_obj["method"].accepts('POST'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+
+import orm.matchsummary as matchsummary
+
+def match_leaf(source, function, value, ignore_case=False):
+    inp = {'value': value}
+    if ignore_case:
+        inp['ignore_case'] = True
+    return {'match': {'source': source, 'function': function, 'input': inp}}
+
+class MatchSummaryTest(unittest.TestCase):
+    def test_get_match_summary(self):
+        match_tree = {'and': [
+            {'or': [match_leaf('path', 'begins_with', '/api/v1'),
+                    match_leaf('path', 'begins_with', '/api/v2')]},
+            {'or': [match_leaf('method', 'exact', 'GET')]}
+        ]}
+        summaries = matchsummary.get_all_match_summaries(match_tree)
+        self.assertEqual(summaries['path']['prefix'], '/api/v')
+        self.assertEqual(summaries['path']['min_len'], 7)
+        self.assertIsNone(summaries['path']['max_len'])
+        self.assertEqual(summaries['method']['values'], frozenset(['GET']))
+        self.assertIsNone(summaries['query']['values'])
+        # A match on another source in an 'or' leaves this source open
+        match_tree = {'or': [match_leaf('path', 'exact', '/a'),
+                             match_leaf('method', 'exact', 'GET')]}
+        summary = matchsummary.get_match_summary(match_tree, 'path')
+        self.assertEqual(summary, matchsummary.get_summary_top())
+        # Contradicting 'and' is provably empty
+        match_tree = {'and': [match_leaf('path', 'exact', '/a'),
+                              match_leaf('path', 'exact', '/b')]}
+        summary = matchsummary.get_match_summary(match_tree, 'path')
+        self.assertTrue(summary['empty'])
+
+    def test_summaries_disjoint(self):
+        cases = [
+            (('method', 'exact', 'GET'), ('method', 'exact', 'POST'),
+             'finite_set'),
+            (('path', 'begins_with', '/a'), ('path', 'begins_with', '/b'),
+             'prefix'),
+            (('path', 'ends_with', '.js'), ('path', 'ends_with', '.css'),
+             'suffix'),
+            (('path', 'begins_with', 'a', True), ('path', 'exact', 'b'),
+             'first_char'),
+            (('path', 'exact', 'abc', True), ('path', 'contains', 'abcd'),
+             'length'),
+            (('path', 'begins_with', '/a'), ('path', 'begins_with', '/ab'),
+             None),
+            (('path', 'regex', '/a.*'), ('path', 'exact', '/b'), None),
+        ]
+        for one, two, exp in cases:
+            summaries = [matchsummary.get_match_summary(match_leaf(*leaf_args),
+                                                        leaf_args[0])
+                         for leaf_args in (one, two)]
+            self.assertEqual(matchsummary.summaries_disjoint(*summaries),
+                             exp, str((one, two)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,12 @@ import string
 
 import orm.parser as parser
 
+def match_leaf(source, function, value, ignore_case=False):
+    inp = {'value': value}
+    if ignore_case:
+        inp['ignore_case'] = True
+    return {'match': {'source': source, 'function': function, 'input': inp}}
+
 class ParseRulesTest(unittest.TestCase):
     #pylint:disable=too-many-instance-attributes
     def setUp(self):
@@ -55,6 +61,53 @@ class ParseRulesTest(unittest.TestCase):
         self.assertIsNotNone(re.search(allowed_pattern, id2))
         self.assertNotEqual(id1, id2)
 
+    def test_get_rule_id(self):
+        rule_id = parser.get_rule_id('rules/a.yml', 'example.com', 'Foo bar')
+        self.assertRegex(rule_id, r'^foo_bar_[0-9a-f]{8}$')
+        self.assertEqual(
+            rule_id, parser.get_rule_id('rules/a.yml', 'example.com', 'Foo bar'))
+        self.assertNotEqual(
+            rule_id, parser.get_rule_id('rules/b.yml', 'example.com', 'Foo bar'))
+        self.assertNotEqual(
+            rule_id, parser.get_rule_id('rules/a.yml', 'example.org', 'Foo bar'))
+        # The path is taken relative to the rules root
+        self.assertEqual(
+            rule_id, parser.get_rule_id('./rules/a.yml', 'example.com',
+                                        'Foo bar'))
+        self.assertEqual(
+            parser.get_rule_id('a.yml', 'example.com', 'Foo bar'),
+            parser.get_rule_id('/srv/orm/rules/a.yml', 'example.com',
+                               'Foo bar', rules_root='/srv/orm/rules'))
+
+    def test_get_rules_root(self):
+        self.assertEqual(parser.get_rules_root('rules/**/*.yml'), 'rules')
+        self.assertEqual(parser.get_rules_root('/srv/rules/a*/b.yml'),
+                         '/srv/rules')
+        self.assertEqual(parser.get_rules_root('rules/a.yml'), 'rules')
+        self.assertEqual(parser.get_rules_root('*.yml'), '.')
+
+    def test_rule_ids_stable(self):
+        def rule_ids(file_docs):
+            rules = parser.merge_documents(file_docs)['rules']
+            return {(rule['_orm_source_file'], rule['description']):
+                    rule['_rule_id'] for rule in rules['example.com']}
+        def doc(*descriptions):
+            return [{'rules': [{'description': description,
+                                'domains': ['example.com']}
+                               for description in descriptions]}]
+        file_docs = [('a.yml', doc('foo', 'bar')), ('b.yml', doc('foo'))]
+        ids = rule_ids(file_docs)
+        self.assertEqual(len(set(ids.values())), 3)
+        # Adding and reordering rules leaves the ids of other rules alone
+        new_ids = rule_ids([('0.yml', doc('foo')), ('b.yml', doc('foo')),
+                            ('a.yml', doc('bar', 'foo', 'baz'))])
+        for key, rule_id in ids.items():
+            self.assertEqual(new_ids[key], rule_id)
+        # Identical rules still get unique ids
+        rules = parser.merge_documents([('a.yml', doc('foo', 'foo'))])
+        rule_one, rule_two = rules['rules']['example.com']
+        self.assertEqual(rule_two['_rule_id'], rule_one['_rule_id'] + '_2')
+
     def test_extract_from_origin(self):
         scheme, host, port = parser.extract_from_origin('www.example.com')
         self.assertIsInstance(scheme, str)
@@ -161,22 +214,22 @@ class ParseRulesTest(unittest.TestCase):
                 'example.com': [
                     {
                         '_orm_source_file': self.merge_files[0],
-                        '_rule_id': 'foo',
+                        '_rule_id': 'foo_5aa87e94',
                         'description': 'foo',
                         'domains': ['example.com', 'site.example.com']
                     }, {
                         '_orm_source_file': self.merge_files[0],
-                        '_rule_id': 'bar',
+                        '_rule_id': 'bar_a72f388d',
                         'description': 'bar',
                         'domains': ['example.com']
                     }, {
                         '_orm_source_file': self.merge_files[1],
-                        '_rule_id': 'foo_3',
+                        '_rule_id': 'foo_c0655123',
                         'description': 'foo',
                         'domains': ['example.com']
                     }, {
                         '_orm_source_file': self.merge_files[1],
-                        '_rule_id': 'baz',
+                        '_rule_id': 'baz_d1e5ed4a',
                         'description': 'baz',
                         'domains': ['example.com']
                     }
@@ -184,7 +237,7 @@ class ParseRulesTest(unittest.TestCase):
                 'site.example.com': [
                     {
                         '_orm_source_file': self.merge_files[0],
-                        '_rule_id': 'foo_2',
+                        '_rule_id': 'foo_48b8edff',
                         'description': 'foo',
                         'domains': ['example.com', 'site.example.com']
                     }
@@ -203,7 +256,7 @@ class ParseRulesTest(unittest.TestCase):
                 'example.com': [
                     {
                         '_orm_source_file': self.defaults_file,
-                        '_rule_id': 'foo',
+                        '_rule_id': 'foo_260e7145',
                         'description': 'foo',
                         'domains': ['example.com'],
                         'actions': {
@@ -211,7 +264,7 @@ class ParseRulesTest(unittest.TestCase):
                         }
                     }, {
                         '_orm_source_file': self.defaults_file,
-                        '_rule_id': 'bar',
+                        '_rule_id': 'bar_69c87f68',
                         'description': 'bar',
                         'domains': ['example.com'],
                         'actions': {
@@ -219,7 +272,7 @@ class ParseRulesTest(unittest.TestCase):
                         }
                     }, {
                         '_orm_source_file': self.defaults_file,
-                        '_rule_id': 'lizard',
+                        '_rule_id': 'lizard_bcc8823e',
                         'description': 'lizard',
                         'domains': ['example.com'],
                         'actions': {
@@ -227,7 +280,7 @@ class ParseRulesTest(unittest.TestCase):
                         }
                     }, {
                         '_orm_source_file': self.defaults_file,
-                        '_rule_id': 'snek',
+                        '_rule_id': 'snek_85d059b8',
                         'description': 'snek',
                         'domains': ['example.com'],
                         'actions': {
@@ -245,6 +298,52 @@ class ParseRulesTest(unittest.TestCase):
         docs = parser.parse_rules([self.defaults_file], defaults=defaults)
         self.assertEqual(docs, exp_docs)
 
+    def test_parse_yaml_files(self):
+        yml_files = self.merge_files + [self.defaults_file,
+                                         self.valid_rule_file]
+        expected = [parser.parse_yaml_file(yml_file) for yml_file in yml_files]
+        self.assertEqual(parser.parse_yaml_files(yml_files), expected)
+        # Parallel parsing keeps the order of the files
+        parallel_parse_min_files = parser.parallel_parse_min_files
+        try:
+            parser.parallel_parse_min_files = 0
+            self.assertEqual(parser.parse_yaml_files(yml_files, max_workers=2),
+                             expected)
+        finally:
+            parser.parallel_parse_min_files = parallel_parse_min_files
+
+    def test_iter_rules(self):
+        merged = parser.parse_rules(self.merge_files)
+        domain_rules = {}
+        for domain, rule in parser.iter_rules(
+                parser.iter_yaml_files(self.merge_files)):
+            domain_rules.setdefault(domain, []).append(rule)
+        self.assertEqual(domain_rules, merged['rules'])
+        # Files are only read when their rules are consumed
+        rules = parser.iter_rules(parser.iter_yaml_files(
+            [self.merge_files[0], 'test/__notfound']))
+        domain, rule = next(rules)
+        self.assertEqual((domain, rule['description']), ('example.com', 'foo'))
+        with self.assertRaises(FileNotFoundError):
+            list(rules)
+
+    def test_loaded_ruleset(self):
+        ruleset = parser.LoadedRuleset(self.merge_files)
+        self.assertEqual(list(ruleset.documents), self.merge_files)
+        merged = ruleset.get_merged_documents()
+        self.assertEqual(merged, parser.parse_rules(self.merge_files))
+        self.assertIs(ruleset.get_merged_documents(), merged)
+        # The loaded documents are left untouched
+        for yml_file, yml_docs in ruleset.documents.items():
+            self.assertEqual(yml_docs, parser.parse_yaml_file(yml_file))
+        self.assertIsNone(ruleset.globals_doc)
+        ruleset = parser.LoadedRuleset([self.defaults_file])
+        ruleset.globals_doc = {'defaults': {'https_redirection': True}}
+        self.assertEqual(
+            ruleset.get_merged_documents(with_defaults=True),
+            parser.parse_rules([self.defaults_file],
+                               defaults={'https_redirection': True}))
+
     def test_parse_match_values(self):
         for value_type in ("path", "query", "method"):
             ## Test flattening
@@ -439,6 +538,66 @@ class ParseRulesTest(unittest.TestCase):
         mini_tree = parser.minify_match_tree(match_tree)
         self.assertEqual(mini_tree, exp_tree)
 
+    def test_canonicalize_match_tree(self):
+        match_tree = {'and': [
+            {'or': [match_leaf('path', 'begins_with', '/b'),
+                    match_leaf('path', 'begins_with', '/a'),
+                    match_leaf('path', 'begins_with', '/a/x')]},
+            {'and': [match_leaf('method', 'exact', 'GET')]},
+            {'not': {'or': [match_leaf('path', 'contains', 'x'),
+                            match_leaf('path', 'contains', 'xy')]}},
+        ]}
+        exp_tree = {'and': [
+            {'match': {'source': 'path', 'function': 'begins_with',
+                       'input': {'values': ['/a', '/b']}}},
+            {'match': {'source': 'method', 'function': 'exact',
+                       'input': {'value': 'GET'}}},
+            {'not': match_leaf('path', 'contains', 'x')},
+        ]}
+        canonical_tree = parser.canonicalize_match_tree(match_tree)
+        self.assertEqual(canonical_tree, exp_tree)
+        self.assertEqual(parser.canonicalize_match_tree(canonical_tree),
+                         canonical_tree)
+        # Equivalent trees get the same canonical form
+        match_tree = {'and': [
+            {'and': [{'not': match_leaf('path', 'contains', 'xy')},
+                     {'not': match_leaf('path', 'contains', 'x')}]},
+            {'not': {'not': match_leaf('method', 'exact', 'GET')}},
+            {'or': [match_leaf('path', 'begins_with', '/b'),
+                    match_leaf('path', 'begins_with', '/a')]},
+        ]}
+        self.assertEqual(parser.canonicalize_match_tree(match_tree),
+                         exp_tree)
+        # Matches with other options are not merged
+        match_tree = {'or': [match_leaf('path', 'exact', '/a'),
+                             match_leaf('path', 'exact', '/b',
+                                        ignore_case=True)]}
+        canonical_tree = parser.canonicalize_match_tree(match_tree)
+        self.assertEqual(len(canonical_tree['or']), 2)
+
+    def test_iter_match_inputs(self):
+        self.assertEqual(list(parser.iter_match_inputs({'value': 'a'})),
+                         [{'value': 'a'}])
+        inp = {'values': ['a', 'b'], 'ignore_case': True}
+        self.assertEqual(list(parser.iter_match_inputs(inp)),
+                         [{'value': 'a', 'ignore_case': True},
+                          {'value': 'b', 'ignore_case': True}])
+        self.assertEqual(list(parser.iter_match_inputs('example.com')),
+                         ['example.com'])
+
+    def test_merge_match_values(self):
+        values = ['/b', '/a/x', '/a', '/a']
+        self.assertEqual(parser.merge_match_values('begins_with', values),
+                         ['/a', '/b'])
+        self.assertEqual(parser.merge_match_values('exact', values),
+                         ['/a', '/a/x', '/b'])
+        self.assertEqual(parser.merge_match_values('ends_with',
+                                                   ['.js', 'a.js', '.css']),
+                         ['.css', '.js'])
+        self.assertEqual(parser.merge_match_values('contains',
+                                                   ['ab', 'b', 'c']),
+                         ['b', 'c'])
+
     def test_traverse_match(self):
         match = {
             'source': 'doge',
@@ -496,6 +655,58 @@ class ParseRulesTest(unittest.TestCase):
         data_out = parser.traverse_match_tree(self.traverse_functions,
                                               match_tree)
         self.assertEqual(data_out, exp_data_out)
+        # Compiled trees are traversed in their canonical form
+        compiled_tree = parser.compile_match_tree(match_tree)
+        exp_data_out = ('and['
+                        'path:ends_with(yeah),'
+                        'domain:exact(example.com),'
+                        'path:!regex(foo)'
+                        ']')
+        data_out = parser.traverse_match_tree(self.traverse_functions,
+                                              compiled_tree)
+        self.assertEqual(data_out, exp_data_out)
+        # Missing handlers default without touching the passed functions
+        functions = {'handle_match': self.traverse_functions['handle_match']}
+        data_out = parser.traverse_match_tree(functions, compiled_tree)
+        self.assertEqual(len(data_out), 3)
+        self.assertEqual(list(functions), ['handle_match'])
+
+    def test_compile_match_tree(self):
+        match_tree = {'or': [
+            {'match': {'source': 'path', 'function': 'exact',
+                       'input': {'value': '/a'}}},
+            {'not': {'match': {'source': 'method', 'function': 'exact',
+                               'input': {'value': 'GET'}}}},
+        ]}
+        compiled_tree = parser.compile_match_tree(match_tree)
+        self.assertIsInstance(compiled_tree, parser.MatchNode)
+        self.assertEqual(compiled_tree.operator, 'or')
+        self.assertEqual([child.negate for child in compiled_tree.children],
+                         [False, True])
+        self.assertEqual(compiled_tree.to_dict(),
+                         parser.canonicalize_match_tree(match_tree))
+        self.assertEqual(compiled_tree, parser.compile_match_tree(match_tree))
+        with self.assertRaises(AttributeError):
+            compiled_tree.operator = 'and'
+        with self.assertRaises(AttributeError):
+            compiled_tree.children[0].negate = True
+
+    def test_domain_rule(self):
+        rules = parser.parse_rules(self.merge_files)['rules']
+        rule = rules['example.com'][0]
+        self.assertIsInstance(rule, parser.DomainRule)
+        # A rule listed for several domains is shared, with one id each
+        other_rule = rules['site.example.com'][0]
+        self.assertIs(rule.rule, other_rule.rule)
+        self.assertEqual((rule.rule_id, other_rule.rule_id),
+                         ('foo_5aa87e94', 'foo_48b8edff'))
+        self.assertEqual(rule['description'], 'foo')
+        self.assertEqual(rule.get('_orm_source_file'), self.merge_files[0])
+        self.assertIsNone(rule.get('matches'))
+        with self.assertRaises(AttributeError):
+            rule.rule.description = 'bar'
+        with self.assertRaises(TypeError):
+            rule['description'] = 'bar'
 
 if __name__ == '__main__':
     unittest.main()
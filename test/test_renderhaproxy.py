@@ -55,6 +55,22 @@ class RenderHAProxyTest(unittest.TestCase):
         self.assertIsStringList(self.render.backends, emptyOk=False)
         self.assertIsStringList(self.render.backend_acls, emptyOk=False)
 
+    def test_profile(self):
+        rule_docs = {
+            'a.example.com': [
+                {'_rule_id': rule_id,
+                 'actions': {'backend': {'origin': 'https://example.com'}}}
+                for rule_id in ['cold', 'hot', 'warm']
+            ]
+        }
+        profile = {'rules': {'hot': 10, 'warm': 1}}
+        render = RenderHAProxy(rule_docs=rule_docs, profile=profile)
+        self.assertEqual([acl.split()[1] for acl in render.backend_acls],
+                         ['hot', 'warm', 'cold'])
+        render = RenderHAProxy(rule_docs=rule_docs)
+        self.assertEqual([acl.split()[1] for acl in render.backend_acls],
+                         ['cold', 'hot', 'warm'])
+
     def test_make_custom_internal_healthcheck(self):
         healthcheck_config = None
         out = renderhaproxy.make_custom_internal_healthcheck(healthcheck_config)
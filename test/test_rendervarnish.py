@@ -4,6 +4,7 @@ import re
 
 from orm.render import ORMInternalRenderException
 import orm.rendervarnish as rendervarnish
+import orm.dispatchtree as dispatchtree
 from orm.rendervarnish import RenderVarnish
 
 def assertIsStringList(self, lst, emptyOk=True):
@@ -84,11 +85,114 @@ class RenderVarnishTest(unittest.TestCase):
         value = re.sub('\n|\r|\v|\f', '', string.printable)
         inp = {'value': value}
         allowed_pattern = re.compile(r'^variable\.get\("path"\) ~ {?".*"}?$')
-        for function in ['regex', 'exact', 'begins_with', 'ends_with',
-                         'contains']:
+        for function in ['regex', 'contains']:
             match = self.render.make_match_path(function, inp)
             self.assertIsInstance(match, str)
             self.assertIsNotNone(re.search(allowed_pattern, match))
+        # Without ignore_case, these need no regex
+        allowed_pattern = re.compile(r'^(std\.strstr\()?"?#?"? ?\+? ?'
+                                     r'variable\.get\("path"\)[ ,)]')
+        for function in ['exact', 'begins_with', 'ends_with']:
+            match = self.render.make_match_path(function, inp)
+            self.assertIsNotNone(re.search(allowed_pattern, match))
+            self.assertNotIn(' ~ ', match)
+            inp_ignore_case = {'value': value, 'ignore_case': True}
+            match = self.render.make_match_path(function, inp_ignore_case)
+            self.assertIn(' ~ ', match)
+
+    def test_make_vcl_input_regex(self):
+        inp = {'values': ['/a', '/b.c']}
+        regex = rendervarnish.make_vcl_input_regex('path', 'begins_with', inp)
+        self.assertEqual(regex, r'^(?:/a|/b\.c).*$')
+        inp = {'values': ['a|b', 'c'], 'ignore_case': True}
+        regex = rendervarnish.make_vcl_input_regex('path', 'regex', inp)
+        self.assertEqual(regex, '(?i)(?:^a|b$)|(?:^c$)')
+        # A single value gets the same regex as on its own
+        inp = {'value': '/a'}
+        self.assertEqual(
+            rendervarnish.make_vcl_input_regex('path', 'exact', inp),
+            rendervarnish.make_vcl_value_regex('path', '/a', 'exact', False))
+        with self.assertRaises(ORMInternalRenderException):
+            rendervarnish.make_vcl_input_regex('path', 'unsupported',
+                                               {'values': ['a', 'b']})
+
+    def test_make_vcl_char_class(self):
+        self.assertEqual(rendervarnish.make_vcl_char_class('dbac'), '[a-d]')
+        self.assertEqual(rendervarnish.make_vcl_char_class('ab.-'),
+                         r'[\-.ab]')
+        self.assertEqual(rendervarnish.make_vcl_char_class('x'), '[x]')
+
+    def test_host_dispatch(self):
+        domains = ['www.example.com', 'example.com', 'example.co', 'a.se',
+                   'api.example.com', 'b.se', 'c.se', 'z.example.org',
+                   'example.com.evil', 'cdn.example.com'] + \
+                  ['host{}.example.com'.format(i) for i in range(40)]
+        tree = dispatchtree.get_host_dispatch_tree(domains)
+        # Far fewer comparisons than checking the domains one by one
+        self.assertLessEqual(dispatchtree.get_host_dispatch_depth(tree), 10)
+
+        def dispatch(tree, host):
+            while not isinstance(tree, list):
+                position, chars, left, right = tree
+                regex = '^' + '.' * position + \
+                    rendervarnish.make_vcl_char_class(chars)
+                tree = right if re.match(regex, host) else left
+            return host if host in tree else None
+
+        for domain in domains:
+            self.assertEqual(dispatch(tree, domain), domain)
+        for host in ['example.org', 'www.example.co', '', 'host4']:
+            self.assertIsNone(dispatch(tree, host))
+        domain_subs = {domain: 'sub_' + str(i)
+                       for i, domain in enumerate(domains)}
+        lines = rendervarnish.make_host_dispatch(tree, domain_subs)
+        assertIsStringList(self, lines, emptyOk=False)
+        self.assertEqual(len([line for line in lines if 'call ' in line]),
+                         len(domains))
+        # Hot domains take fewer comparisons
+        hits = {'www.example.com': 1000, 'host7.example.com': 500}
+        weighted_tree = dispatchtree.get_host_dispatch_tree(domains, hits)
+        for domain in domains:
+            self.assertEqual(dispatch(weighted_tree, domain), domain)
+        costs = dispatchtree.get_host_dispatch_costs(tree)
+        weighted_costs = dispatchtree.get_host_dispatch_costs(weighted_tree)
+        self.assertEqual(sorted(weighted_costs), sorted(domains))
+        for domain in hits:
+            self.assertLess(weighted_costs[domain], costs[domain])
+        self.assertEqual(max(costs.values()),
+                         dispatchtree.get_host_dispatch_depth(tree))
+        self.assertEqual(dispatchtree.get_host_dispatch_tree([]), [])
+        self.assertEqual(rendervarnish.make_host_dispatch([], {}), [])
+
+    def test_make_vcl_string_comparison(self):
+        subject = 'variable.get("path")'
+        self.assertEqual(
+            rendervarnish.make_vcl_string_comparison(subject, 'exact',
+                                                     {'value': '/a'}),
+            'variable.get("path") == "/a"')
+        self.assertEqual(
+            rendervarnish.make_vcl_string_comparison(
+                subject, 'begins_with', {'values': ['/a', '/b']}),
+            '(std.strstr("#" + variable.get("path"), "#/a") == '
+            '("#" + variable.get("path")) || '
+            'std.strstr("#" + variable.get("path"), "#/b") == '
+            '("#" + variable.get("path")))')
+        self.assertEqual(
+            rendervarnish.make_vcl_string_comparison(
+                subject, 'ends_with', {'value': '/a'}, sentinel='#'),
+            'std.strstr(variable.get("path") + "#", "/a#") == "/a#"')
+        # Suffixes need a sentinel which never occurs in the subject
+        self.assertIsNone(rendervarnish.make_vcl_string_comparison(
+            'req.method', 'ends_with', {'value': 'ET'}))
+        for function in ['regex', 'contains']:
+            self.assertIsNone(rendervarnish.make_vcl_string_comparison(
+                subject, function, {'value': '/a'}))
+        self.assertIsNone(rendervarnish.make_vcl_string_comparison(
+            subject, 'exact', {'value': '/a', 'ignore_case': True}))
+        many_values = {'values': [str(i) for i in range(
+            rendervarnish.MAX_STRING_COMPARISON_VALUES + 1)]}
+        self.assertIsNone(rendervarnish.make_vcl_string_comparison(
+            subject, 'exact', many_values))
 
     def test_make_match_query(self):
         with self.assertRaises(ORMInternalRenderException):
@@ -97,11 +201,27 @@ class RenderVarnishTest(unittest.TestCase):
         value = re.sub('\n|\r|\v|\f', '', string.printable)
         inp = {'value': value}
         allowed_pattern = re.compile(r'^variable\.get\("query"\) ~ {?".*"}?$')
-        for function in ['regex', 'exact', 'begins_with', 'ends_with',
-                         'contains']:
+        for function in ['regex', 'contains']:
             match = self.render.make_match_query(function, inp)
             self.assertIsInstance(match, str)
             self.assertIsNotNone(re.search(allowed_pattern, match))
+        # Without ignore_case, these need no regex
+        allowed_pattern = re.compile(r'^(std\.strstr\()?"?#?"? ?\+? ?'
+                                     r'variable\.get\("query"\)[ ,)]')
+        for function in ['exact', 'begins_with', 'ends_with']:
+            match = self.render.make_match_query(function, inp)
+            self.assertIsNotNone(re.search(allowed_pattern, match))
+            self.assertNotIn(' ~ ', match)
+            inp_ignore_case = {'value': value, 'ignore_case': True}
+            match = self.render.make_match_query(function, inp_ignore_case)
+            self.assertIn(' ~ ', match)
+        self.assertEqual(self.render.match_counts['too_many_values'], 0)
+        # Matches over the value limit are counted as such
+        many_values = {'values': [str(i) for i in range(
+            rendervarnish.MAX_STRING_COMPARISON_VALUES + 1)]}
+        match = self.render.make_match_query('exact', many_values)
+        self.assertIn(' ~ ', match)
+        self.assertEqual(self.render.match_counts['too_many_values'], 1)
 
     def test_make_match_domain(self):
         inp = re.sub('\n|\r|\v|\f', '', string.printable)
@@ -166,10 +286,12 @@ class RenderVarnishTest(unittest.TestCase):
     def test_make_condition(self):
         cond = self.render.make_condition(self.match_tree, 'rule_id')
         assertIsStringList(self, cond, emptyOk=False)
-
-    def test_make_match_sub(self):
-        sub = self.render.make_match_sub(self.match_tree, 'rule_id', 'sub_name')
-        assertIsStringList(self, sub, emptyOk=False)
+        self.assertTrue(cond[0].startswith('if ('))
+        self.assertEqual(self.render.rule_match_counts['rule_id'],
+                         {'string': 3, 'regex': 0, 'too_many_values': 0})
+        cond = self.render.make_condition(self.match_tree, 'rule_id',
+                                          keyword='} elseif')
+        self.assertTrue(cond[0].startswith('} elseif ('))
 
     def test_make_actions(self):
         unknown_action_config = {'unknown': 'action',
@@ -177,7 +299,7 @@ class RenderVarnishTest(unittest.TestCase):
         with self.assertRaises(ORMInternalRenderException):
             self.render.make_actions(unknown_action_config,
                                      'rule_id',
-                                     match_sub_name='sub_name')
+                                     match_tree=self.match_tree)
         action_config = {
             'https_redirection': True,
             'trailing_slash': 'add',
@@ -204,11 +326,13 @@ class RenderVarnishTest(unittest.TestCase):
         created = self.render.make_actions(action_config,
                                            'rule_id',
                                            domain=domain,
-                                           match_sub_name='sub_name')
+                                           match_tree=self.match_tree)
         self.assertTrue(created)
         sb = self.render.actions_southbound
         nb = self.render.actions_northbound
-        assertIsStringList(self, sb[domain], emptyOk=False)
+        self.assertEqual(len(sb[domain]), 1)
+        self.assertEqual(sb[domain][0]['match_tree'], self.match_tree)
+        assertIsStringList(self, sb[domain][0]['actions'], emptyOk=False)
         assertIsStringList(self, nb[domain], emptyOk=False)
         # Create default rules
         created = self.render.make_actions(action_config,
@@ -229,6 +353,28 @@ class RenderVarnishTest(unittest.TestCase):
         assertIsStringList(self, sb_global, emptyOk=False)
         assertIsStringList(self, nb_global, emptyOk=False)
 
+    def test_make_southbound_actions(self):
+        action_config = {'backend': {'origin': 'example.com'}}
+        for rule_id in ['one', 'two', 'three']:
+            self.render.make_actions(action_config, rule_id, domain='domain',
+                                     match_tree=self.match_tree,
+                                     indent_depth=1)
+        self.render.make_actions(action_config, 'default', domain='domain',
+                                 indent_depth=1)
+        subs, dispatch = self.render.make_southbound_actions(['domain'])
+        assertIsStringList(self, subs, emptyOk=False)
+        assertIsStringList(self, dispatch, emptyOk=False)
+        # The rules form one chain, which stops at the first match,
+        # followed by the default actions
+        self.assertEqual(len([line for line in subs
+                              if line.strip().startswith('if (')]), 1)
+        self.assertEqual(len([line for line in subs
+                              if line.strip().startswith('} elseif (')]), 2)
+        chain_end = subs.index('  }')
+        self.assertIn('match_default', ' '.join(subs[chain_end:]))
+        self.assertEqual(self.render.southbound_subs,
+                         {'domain': 'southbound_domain'})
+
 def fresh_action_args():
     return {
         'config_out': {
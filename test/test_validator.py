@@ -1,8 +1,11 @@
+import os
+import shutil
 import unittest
+import tempfile
 
-from greenery.fsm import fsm
-
+import orm.parser as parser
 import orm.validator as validator
+import orm.fsmcache as fsmcache
 
 class ValidateRulesTest(unittest.TestCase):
     #pylint:disable=too-many-instance-attributes
@@ -21,16 +24,6 @@ class ValidateRulesTest(unittest.TestCase):
         self.valid_globals = self.testpath + 'valid_globals.yml'
         self.invalid_globals = self.testpath + 'invalid_globals.yml'
 
-    def test_lego_ignore_case(self):
-        exp = ('[yY][eE][aA][hH]\\[[bB][oO][iI]\\]'
-               '[tT][hH][iI][sS][rRa-eA-EgG\\-eExX][!]')
-        out = validator.lego_ignore_case('yeAh\\[boi\\]this[ra-eg\\-ex][!]')
-        self.assertEqual(exp, out)
-        # Do not convert weird non-ascii character ranges.
-        exp = ('[a-ö][$-f]')
-        out = validator.lego_ignore_case('[a-ö][$-f]')
-        self.assertEqual(exp, out)
-
     def test_ignore_case(self):
         pass
 
@@ -75,6 +68,110 @@ class ValidateRulesTest(unittest.TestCase):
         self.assertEqual(r, False, "Constraint check with invalid ORM file "
                          "due to 'domain_default: False'")
 
+    def test_validate_rule_constraints_cache(self):
+        with tempfile.TemporaryDirectory() as cache_path:
+            for _ in range(2):
+                r = validator.validate_rule_constraints(
+                    yml_files=[self.valid_rule], cache_path=cache_path)
+                self.assertEqual(r, True, "Constraint check with valid ORM "
+                                 "file using cache")
+                r = validator.validate_rule_constraints(
+                    yml_files=[self.invalid_collision], cache_path=cache_path)
+                self.assertEqual(r, False, "Constraint check with invalid ORM "
+                                 "file using cache")
+
+    def test_validate_constraints_rule_collision_multiple_domains(self):
+        def rule(description, function, path):
+            return {'description': description,
+                    '_orm_source_file': 'rules.yml',
+                    'matches': {'all': [{'paths': {function: [path]}}]}}
+        domains = ['a.example.com', 'b.example.com', 'c.example.com']
+        domain_rules = {domain: [rule('one', 'regex', '/one.*'),
+                                 rule('two', 'regex', '/t.*o')]
+                        for domain in domains}
+        with tempfile.TemporaryDirectory() as cache_path:
+            r = validator.validate_constraints_rule_collision(
+                domain_rules, cache_path=cache_path)
+            self.assertTrue(r)
+            # One set of FSM:s per unique match tree, not per domain
+            fsm_dir = os.path.join(cache_path, 'fsm')
+            self.assertEqual(
+                sum(len(files) for _, _, files in os.walk(fsm_dir)), 2)
+            # The verdict of the pair outlives its FSM:s
+            shutil.rmtree(fsm_dir)
+            shutil.rmtree(os.path.join(cache_path, 'verified'))
+            r = validator.validate_constraints_rule_collision(
+                domain_rules, cache_path=cache_path)
+            self.assertTrue(r)
+            self.assertFalse(os.path.exists(fsm_dir))
+            domain_rules['b.example.com'].append(
+                rule('three', 'begins_with', '/one/x'))
+            r = validator.validate_constraints_rule_collision(
+                domain_rules, cache_path=cache_path)
+            self.assertFalse(r)
+
+    def test_validate_rule_files_incremental(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_path = os.path.join(tmpdir, 'cache')
+            rule_files = [os.path.join(tmpdir, 'rule.yml'),
+                          os.path.join(tmpdir, 'other.yml')]
+            with open(self.valid_rule) as src:
+                valid_rule = src.read()
+            with open(rule_files[0], 'w') as dst:
+                dst.write(valid_rule)
+            with open(rule_files[1], 'w') as dst:
+                dst.write(valid_rule.replace('sport', 'news')
+                          .replace('Sport', 'News'))
+            r = validator.validate_rule_files(yml_files=rule_files,
+                                              cache_path=cache_path)
+            self.assertTrue(r)
+            manifest = fsmcache.FSMCache(cache_path).load_manifest(tmpdir)
+            self.assertEqual(manifest, {})
+            ruleset = parser.LoadedRuleset(rule_files, rules_root=tmpdir)
+            r = validator.validate_rule_files(cache_path=cache_path,
+                                              ruleset=ruleset)
+            self.assertTrue(r)
+            manifest = fsmcache.FSMCache(cache_path).load_manifest(tmpdir)
+            self.assertEqual(sorted(manifest), ['other.yml', 'rule.yml'])
+            # Unchanged files are not parsed again
+            ruleset = parser.LoadedRuleset(rule_files, rules_root=tmpdir)
+            r = validator.validate_rule_files(cache_path=cache_path,
+                                              ruleset=ruleset)
+            self.assertTrue(r)
+            self.assertEqual(ruleset.loaded_documents, {})
+            # A changed file is validated again, and its rules are checked
+            # against the rules of unchanged files
+            with open(rule_files[1], 'w') as dst:
+                dst.write(valid_rule.replace('Sport', 'Other'))
+            ruleset = parser.LoadedRuleset(rule_files, rules_root=tmpdir)
+            r = validator.validate_rule_files(cache_path=cache_path,
+                                              ruleset=ruleset)
+            self.assertFalse(r)
+            self.assertEqual(list(ruleset.loaded_documents), rule_files[1:])
+            with open(self.invalid_schema) as src, \
+                    open(rule_files[1], 'w') as dst:
+                dst.write(src.read())
+            ruleset = parser.LoadedRuleset(rule_files, rules_root=tmpdir)
+            r = validator.validate_rule_files(cache_path=cache_path,
+                                              ruleset=ruleset)
+            self.assertFalse(r)
+            manifest = fsmcache.FSMCache(cache_path).load_manifest(tmpdir)
+            self.assertEqual(list(manifest), ['rule.yml'])
+
+    def test_validate_constraints_rule_collision_duplicate_rule(self):
+        rule = {'description': 'one',
+                '_orm_source_file': 'rules.yml',
+                'matches': {'all': [{'paths': {'begins_with': ['/one']}}]}}
+        with tempfile.TemporaryDirectory() as cache_path:
+            r = validator.validate_constraints_rule_collision(
+                {'a.example.com': [rule]}, cache_path=cache_path)
+            self.assertTrue(r)
+            # A verified rule still collides with a copy of itself
+            r = validator.validate_constraints_rule_collision(
+                {'a.example.com': [rule, dict(rule, description='two')]},
+                cache_path=cache_path)
+            self.assertFalse(r)
+
     def test_get_schema(self):
         yml_file = 'superfile'
         yml_doc_without_version = {'good': 'stuff'}
@@ -91,43 +188,21 @@ class ValidateRulesTest(unittest.TestCase):
                                                   schema_type)
                 self.assertIsInstance(orm_schema, dict)
 
-    def test_get_all_match_fsms(self):
-        match_tree = {
-            'and': [
-                {'or': [
-                    {'not': {'and': [
-                        {'match': {
-                            'source': 'path',
-                            'function': 'regex',
-                            'input': {
-                                'value': 'imba'
-                            }
-                        }}
-                    ]}}
-                ]},
-                {'not': {'not': {
-                    'match': {
-                        'source': 'path',
-                        'function': 'begins_with',
-                        'input': {
-                            'value': 'yeah'
-                        }
-                    }
-                }}}
-            ]
-        }
-        fsm_obj = validator.get_all_match_fsms(match_tree)
-        self.assertIsInstance(fsm_obj, dict)
-        self.assertIsInstance(fsm_obj["path"], fsm)
-        # Test match tree without any path matches
-        match_tree = {
-            'match': {'source': 'domain',
-                      'function': 'exact',
-                      'input': 'example.com'}
-        }
-        fsm_obj = validator.get_all_match_fsms(match_tree)
-        self.assertIsInstance(fsm_obj, dict)
-        self.assertIsInstance(fsm_obj["path"], fsm)
+    def test_get_schema_validator(self):
+        schema_file = validator.get_schema_file('superfile',
+                                                {'schema_version': 2})
+        self.assertIs(validator.get_schema_validator(schema_file),
+                      validator.get_schema_validator(schema_file))
+        self.assertIs(validator.get_schema('superfile', {'schema_version': 2}),
+                      validator.load_schema(schema_file))
+
+    def test_memoize_format_check(self):
+        format_check = validator.format_check_uri_path
+        hits = format_check.cache_info().hits
+        self.assertTrue(format_check('some/path'))
+        self.assertTrue(format_check('some/path'))
+        self.assertEqual(format_check.cache_info().hits, hits + 1)
+        self.assertFalse(validator.format_check_origin(['not', 'a', 'string']))
 
 if __name__ == '__main__':
     unittest.main()